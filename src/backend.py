@@ -1,19 +1,27 @@
-import datetime
 from selenium.webdriver.common.action_chains import ActionChains
 import os
-import time
 import asyncio
 import logging
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 from flat_search.backends.za import Za
 from flat_search.data import Property
 from flat_search.data.changes import PropertyChanges, dump_latest_changes
-from flat_search.data.dump import dump_properties
-from flat_search.email import send_property_updates_email
-from flat_search.settings import Settings, load_settings
-from croniter import croniter
-
-from flat_search.util import binomial_trial, random_in_range
+from flat_search.data.digest import DIGEST_FILENAME, ChangeDigest
+from flat_search.data.dedup import DuplicateIndex, deduplicate
+from flat_search.data.events import EVENTS_DIRNAME, ChangeEventLog, change_events
+from flat_search.data.dump import dump_properties, list_dumps
+from flat_search.data.price_history import PRICE_HISTORY_DIRNAME, PriceDrop, PriceHistory
+from flat_search.data.run_metrics import RUN_METRICS_FILENAME, MetricsDriftError, RunMetrics, RunMetricsStore
+from flat_search.data.search_index import INDEX_FILENAME, snapshot_timestamp
+from flat_search.data.seen import ListingStatus, SeenIndex
+from flat_search.data.filter import filter_settings
+from flat_search.email import send_error_email, send_property_updates_email
+from flat_search.api import start_api_server
+from flat_search.exporter import LISTINGS_PER_RUN, PAGES_PER_RUN, start_metrics_server
+from flat_search.scheduler import SearchScheduler
+from flat_search.settings import SearchProfile, Settings, load_search_profiles, load_settings
 load_dotenv()
 
 
@@ -27,80 +35,241 @@ load_dotenv()
 # ActionChains.scroll_to_element = _scroll_to_element
 
 
-def property_filter(p: Property, settings: Settings) -> bool:
-    price_above_min = p.price_per_month is not None and \
-        p.price_per_month >= settings.min_price
-    price_below_max = p.price_per_month <= settings.max_price
-
-    bedrooms_above_min = p.bedrooms is not None and \
-        p.bedrooms >= settings.min_bedrooms
-    bedrooms_below_max = p.bedrooms <= settings.max_bedrooms
+def match_history(properties: List[Property], dump_dir: str, settings: Settings) -> Tuple[Dict[str, List[str]], Dict[str, float]]:
+    """ matches the listings against every earlier dump in `dump_dir`.
 
-    available_from_above = p.available_from is not None and \
-        p.available_from.timestamp() > settings.available_from
+        returns the ids of new listings mapped to the ids of the earlier listings they duplicate or repost,
+        and the ids of listings back on the market after being absent from the last dump mapped to when they were first seen
+    """
+    if not list_dumps(dump_dir):
+        return ({}, {})
+    path = os.path.join(dump_dir, INDEX_FILENAME)
+    try:
+        seen = SeenIndex(path, settings.seen_bloom_filter_bits)
+        sightings = seen.classify(properties)
+        seen.close()
 
-    logging.debug(
-        f"property: {p.id} filters: price:{p.price_per_month}, price_above_min={price_above_min}, price_below_max:{price_below_max}, bedrooms: {p.bedrooms}, bedrooms_above_min:{bedrooms_above_min}, bedrooms_below_max:{bedrooms_below_max}, available_from: {p.available_from}, available_from_above:{available_from_above}")
-    return price_above_min and price_below_max and bedrooms_above_min and bedrooms_below_max and available_from_above
+        duplicates = DuplicateIndex(path)
+        relisted = duplicates.match(properties)
+        duplicates.close()
+    except:
+        logging.exception(
+            "Exception in matching listings against earlier dumps")
+        return ({}, {})
 
+    for id, sighting in sightings.items():
+        if sighting.status == ListingStatus.REPOSTED:
+            relisted.setdefault(id, [])
+            if sighting.previous_id not in relisted[id]:
+                relisted[id].insert(0, sighting.previous_id)
+    returning = {id: x.first_seen for id, x in sightings.items()
+                 if x.status == ListingStatus.RETURNING}
 
-async def execute(settings: Settings):
+    counts = Counter(x.status.value for x in sightings.values())
     logging.info(
-        "Executing scraping and json delta notification routines")
-    za_provider = Za(settings)
+        f"Listings by status: {dict(counts)}, relisted: {relisted}, returning: {list(returning)}")
+    return (relisted, returning)
+
+
+def find_price_drops(properties: List[Property], dump_dir: str) -> Dict[str, PriceDrop]:
+    """ the listings cheaper in the latest dump in `dump_dir` than they have ever been seen at before """
+    try:
+        return PriceHistory(os.path.join(dump_dir, PRICE_HISTORY_DIRNAME)).price_drops([x.id for x in properties])
+    except:
+        logging.exception("Exception in finding price drops")
+        return {}
+
+
+def deliver(settings: Settings, changes: Optional[PropertyChanges], old_properties: List[Property], properties: List[Property], dump_dir: str):
+    """ emails the changes straight away, or in digest mode queues them and emails the digest once it's due.
+        with no changes a digest which came due since the last run is still sent
+    """
+    if settings.digest_window_minutes <= 0:
+        if changes:
+            send_property_updates_email(
+                settings, changes, old_properties, properties, find_price_drops(properties, dump_dir))
+        return
+
+    digest = ChangeDigest(os.path.join(dump_dir, DIGEST_FILENAME))
+    try:
+        if changes:
+            digest.add(changes, old_properties, properties)
+        pending = digest.pending()
+        if not digest.due(settings.digest_window_minutes * 60, settings.digest_max_changes):
+            logging.info(
+                f"{pending} listings with changes queued for the next digest")
+            return
 
-    properties_za = await za_provider.retrieve_all_properties()
-    properties_za = list(filter(
-        lambda p: property_filter(p, settings), properties_za))
+        collected = digest.collect()
+        if collected:
+            changes, old_properties, properties = collected
+            logging.info(f"Sending digest of {pending} changed listings")
+            send_property_updates_email(
+                settings, changes, old_properties, properties, find_price_drops(properties, dump_dir))
+        else:
+            logging.info("Queued changes cancelled out, no digest to send")
+        digest.clear()
+    finally:
+        digest.close()
 
-    new_dump_path = dump_properties(properties_za)
-    changes = await dump_latest_changes(settings)
+
+def log_change_events(changes: PropertyChanges, old_properties: List[Property], properties: List[Property], dump_path: str):
+    """ appends one event per changed listing to the change event log next to the dump """
+    try:
+        events = ChangeEventLog(os.path.join(os.path.dirname(dump_path), EVENTS_DIRNAME)).append(
+            change_events(changes, old_properties, properties, snapshot_timestamp(os.path.basename(dump_path))))
+        if events:
+            logging.info(
+                f"Logged change events {events[0].offset} to {events[-1].offset}")
+    except:
+        logging.exception("Exception in logging change events")
+
+
+async def notify(settings: Settings, properties: List[Property], dump_dir: str, metrics: RunMetrics):
+    """ filters the scraped properties with the given settings, dumps them and emails the changes since the last dump in `dump_dir` """
+    with metrics.phase("filter"):
+        filtered = filter_settings(properties, settings)
+    logging.info(
+        f"Kept {len(filtered)} of {len(properties)} parsed properties after client side filtering")
+    properties = filtered
+    metrics.add("listings_kept", len(properties))
+
+    with metrics.phase("match"):
+        relisted, returning = match_history(properties, dump_dir, settings)
+    with metrics.phase("dump"):
+        new_dump_path = dump_properties(
+            properties, dump_dir, settings.dump_format == "ndjson")
+    with metrics.phase("diff"):
+        changes = await dump_latest_changes(
+            settings, dump_dir, relisted, returning)
     if changes:
         changes, old_properties, new_properties = changes
-        send_property_updates_email(
-            settings, changes, old_properties, new_properties)
-    elif len(os.listdir('data/')) > 1:
+        # the event log records every change, removed listings are only left out of the emails
+        log_change_events(changes, old_properties,
+                          new_properties, new_dump_path)
+        if not settings.send_removed_properties:
+            changes.removed = []
+        with metrics.phase("email"):
+            deliver(settings, None if changes.empty() else changes, old_properties,
+                    new_properties, dump_dir)
+    elif len(list_dumps(dump_dir)) > 1:
         logging.info(f"Deleting dump at: {new_dump_path} as no new changes")
         os.remove(new_dump_path)
+        with metrics.phase("email"):
+            deliver(settings, None, [], [], dump_dir)
     else:
         logging.info(f"Sending first dump via email")
-        send_property_updates_email(
-            settings, PropertyChanges(
-                [x.id for x in properties_za], [], {}), [], properties_za
-        )
+        changes = PropertyChanges([x.id for x in properties], [], {})
+        log_change_events(changes, [], properties, new_dump_path)
+        with metrics.phase("email"):
+            deliver(settings, changes, [], properties, dump_dir)
 
-if __name__ == "__main__":
 
-    while True:
-        # load settings each time in case they change, this lets us change things in between runs
-        settings = load_settings()
-        start = datetime.datetime.now()
-        cron_iter = croniter(settings.cron_expression, start)
+def record_run_metrics(settings: Settings, metrics: RunMetrics, status: str, dump_dir: str):
+    """ stores the metrics of the run and emails an alert if a successful run drifted away from the runs before it """
+    metrics.finish()
+    logging.info("run metrics: %s", metrics.values)
+    PAGES_PER_RUN.observe(metrics.values.get("pages_walked", 0))
+    LISTINGS_PER_RUN.observe(metrics.values.get("listings_parsed", 0))
+    try:
+        store = RunMetricsStore(os.path.join(dump_dir, RUN_METRICS_FILENAME))
+        try:
+            run_id = store.record(metrics, status)
+            drifted = {}
+            if status == "ok" and settings.metrics_alert_band > 0:
+                drifted = store.drifts(run_id, metrics, settings.metrics_alerts,
+                                       settings.metrics_alert_band, settings.metrics_alert_window)
+        finally:
+            store.close()
+    except:
+        logging.exception("Exception in recording run metrics")
+        return
 
-        next_date: datetime.datetime = cron_iter.get_next(
-            ret_type=datetime.datetime)
-        random_minutes = random_in_range(
-            0, settings.cron_expression_variation)
-        logging.info(f"Next cron trigger: {next_date}")
-        randomized_trigger = next_date + \
-            datetime.timedelta(minutes=random_minutes)
-        logging.info(
-            f"Adding random variation of {random_minutes:.2f} minutes, new trigger {randomized_trigger}")
+    if drifted:
+        error = MetricsDriftError(drifted)
+        logging.warning(f"Run {run_id} drifted: {error}")
+        send_error_email(settings, None, error)
 
-        sleep_time = randomized_trigger - datetime.datetime.now()
-        logging.info(f"Sleeping for {sleep_time}")
 
-        will_skip = binomial_trial(settings.cron_expression_skip_chance)
-        logging.info(f"Will this run be skipped?: {will_skip}")
+async def scrape(settings: Settings, metrics: RunMetrics) -> List[Property]:
+    """ scrapes the search, a failed scrape is retried up to `scrape_retries` times and resumes from the pages it parsed """
+    for attempt in range(settings.scrape_retries + 1):
+        final_attempt = attempt == settings.scrape_retries
+        za_provider = Za(settings)
+        try:
+            return await za_provider.retrieve_all_properties(final_attempt)
+        except Exception:
+            if final_attempt:
+                raise
+            logging.warning(
+                f"Scrape attempt {attempt + 1} of {settings.scrape_retries + 1} failed, retrying in {settings.scrape_retry_delay_seconds}s")
+            metrics.add("scrape_retries", 1)
+        finally:
+            if za_provider.report:
+                metrics.add_report(za_provider.report)
+        await asyncio.sleep(settings.scrape_retry_delay_seconds)
+
+
+async def execute(settings: Settings, dump_dir: str = "data"):
+    logging.info(
+        "Executing scraping and json delta notification routines")
+    metrics = RunMetrics(settings.trace_allocations)
+    status = "failed"
+    try:
+        # with subscribers the union of their searches is scraped only once
+        properties_za = await scrape(settings.superset(), metrics)
+        # results shift between pages while walking them so the same listing can be parsed more than once
+        with metrics.phase("dedup"):
+            properties_za, _ = deduplicate(properties_za)
+
+        if not settings.subscribers:
+            await notify(settings, properties_za, dump_dir, metrics)
+
+        for subscriber in settings.subscribers:
+            logging.info(f"Notifying subscriber: {subscriber.name}")
+            await notify(settings.for_subscriber(subscriber), properties_za,
+                         os.path.join(dump_dir, subscriber.name), metrics)
+        status = "ok"
+    finally:
+        record_run_metrics(settings, metrics, status, dump_dir)
 
-        time.sleep(sleep_time.total_seconds())
 
+async def execute_profile(profile: SearchProfile, settings: Settings):
+    # picks up a changed logging level, only reparses the main settings file if it changed
+    load_settings()
+    await execute(settings, profile.dump_dir)
+
+
+def api_dump_dirs(profiles: List[SearchProfile]) -> Dict[str, str]:
+    """ the dump directory of every search mapped to its name, a search with subscribers has one per subscriber named `<search>/<subscriber>` """
+    dump_dirs = {}
+    for profile in profiles:
         try:
-            if not will_skip:
-                asyncio.run(execute(settings))
-            else:
-                logging.info("Skipping...")
-        except Exception as E:
-            logging.error(
-                f"Exception in scraping run.")
-            logging.exception(E)
+            subscribers = profile.load().subscribers
+        except:
+            logging.exception(
+                f"Exception in loading the settings of {profile.name}, its listings are not served")
+            continue
+        if not subscribers:
+            dump_dirs[profile.name] = profile.dump_dir
+        for subscriber in subscribers:
+            dump_dirs[f"{profile.name}/{subscriber.name}"] = os.path.join(
+                profile.dump_dir, subscriber.name)
+    return dump_dirs
+
+
+if __name__ == "__main__":
+    # configures logging from the main settings file
+    settings = load_settings()
+    if settings.metrics_port:
+        start_metrics_server(settings.metrics_host, settings.metrics_port)
+    profiles, max_concurrent_sessions = load_search_profiles()
+    if settings.api_port:
+        start_api_server(api_dump_dirs(profiles),
+                         settings.api_host, settings.api_port)
+    logging.info(
+        f"Scheduling searches: {[x.name for x in profiles]} with at most {max_concurrent_sessions} concurrent sessions")
+
+    scheduler = SearchScheduler(
+        profiles, execute_profile, max_concurrent_sessions)
+    asyncio.run(scheduler.run_forever())
@@ -0,0 +1,253 @@
+"""
+Offline commands over the dumps of a search, none of them import the browser stack.
+
+    python -m flat_search diff <old dump> <new dump>
+    python -m flat_search render <old dump> <new dump> --out email.html
+    python -m flat_search replay data
+    python -m flat_search stats data
+    python -m flat_search metrics data
+    python -m flat_search serve data --port 8080
+    python -m flat_search check-imports
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+from flat_search.data import Property
+
+BROWSER_MODULES = ["selenium", "seleniumwire", "undetected_chromedriver",
+                   "fake_useragent", "requests", "bs4", "dateparser"]
+""" top level packages which must not be imported by the offline commands """
+
+
+def load_properties(path: str) -> Tuple[dict, List[Property]]:
+    from flat_search.data.snapshot import load_dump
+
+    dump = load_dump(path)
+    return (dump, Property.schema().load(dump["properties"], many=True))
+
+
+def diff(args: argparse.Namespace):
+    from flat_search.data.changes import EXCLUDED_ATTRIBUTES, PropertyChanges, generate_changes, merge_changes
+    from flat_search.data.snapshot import is_ndjson, read_snapshot
+
+    if is_ndjson(args.old) and is_ndjson(args.new):
+        changes, _, _ = merge_changes(read_snapshot(args.old), read_snapshot(
+            args.new), EXCLUDED_ATTRIBUTES, keep_values=False)
+    else:
+        old, _ = load_properties(args.old)
+        new, _ = load_properties(args.new)
+        changes = generate_changes(
+            old, new, excluded_attributes=EXCLUDED_ATTRIBUTES)
+    print(json.dumps(changes, indent=4, cls=PropertyChanges.Encoder))
+
+
+def render(args: argparse.Namespace):
+    from dataclasses import replace
+    from flat_search.data.changes import EXCLUDED_ATTRIBUTES, generate_changes
+    from flat_search.email import generate_email
+    from flat_search.settings import parse_settings
+
+    old, old_properties = load_properties(args.old)
+    new, properties = load_properties(args.new)
+    settings = parse_settings(args.settings)
+    if args.template:
+        settings = replace(settings, email_template=args.template)
+
+    changes = generate_changes(
+        old, new, excluded_attributes=EXCLUDED_ATTRIBUTES)
+    html = generate_email(settings, changes, old_properties, properties)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(html)
+    else:
+        print(html)
+
+
+def replay(args: argparse.Namespace):
+    from flat_search.data.changes import EXCLUDED_ATTRIBUTES, generate_changes
+    from flat_search.data.dump import list_dumps
+    from flat_search.data.snapshot import load_dump
+
+    dumps = list_dumps(args.dump_dir)
+    previous = None
+    for filename in dumps:
+        dump = load_dump(os.path.join(args.dump_dir, filename))
+        if previous is None:
+            print(f"{filename}\t{len(dump['properties'])} listings")
+        else:
+            changes = generate_changes(
+                previous, dump, excluded_attributes=EXCLUDED_ATTRIBUTES)
+            print(f"{filename}\t{len(dump['properties'])} listings\tappended: {len(changes.appended)}"
+                  f"\tremoved: {len(changes.removed)}\tmodified: {len(changes.modified)}")
+        previous = dump
+
+    if args.rebuild:
+        from flat_search.data.price_history import rebuild_price_history
+        from flat_search.data.search_index import rebuild_index
+
+        rebuild_index(args.dump_dir).close()
+        rebuild_price_history(args.dump_dir)
+        print(
+            f"rebuilt the search index and price history from {len(dumps)} dumps")
+
+
+def stats(args: argparse.Namespace):
+    import numpy as np
+    from flat_search.data.dump import list_dumps
+    from flat_search.data.filter import PropertyColumns
+    from flat_search.data.postcode import district_stats
+
+    dumps = list_dumps(args.dump_dir)
+    if not dumps:
+        raise SystemExit(f"no dumps in {args.dump_dir}")
+    _, properties = load_properties(os.path.join(args.dump_dir, dumps[-1]))
+    print(
+        f"{len(dumps)} dumps from {os.path.splitext(dumps[0])[0]} to {os.path.splitext(dumps[-1])[0]}")
+    print(f"{len(properties)} listings in the latest dump")
+
+    columns = PropertyColumns(properties)
+    bedrooms = np.array([str(int(x)) if not np.isnan(x) else ""
+                        for x in columns.bedrooms], dtype=str)
+    for name, groups in [("bedrooms", bedrooms), ("area", columns.postcode_area)]:
+        for key, (count, median) in sorted(district_stats(groups, columns.price_per_month).items()):
+            print(f"{name} {key}\tcount: {count}\tmedian pcm: {median:.0f}")
+
+
+def metrics(args: argparse.Namespace):
+    from flat_search.data.run_metrics import RUN_METRICS_FILENAME, RunMetricsStore, metrics_report
+
+    path = os.path.join(args.dump_dir, RUN_METRICS_FILENAME)
+    if not os.path.exists(path):
+        raise SystemExit(f"no run metrics in {args.dump_dir}")
+    store = RunMetricsStore(path)
+    print(metrics_report(store, args.runs, args.names))
+    store.close()
+
+
+def serve(args: argparse.Namespace):
+    from flat_search.api import make_api_server
+
+    server = make_api_server({"": args.dump_dir}, args.host, args.port)
+    print(
+        f"serving the listings of {args.dump_dir} at http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+OFFLINE_MODULES = ["flat_search.api", "flat_search.__main__", "flat_search.data.changes", "flat_search.data.dump", "flat_search.data.filter",
+                   "flat_search.data.postcode", "flat_search.data.price_history", "flat_search.data.run_metrics", "flat_search.data.search_index",
+                   "flat_search.email"]
+""" every module the offline commands import when they run """
+
+
+def import_times(modules: List[str]) -> Tuple[Dict[str, int], int]:
+    """ imports the modules in a fresh interpreter, returns the cumulative microseconds of every module imported and the total """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+                            capture_output=True, text=True, env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit(f"importing {modules} failed")
+
+    imported = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        imported[name.strip()] = int(cumulative)
+        # top level imports are indented by a single space, nested ones by more
+        if not name.startswith("  "):
+            total += int(cumulative)
+    return (imported, total)
+
+
+def check_imports(args: argparse.Namespace):
+    """ fails if the offline commands, or the backends package, import the browser stack or the offline commands take too long to import """
+    failed = False
+    for modules, budget_ms in [(OFFLINE_MODULES, args.max_ms), (["flat_search.backends"], None)]:
+        imported, total = import_times(modules)
+        heavy = sorted(
+            x for x in imported if x.split(".")[0] in BROWSER_MODULES)
+        print(f"import {', '.join(modules)}: {total / 1000:.0f}ms")
+        if heavy:
+            print(f"  imports the browser stack: {heavy}")
+            failed = True
+        if budget_ms is not None and total / 1000 > budget_ms:
+            print(f"  slower than {budget_ms:g}ms")
+            failed = True
+
+    if failed:
+        raise SystemExit(1)
+    print("ok")
+
+
+def main():
+    env = os.getenv("ENV", "dev")
+    parser = argparse.ArgumentParser(
+        prog="python -m flat_search", description="offline commands over the dumps of a search")
+    commands = parser.add_subparsers(required=True, metavar="command")
+
+    command = commands.add_parser(
+        "diff", help="print the changes between two dumps as json")
+    command.add_argument("old")
+    command.add_argument("new")
+    command.set_defaults(func=diff)
+
+    command = commands.add_parser(
+        "render", help="render the email for the changes between two dumps")
+    command.add_argument("old")
+    command.add_argument("new")
+    command.add_argument("--settings", default=f"settings-{env}.json")
+    command.add_argument("--template", help="overrides the email_template of the settings")
+    command.add_argument("--out", help="write the html here instead of printing it")
+    command.set_defaults(func=render)
+
+    command = commands.add_parser(
+        "replay", help="diff every dump in a directory against the one before it")
+    command.add_argument("dump_dir", nargs="?", default="data")
+    command.add_argument("--rebuild", action="store_true",
+                         help="also rebuild the search index and price history from the dumps")
+    command.set_defaults(func=replay)
+
+    command = commands.add_parser(
+        "stats", help="listing counts and median prices of the latest dump")
+    command.add_argument("dump_dir", nargs="?", default="data")
+    command.set_defaults(func=stats)
+
+    command = commands.add_parser(
+        "metrics", help="trends of the metrics recorded by every run")
+    command.add_argument("dump_dir", nargs="?", default="data")
+    command.add_argument("names", nargs="*",
+                         help="the metrics to show, all of them by default")
+    command.add_argument("--runs", type=int, default=20,
+                         help="the number of latest runs to show")
+    command.set_defaults(func=metrics)
+
+    command = commands.add_parser(
+        "serve", help="serve the read-only listings api over the dumps")
+    command.add_argument("dump_dir", nargs="?", default="data")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8080)
+    command.set_defaults(func=serve)
+
+    command = commands.add_parser(
+        "check-imports", help="check the offline commands don't import the browser stack")
+    command.add_argument("--max-ms", type=float, default=1000,
+                         help="the most importing the offline commands may take")
+    command.set_defaults(func=check_imports)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+Read-only http api over the dumps of a search: the current listings, the history of a listing and the latest changes
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from flat_search.data import Property, PropertyType
+from flat_search.data.dump import add_dump_listener, list_dumps
+from flat_search.data.events import EVENTS_DIRNAME, ChangeEventLog
+from flat_search.data.filter import filter_properties
+from flat_search.data.price_history import PRICE_HISTORY_DIRNAME, PriceHistory
+from flat_search.data.snapshot import is_ndjson, loads_dump
+from flat_search.exporter import API_CACHE
+from flat_search.settings import FilterRule, rule_problems
+
+DEFAULT_PAGE_SIZE = 50
+
+MAX_PAGE_SIZE = 500
+
+RESPONSE_CACHE_SIZE = 256
+""" the number of rendered responses kept """
+
+RANGE_PARAMETERS = {
+    "min_price": ("price_per_month", "min"),
+    "max_price": ("price_per_month", "max"),
+    "min_bedrooms": ("bedrooms", "min"),
+    "max_bedrooms": ("bedrooms", "max"),
+    "available_from": ("available_from", "min"),
+}
+""" the query parameters named after the ranges of `Settings`, mapped to the field and bound they restrict """
+
+
+class ApiError(Exception):
+    """ a request which cannot be answered, turned into an error response with the status """
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class Response():
+    def __init__(self, status: int, body: bytes, etag: Optional[str] = None) -> None:
+        self.status = status
+        self.body = body
+        self.etag = etag
+
+
+def single(query: Dict[str, List[str]], name: str) -> Optional[str]:
+    values = query.get(name)
+    return values[-1] if values else None
+
+
+def integer(query: Dict[str, List[str]], name: str, default: int, minimum: int = 0, maximum: Optional[int] = None) -> int:
+    value = single(query, name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ApiError(400, f"{name} is not an integer: {value}")
+    if number < minimum or (maximum is not None and number > maximum):
+        raise ApiError(400, f"{name} must be between {minimum} and {maximum}")
+    return number
+
+
+def query_rules(query: Dict[str, List[str]]) -> List[FilterRule]:
+    """ the filter rules of a query using the filter vocabulary of the settings:
+        `min_price`, `max_price`, `min_bedrooms`, `max_bedrooms`, `available_from` (a timestamp, exclusive),
+        `property_type_allowlist` (repeated or comma separated) and `filters`, a json list of filter rules
+    """
+    bounds: Dict[str, Dict[str, Any]] = {}
+    for name, (field, bound) in RANGE_PARAMETERS.items():
+        value = single(query, name)
+        if value is None:
+            continue
+        try:
+            bounds.setdefault(field, {"min_exclusive": field == "available_from"})[
+                bound] = float(value)
+        except ValueError:
+            raise ApiError(400, f"{name} is not a number: {value}")
+    rules = [FilterRule(field, **kwargs) for field, kwargs in bounds.items()]
+
+    allowed = [x for values in query.get("property_type_allowlist", [])
+               for x in values.split(",") if x]
+    if allowed:
+        try:
+            allowed = [PropertyType(x).value for x in allowed]
+        except ValueError as E:
+            raise ApiError(400, str(E))
+        rules.append(FilterRule("property_type", allow=allowed))
+
+    for value in query.get("filters", []):
+        try:
+            rules.extend(FilterRule.schema().loads(value, many=True))
+        except Exception as E:
+            raise ApiError(400, f"filters is not a json list of filter rules: {E}")
+
+    problems = [x for rule in rules for x in rule_problems(rule)]
+    if problems:
+        raise ApiError(400, "; ".join(problems))
+    return rules
+
+
+class Snapshot():
+    """ the latest dump of a search, its listings and the digest of its contents """
+
+    def __init__(self, filename: str, data: bytes) -> None:
+        self.filename = filename
+        self.digest = hashlib.sha1(data).hexdigest()
+        dump = loads_dump(data.decode(), is_ndjson(filename))
+        self.values: List[Dict[str, Any]] = dump["properties"]
+        self.properties: List[Property] = Property.schema().load(
+            self.values, many=True)
+        self.positions = {id(x): i for i, x in enumerate(self.properties)}
+        self.ids: Dict[str, int] = dump["ids"]
+
+
+class ResponseCache():
+    """ least recently used rendered responses """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE) -> None:
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[str, ...], Response]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple[str, ...]) -> Optional[Response]:
+        with self.lock:
+            response = self.entries.get(key)
+            if response is None:
+                API_CACHE.inc(result="miss")
+                return None
+            API_CACHE.inc(result="hit")
+            self.entries.move_to_end(key)
+            return response
+
+    def put(self, key: Tuple[str, ...], response: Response):
+        with self.lock:
+            self.entries[key] = response
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ListingsApi():
+    """ answers the requests of the api from the dumps in `dump_dir`.
+
+        every response carries an etag derived from the digest of the latest dump (and the change log for `/changes`),
+        a request whose `If-None-Match` matches it gets an empty 304. rendered responses are kept in an LRU cache which is
+        cleared when this process writes a dump, a dump written by another process is noticed by the mtime of the directory.
+    """
+
+    def __init__(self, dump_dir: str, cache_size: int = RESPONSE_CACHE_SIZE) -> None:
+        self.dump_dir = dump_dir
+        self.cache = ResponseCache(cache_size)
+        self.lock = threading.Lock()
+        self._snapshot: Optional[Snapshot] = None
+        self._snapshot_key: Optional[int] = None
+        add_dump_listener(self._dump_written)
+
+    def _dump_written(self, path: str):
+        if os.path.abspath(os.path.dirname(path)) == os.path.abspath(self.dump_dir):
+            with self.lock:
+                self._snapshot_key = None
+            self.cache.clear()
+
+    def snapshot(self) -> Snapshot:
+        """ the latest dump, only read again once the directory changed """
+        with self.lock:
+            try:
+                key = os.stat(self.dump_dir).st_mtime_ns
+            except FileNotFoundError:
+                raise ApiError(404, "no dumps yet")
+            if self._snapshot is None or key != self._snapshot_key:
+                dumps = list_dumps(self.dump_dir)
+                if not dumps:
+                    raise ApiError(404, "no dumps yet")
+                if self._snapshot is None or self._snapshot.filename != dumps[-1]:
+                    with open(os.path.join(self.dump_dir, dumps[-1]), "rb") as f:
+                        data = f.read()
+                    try:
+                        self._snapshot = Snapshot(dumps[-1], data)
+                    except ValueError:
+                        # still being written, serve the previous dump and read it again on the next request
+                        if self._snapshot is None:
+                            raise ApiError(503, "the first dump is being written")
+                        return self._snapshot
+                self._snapshot_key = key
+            return self._snapshot
+
+    def _events_version(self) -> str:
+        log = ChangeEventLog(os.path.join(self.dump_dir, EVENTS_DIRNAME))
+        segments = log.segments()
+        if not segments:
+            return ""
+        return f"{segments[-1]}:{os.path.getsize(os.path.join(log.directory, segments[-1]))}"
+
+    def get(self, url: str, if_none_match: Optional[str] = None) -> Response:
+        """ the response to a GET request of the url """
+        try:
+            parsed = urlparse(url)
+            path = [unquote(x) for x in parsed.path.strip("/").split("/") if x]
+            query = parse_qs(parsed.query)
+
+            version = self.snapshot().digest
+            if path == ["changes"]:
+                version += self._events_version()
+            canonical = json.dumps(sorted(query.items()))
+            etag = '"' + hashlib.sha1(
+                f"{version}/{'/'.join(path)}?{canonical}".encode()).hexdigest()[:24] + '"'
+            if if_none_match and (if_none_match.strip() == "*" or etag in [x.strip() for x in if_none_match.split(",")]):
+                return Response(304, b"", etag)
+
+            key = (etag,)
+            response = self.cache.get(key)
+            if response is None:
+                response = Response(
+                    200, json.dumps(self.render(path, query)).encode(), etag)
+                self.cache.put(key, response)
+            return response
+        except ApiError as E:
+            return Response(E.status, json.dumps({"error": str(E)}).encode())
+
+    def render(self, path: List[str], query: Dict[str, List[str]]) -> Dict[str, Any]:
+        if path == ["listings"]:
+            return self.listings(query)
+        if len(path) == 2 and path[0] == "listings":
+            return self.listing(path[1])
+        if path == ["changes"]:
+            return self.changes(query)
+        raise ApiError(404, f"unknown path: /{'/'.join(path)}")
+
+    def listings(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+        """ a page of the listings of the latest dump passing the filters of the query """
+        snapshot = self.snapshot()
+        offset = integer(query, "offset", 0)
+        limit = integer(query, "limit", DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+        properties = filter_properties(
+            snapshot.properties, query_rules(query))
+        page = properties[offset:offset + limit]
+        return {
+            "snapshot": snapshot.filename,
+            "total": len(properties),
+            "offset": offset,
+            "limit": limit,
+            "next_offset": offset + limit if offset + limit < len(properties) else None,
+            # the values as dumped, rather than dumping the parsed properties again
+            "listings": [snapshot.values[snapshot.positions[id(x)]] for x in page],
+        }
+
+    def listing(self, listing_id: str) -> Dict[str, Any]:
+        """ the listing in the latest dump, none if it's gone, and every price it was dumped at """
+        snapshot = self.snapshot()
+        position = snapshot.ids.get(listing_id)
+        timestamps, prices = PriceHistory(os.path.join(
+            self.dump_dir, PRICE_HISTORY_DIRNAME)).listing_prices(listing_id)
+        if position is None and len(timestamps) == 0:
+            raise ApiError(404, f"unknown listing: {listing_id}")
+        return {
+            "snapshot": snapshot.filename,
+            "listing": snapshot.values[position] if position is not None else None,
+            "prices": [{"timestamp": float(t), "price": None if p != p else float(p)}
+                       for t, p in zip(timestamps, prices)],
+        }
+
+    def changes(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+        """ the change events from the `from` offset, or the latest ones if it's not given """
+        limit = integer(query, "limit", DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+        log = ChangeEventLog(os.path.join(self.dump_dir, EVENTS_DIRNAME))
+        if single(query, "from") is None:
+            events = list(deque(log.read(), maxlen=limit))
+        else:
+            events = []
+            for event in log.read(integer(query, "from", 0)):
+                if len(events) == limit:
+                    break
+                events.append(event)
+        return {
+            "events": [x.to_dict() for x in events],
+            "next_offset": events[-1].offset + 1 if events else integer(query, "from", 0),
+        }
+
+
+class ApiRouter():
+    """ the apis of several searches behind one server, each under the path of its name i.e. `/<search>/<subscriber>/listings`.
+        `GET /` lists the names
+    """
+
+    def __init__(self, apis: Dict[str, ListingsApi]) -> None:
+        self.apis = {tuple(x for x in name.split("/") if x): api
+                     for name, api in apis.items()}
+
+    def get(self, url: str, if_none_match: Optional[str] = None) -> Response:
+        parsed = urlparse(url)
+        path = [unquote(x) for x in parsed.path.strip("/").split("/") if x]
+        if not path:
+            return Response(200, json.dumps({"searches": ["/".join(x) for x in self.apis]}).encode())
+
+        # the longest name first so a search isn't shadowed by another search named after its first segment
+        for name, api in sorted(self.apis.items(), key=lambda x: -len(x[0])):
+            if len(path) > len(name) and tuple(path[:len(name)]) == name:
+                rest = "/" + "/".join(quote(x, safe="") for x in path[len(name):])
+                return api.get(parsed._replace(path=rest).geturl(), if_none_match)
+        return Response(404, json.dumps({"error": f"unknown search: /{'/'.join(path)}"}).encode())
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    api: ListingsApi = None
+
+    def do_GET(self):
+        response = self.api.get(self.path, self.headers.get("If-None-Match"))
+        self.send_response(response.status)
+        if response.etag:
+            self.send_header("ETag", response.etag)
+        if response.status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response.body)))
+        self.end_headers()
+        if response.status != 304:
+            self.wfile.write(response.body)
+
+    def log_message(self, format: str, *args):
+        logging.debug("api: " + format, *args)
+
+
+def make_api_server(dump_dirs: Dict[str, str], host: str, port: int) -> ThreadingHTTPServer:
+    """ the api over the dumps of the directories mapped to their names listening at `http://<host>:<port>`, serving from a thread
+        per request. a single directory named `""` is served at the root, otherwise every directory is served under its name
+    """
+    if list(dump_dirs) == [""]:
+        api = ListingsApi(dump_dirs[""])
+    else:
+        api = ApiRouter({name: ListingsApi(x)
+                        for name, x in dump_dirs.items()})
+    handler = type("Handler", (ApiHandler,), {"api": api})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def start_api_server(dump_dirs: Dict[str, str], host: str, port: int) -> ThreadingHTTPServer:
+    """ serves the api from a daemon thread """
+    server = make_api_server(dump_dirs, host, port)
+    threading.Thread(target=server.serve_forever,
+                     name="api-server", daemon=True).start()
+    logging.info(
+        f"Serving the listings of {list(dump_dirs.values())} at http://{host}:{server.server_address[1]}")
+    return server
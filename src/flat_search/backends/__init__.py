@@ -2,21 +2,22 @@ import logging
 import os
 import json
 import random
-from typing import Dict, List, Tuple, Union
-from fake_useragent import UserAgent
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
 
-from flat_search.data import Property
+from flat_search.data import Property, ScrapeReport
+from flat_search.data.checkpoint import ScrapeCheckpoint
+from flat_search.backends.rate_limit import NavigationTokenBucket
 from time import time
 from dotenv import load_dotenv
-from selenium.webdriver import FirefoxOptions
-from seleniumwire import webdriver
-from seleniumwire.request import Request as SWRequest
-from selenium.webdriver.remote.webdriver import WebDriver
 from flat_search.email import send_error_email
 from flat_search.settings import Settings
-import requests
+from flat_search.util import run_blocking
 from urllib.parse import ParseResult, urlparse
-import seleniumwire.undetected_chromedriver as uc
+
+# the browser stack takes seconds to import, it's only imported once a browser or proxy is actually used
+if TYPE_CHECKING:
+    from seleniumwire.request import Request as SWRequest
+    from selenium.webdriver.remote.webdriver import WebDriver
 
 from copy import deepcopy
 # load dotenv if possible
@@ -58,6 +59,8 @@ class Proxy():
         self.total_failures = total_failures
 
     def check_proxy(self) -> bool:
+        import requests
+        from fake_useragent import UserAgent
         try:
             url = f'https://www.toolsvoid.com/proxy-test/'
 
@@ -104,8 +107,12 @@ class PropertyDataProvider():
 
         self.request_limiter_minutes = RequestStopwatchLimit(60, 60)
         self.request_limiter_seconds = RequestStopwatchLimit(1, 1)
+        self.navigation_limiter = NavigationTokenBucket(
+            settings.navigation_rate_per_minute, settings.navigation_burst)
         self.proxies: List[Proxy] = []
         self.vdisplay = None
+        self.checkpoint: ScrapeCheckpoint = None
+        self.report: ScrapeReport = None
         if not settings.no_proxy:
             try:
                 with open('proxies.json') as f:
@@ -129,7 +136,8 @@ class PropertyDataProvider():
                 dict['url'] = dict['url'].geturl()
             json.dump(output, f, indent=4)
 
-    def make_fake_user(self) -> Tuple[WebDriver, Proxy]:
+    def make_fake_user(self) -> Tuple["WebDriver", Proxy]:
+        import seleniumwire.undetected_chromedriver as uc
 
         # setup driver
         opts = uc.ChromeOptions()
@@ -187,20 +195,32 @@ class PropertyDataProvider():
                 'proxy': proxy.get_proxies_dict() if proxy else {}
             }, **additional_kwargs)
 
-        def interceptor(request: SWRequest):
+        def interceptor(request: "SWRequest"):
             if request.headers.get('user-agent', None):
                 request.headers.replace_header('user-agent', user_agent)
+            # every page load goes through here whether it came from driver.get, a click or pagination
+            if request.headers.get('sec-fetch-mode') == 'navigate' or 'text/html' in request.headers.get('accept', ''):
+                self.navigation_limiter.acquire(request.host)
 
         driver.request_interceptor = interceptor
 
         driver.implicitly_wait(10)
         return (driver, proxy)
 
-    async def _retrieve_all(self, driver: WebDriver, proxy: Union[Proxy, None]) -> List[Property]:
+    async def _retrieve_all(self, driver: "WebDriver", proxy: Union[Proxy, None]) -> List[Property]:
         raise NotImplementedError("Implement _retrieve_all!")
 
-    async def retrieve_all_properties(self) -> List[Property]:
+    def page_parsed(self, index: int, properties: List[Property]):
+        """ records a parsed listing page in the report and the checkpoint """
+        self.report.pages_walked += 1
+        self.report.listings_parsed += len(properties)
+        self.checkpoint.save_page(index, properties)
+
+    async def retrieve_all_properties(self, final_attempt: bool = True) -> List[Property]:
         """ retrieve all properties with the current criteria/filters set while respecting request limits, may throw error if requested too many times.
+
+            final_attempt -- whether a failure is final, only then is the proxy marked as failed and the error emailed.
+                a failure which will be retried keeps its checkpoint so the retry resumes it
             :raises:
                 ResourceWarning: if used too quickly
         """
@@ -213,27 +233,46 @@ class PropertyDataProvider():
             raise ResourceWarning(
                 f"Too many request per minute, a maximum of {self.request_limiter_seconds.maximum_uses_per_period} requests per minute is allowed.")
 
-        driver, proxy = self.make_fake_user()
+        self.report = ScrapeReport()
+
+        # pages parsed by a recently failed attempt of the same search are kept and not scraped again
+        self.checkpoint = ScrapeCheckpoint(
+            f"{self.__class__.__name__}:{self.settings.search_key()}", self.settings.checkpoint_resume_window_minutes * 60)
+
+        # browser start up blocks for a while, keep the event loop free for other sessions
+        driver, proxy = await run_blocking(self.report.timed("browser_start", self.make_fake_user))
 
         try:
             properties = await self._retrieve_all(driver, proxy)
             logging.info(f"found {len(properties)} properties.")
-            driver.quit()
-
-            if self.vdisplay:
-                self.vdisplay.stop()
-
+            logging.info(f"scrape report: {self.report.summary()}")
+            self.checkpoint.clear()
             return properties
         except Exception as E:
-            proxy.add_failure()
-            self.update_proxy_file()
-            driver.save_screenshot('logs/last_screenshot.png')
+            try:
+                driver.save_screenshot('logs/last_screenshot.png')
+            except Exception:
+                logging.exception("Exception in saving a screenshot")
+
+            if not final_attempt:
+                logging.exception(
+                    f"Exception in backend: {self.__class__.__name__}, to be retried")
+                raise E
+
+            if proxy:
+                proxy.add_failure()
+                self.update_proxy_file()
             send_error_email(self.settings, proxy, E)
 
             logging.exception(
                 f"Exception in backend: {self.__class__.__name__}, marking proxy as failure")
-
+            raise E
+        finally:
+            # a retry starts its own browser, the failed one must not be left running
+            try:
+                await run_blocking(driver.quit)
+            except Exception:
+                logging.exception("Exception in quitting the browser")
             if self.vdisplay:
                 self.vdisplay.stop()
-
-            raise E
+                self.vdisplay = None
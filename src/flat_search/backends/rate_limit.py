@@ -0,0 +1,65 @@
+import fcntl
+import json
+import logging
+import os
+from time import sleep, time
+
+
+class NavigationTokenBucket():
+    """ per-host token bucket limiting page navigations, shared by every process using the same state file.
+
+        the bucket levels are kept in a json file guarded by an exclusive file lock, so several worker processes or
+        scheduled searches draw on one politeness budget per host.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, state_path: str = "rate_limits.json") -> None:
+        """
+            rate_per_minute -- the number of navigations per minute a host's bucket is refilled with
+            burst -- the capacity of each bucket i.e. the number of navigations allowed in quick succession
+            state_path -- the file shared between processes holding the level of each host's bucket
+        """
+        assert (rate_per_minute > 0 and burst >= 1)
+        self.rate_per_second = rate_per_minute / 60
+        self.burst = burst
+        self.state_path = state_path
+
+    def _try_consume(self, host: str) -> float:
+        """ takes a token from the host's bucket if there is one, returns 0 if a token was taken otherwise the seconds until one is available """
+        with open(self.state_path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                data = f.read()
+                state = json.loads(data) if data else {}
+
+                now = time()
+                bucket = state.get(host, {"tokens": self.burst, "updated": now})
+                tokens = min(self.burst, bucket["tokens"] +
+                             (now - bucket["updated"]) * self.rate_per_second)
+
+                wait = 0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / self.rate_per_second
+
+                state[host] = {"tokens": tokens, "updated": now}
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+                return wait
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self, host: str) -> float:
+        """ blocks until a navigation to the host is allowed, returns the seconds waited """
+        waited = 0
+        while True:
+            wait = self._try_consume(host)
+            if wait == 0:
+                return waited
+            logging.info(
+                f"Navigation budget for {host} used up, waiting {wait:.2f}s")
+            sleep(wait)
+            waited += wait
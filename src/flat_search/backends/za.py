@@ -1,13 +1,17 @@
 from asyncio import sleep
 from datetime import datetime
-from typing import Any, Callable, Union, List
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Union, List
 from flat_search.backends import PropertyDataProvider, Proxy
 from flat_search.data import Property, PropertyType
+from flat_search.data.postcode import parse_postcode_district
+from flat_search.exporter import PARSE_SECONDS
+from flat_search.log import Summary
 import logging
-from bs4 import BeautifulSoup, Tag
-from dateparser.search import search_dates
-from urllib.parse import urlparse
-from flat_search.scraping.strategy import PagedPropertyListingStrategy
+import math
+import re
+from urllib.parse import parse_qsl, urlencode, urlparse
+from flat_search.scraping.async_strategy import AsyncPagedPropertyListingStrategy
+from flat_search.scraping.extraction import ExtractionSpec, FieldSpec, find, find_all, next_sibling, to_int
 
 from flat_search.settings import Settings
 import time
@@ -16,6 +20,57 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webdriver import WebDriver
 
 
+if TYPE_CHECKING:
+    from bs4 import Tag
+
+RESULT_COUNT_PATTERN = re.compile(r"^\s*([\d,]+)\s+results?\b")
+
+
+def search_first_date(text: str) -> Optional[datetime]:
+    """ returns the first date mentioned in the text or None """
+    # dateparser takes a second to import, only pay for it once a page is parsed
+    from dateparser.search import search_dates
+    (_, date), *_ = search_dates(text, languages=[
+        'es'], settings={'DATE_ORDER':  'DMY'}) or [(None, None)]
+    return date
+
+
+def image_sources(images: List["Tag"]) -> Optional[List[str]]:
+    """ the sources of the listing images without agent logos, None if any image is missing its source """
+    sources = [x.attrs.get("src") for x in images]
+    if None in sources:
+        return None
+    return [x for x in sources if "static_agent_logo" not in x]
+
+
+def listing_title_text(title: "Tag") -> str:
+    return " ".join(title.text.split()).strip()
+
+
+LISTING_TITLE = find(attrs={"data-testid": "listing-title"})
+
+ZA_EXTRACTION_SPEC = ExtractionSpec({
+    "id": FieldSpec([], transform=lambda div: div.attrs.get("id").split("_")[1], required=True),
+    "price_per_month": FieldSpec([find(attrs={"data-testid": "listing-price"})],
+                                 transform=lambda price: to_int(price.text.strip().removesuffix(" pcm").replace(',', '')[1:]), required=True),
+    "relative_listing_url": FieldSpec([find('a', attrs={"href": lambda x: x is not None and x.startswith("/to-rent/details")})],
+                                      transform=lambda a: a.attrs.get('href'), required=True),
+    "bedrooms": FieldSpec([find("span", string=lambda x: x is not None and "Bedrooms" in x), next_sibling("span")],
+                          transform=lambda span: to_int(span.text), default=1),
+    "image_urls": FieldSpec([find_all("img")], transform=image_sources),
+    "address": FieldSpec([LISTING_TITLE],
+                         transform=lambda title: " ".join([" ".join(x.text.split()).strip() for x in title.next_siblings if str(x)])),
+    "available_from": FieldSpec([find(string=lambda x: x is not None and x.strip().startswith("Available"))],
+                                transform=lambda text: search_first_date(text.text)),
+    "date_listed": FieldSpec([find(string=lambda x: x is not None and x.strip().startswith("Listed"))],
+                             transform=lambda text: search_first_date(text.text)),
+    "description": FieldSpec([LISTING_TITLE], transform=listing_title_text),
+    "property_type": FieldSpec([LISTING_TITLE],
+                               transform=lambda title: Za.read_property_type_from_title(listing_title_text(title))),
+})
+""" how each field of a listing is read from a listing element, the listing url is relative to the base url """
+
+
 class Za(PropertyDataProvider):
     """ requires ZA_URL_FORMAT env variable to be present.
         requires the following format keys to be in the url:
@@ -36,22 +91,7 @@ class Za(PropertyDataProvider):
                     or self.url.netloc.startswith('127'))
 
         self.base_url = "{uri.scheme}://{uri.netloc}".format(uri=self.url)
-
-    def result_or_none_if_throws(logged_error_msg: str, callable: Callable[[], Union[Any, None]]):
-        """ calls the given function and on an exception, logs it then returns None otherwise returns the result """
-        try:
-            return callable()
-        except Exception as E:
-            logging.error(logged_error_msg)
-            logging.exception(E)
-            return None
-
-    def result_or_default_if_throws(default: Union[Any, None], callable: Callable[[], Union[Any, None]]):
-        """ calls the given function and on an exception, logs it then returns None otherwise returns the result """
-        try:
-            return callable()
-        except Exception as E:
-            return default
+        self.extractor = ZA_EXTRACTION_SPEC.compile()
 
     def format_property_types(property_types: List[PropertyType]) -> List[str]:
         """ maps property types to required format strings """
@@ -100,91 +140,100 @@ class Za(PropertyDataProvider):
             "walk_next_page_btn_locator": (By.XPATH, "//*[contains(.,'Next')]"),
             "walk_query_pages_max": self.settings.scrape_max_pages,
             # parsing settings
-            "parse_function": self.parse_page
+            "parse_function": PARSE_SECONDS.time(self.report.timed("parse", self.parse_page)),
+            # resume settings
+            "walk_start_page": self.checkpoint.first_unfinished_page(),
+            "walk_page_url": self.format_page_url,
+            "on_page_parsed": self.page_parsed,
+            # pagination settings
+            "walk_count_pages": self.count_pages
         }
-        strategy = PagedPropertyListingStrategy(**settings)
+        self.report.pushed_down_filters = self.plan_query()
+        strategy = AsyncPagedPropertyListingStrategy(**settings)
         logging.info(f"Executing za scraping strategy")
-        if strategy.execute_strategy(driver):
-            data = strategy.get_data()
-            return data
+        start = time.perf_counter()
+        success = await strategy.execute_strategy(driver)
+        # query entry, decoys and page walks including their deliberate delays, parsing is also counted separately
+        self.report.add_phase("scrape", time.perf_counter() - start)
+        self.report.pages_planned = strategy.pages_planned()
+        self.report.field_misses = dict(self.extractor.misses)
+        if success:
+            # includes the pages parsed by a previous failed attempt
+            return self.checkpoint.properties()
         else:
             raise Exception("Error in strategy")
 
+    def plan_query(self) -> Dict[str, List[str]]:
+        """ maps the settings filters onto the search url parameters so the search itself leaves out the listings we would filter out anyway.
+
+            availability cannot be expressed in the search so it's only filtered after parsing, along with everything else as a safety net.
+        """
+        plan = {
+            "price_min": [str(self.settings.min_price)],
+            "price_max": [str(self.settings.max_price)],
+            "beds_min": [str(self.settings.min_bedrooms)],
+            "beds_max": [str(self.settings.max_bedrooms)],
+        }
+        # rooms have no equivalent sub type, restricting sub types would hide them
+        if PropertyType.ROOM not in self.settings.property_type_allowlist:
+            plan["property_sub_type"] = list(dict.fromkeys(
+                Za.format_property_types(self.settings.property_type_allowlist)))
+        return plan
+
+    def format_page_url(self, query_url: str, page: int) -> str:
+        """ returns the url of the 0 indexed listing page with the planned filters given the url the query led to """
+        plan = self.plan_query()
+        url = urlparse(query_url)
+        query = [(k, v) for k, v in parse_qsl(url.query)
+                 if k != "pn" and k not in plan]
+        query.extend((k, v) for k, values in plan.items() for v in values)
+        query.append(("pn", str(page + 1)))
+        return url._replace(query=urlencode(query)).geturl()
+
+    def count_pages(self, page: str) -> Optional[int]:
+        """ reads the total result count from the first listing page walked and divides it by the number of listings on the first page
+            of the search, returns None if either is missing.
+
+            a resumed walk starts on a later page, which can be the short last one, so the page size is then taken from the
+            first page in the checkpoint rather than from the page walked
+        """
+        from bs4 import BeautifulSoup
+        page = BeautifulSoup(page, 'html.parser')
+
+        results_text = page.find(string=lambda x: x is not None and RESULT_COUNT_PATTERN.search(x))
+        first_page = self.checkpoint.pages.get(0)
+        if first_page:
+            page_size = len(first_page)
+        else:
+            page_size = len(page.find_all(
+                id=lambda x: x is not None and x.startswith("listing_")))
+        if results_text is None or page_size == 0:
+            logging.info("Could not read result count or page size")
+            return None
+
+        total = int(RESULT_COUNT_PATTERN.search(
+            results_text).group(1).replace(',', ''))
+        logging.info(f"{total} results with {page_size} per page")
+        return math.ceil(total / page_size)
+
     def parse_page(self, page: str) -> List[Property]:
         """ parses a single page of html content from the provider and returns the properties as well as the last available page """
         # update referer to point to previous page if we are not on the first one
+        from bs4 import BeautifulSoup
 
         page = BeautifulSoup(page, 'html.parser')
 
         properties: List[Property] = []
 
-        listing_div: Union[Tag, None]
+        listing_div: Union["Tag", None]
         for listing_div in page.find_all(id=lambda x: x is not None and x.startswith("listing_")):
-            _id = listing_div.attrs.get("id").split("_")[1]
-
-            price_per_month = int(listing_div.find(attrs={
-                "data-testid": "listing-price"})
-                .text
-                .strip()
-                .removesuffix(" pcm")
-                .replace(',', '')
-                [1:])
-
-            relative_listing_url = listing_div.find('a', attrs={
-                "href": lambda x: x is not None and x.startswith("/to-rent/details")
-            }).attrs.get('href')
-
-            listing_url = f"{self.base_url}{relative_listing_url}"
-
-            date_found = datetime.now()
-
-            bedrooms = Za.result_or_default_if_throws(1,
-                                                      lambda: int(listing_div.find(
-                                                          "span", string=lambda x: x is not None and "Bedrooms" in x).findNextSibling("span").text))
-
-            image_urls: List[Tag] = Za.result_or_none_if_throws("Failed to get image URLS",
-                                                                lambda:
-                                                                [x.attrs.get("src") for x in listing_div.find_all("img")
-                                                                 if "static_agent_logo" not in x.attrs.get("src")])
-
-            address = Za.result_or_none_if_throws("Failed to get address",
-                                                  lambda: " ".join([" ".join(x.text.split()).strip() for x in listing_div.find(
-                                                      attrs={"data-testid": "listing-title"}).next_siblings if str(x)])
-                                                  )
-
-            available_from_text = Za.result_or_default_if_throws(None,
-                                                                 lambda: listing_div.find(string=lambda x: x is not None and x.strip(
-                                                                 ).startswith("Available")).text)
-            if available_from_text is None:
-                available_from = None
-            else:
-                (_, available_from), *_ = search_dates(available_from_text, languages=[
-                    'es'], settings={'DATE_ORDER':  'DMY'}) or [(None, None)]
-
-            date_listed_text = Za.result_or_none_if_throws("Failed to get date listed",
-                                                           lambda: listing_div.find(string=lambda x: x is not None and x.strip(
-                                                           ).startswith("Listed")).text)
-            if date_listed_text is None:
-                date_listed = None
-            else:
-                (_, date_listed), *_ = search_dates(date_listed_text, languages=[
-                    'es'], settings={'DATE_ORDER':  'DMY'}) or [(None, None)]
-
-            listing_title = Za.result_or_none_if_throws("Failed to get listing description",
-                                                        lambda: " ".join(listing_div.find(
-                                                            attrs={"data-testid": "listing-title"}).text.split()).strip())
-
-            description = listing_title
-
-            property_type = Za.result_or_none_if_throws(
-                "Failed to get property type",
-                lambda: Za.read_property_type_from_title(listing_title))
+            fields = self.extractor.extract(listing_div)
+            relative_listing_url = fields.pop("relative_listing_url")
+            fields["postcode_district"] = parse_postcode_district(
+                fields["address"])
+
             properties.append(
-                Property(_id, listing_url, date_found, property_type=property_type,
-                         price_per_month=price_per_month, bedrooms=bedrooms, image_urls=image_urls, address=address,
-                         available_from=available_from, date_listed=date_listed,
-                         description=description)
-            )
-        logging.info(
-            f"properties found on current page: {[x.short_summary() for x in properties]}")
+                Property(listing_url=f"{self.base_url}{relative_listing_url}", date_found=datetime.now(), **fields))
+        logging.info("properties found on current page: %s",
+                     Summary(properties, Property.short_summary))
         return properties
@@ -4,9 +4,9 @@ Module containing the plain data objects
 
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional
 from datetime import datetime
-from time import time
+from time import perf_counter, time
 
 from dataclasses_json import dataclass_json
 
@@ -65,6 +65,12 @@ class Property():
     description: str = ""
     """ the description provided for the property """
 
+    postcode_district: Optional[str] = None
+    """ the outward code of the postcode in the address i.e. `SW10`, parsed once when the property is scraped """
+
+    duplicate_of: Optional[str] = None
+    """ the id of another listing of the same scrape this one looks like a near-duplicate of """
+
     def make_random_property():
         """ generates a property instance with randon data """
         from lorem import word, paragraph, sentence
@@ -97,5 +103,45 @@ class Property():
         return f"{self.property_type.name} : {self.address} : {self.listing_url}"
 
 
+@dataclass_json
+@dataclass
+class ScrapeReport():
+    """ Contains statistics about a single scrape run """
+
+    pushed_down_filters: Dict[str, List[str]] = field(default_factory=dict)
+    """ the filters applied by the provider's search itself rather than after parsing """
+
+    pages_planned: Optional[int] = None
+    """ the number of listing pages the provider planned to parse from the result count, None if it could not be read """
+
+    pages_walked: int = 0
+    """ the number of listing pages parsed """
+
+    listings_parsed: int = 0
+    """ the number of listings parsed from those pages """
+
+    field_misses: Dict[str, int] = field(default_factory=dict)
+    """ the number of parsed listings each field was missing from """
+
+    phase_seconds: Dict[str, float] = field(default_factory=dict)
+    """ the seconds spent in each phase of the scrape, i.e. `browser_start`, `scrape` and `parse` """
+
+    def add_phase(self, phase: str, seconds: float):
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + seconds
+
+    def timed(self, phase: str, function: Callable[..., Any]) -> Callable[..., Any]:
+        """ wraps the function so the time spent in every call is added to the phase """
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_phase(phase, perf_counter() - start)
+        return wrapper
+
+    def summary(self) -> str:
+        return f"pushed down filters: {self.pushed_down_filters}, pages planned: {self.pages_planned}, pages walked: {self.pages_walked}, listings parsed: {self.listings_parsed}, field misses: {self.field_misses}, phase seconds: {self.phase_seconds}"
+
+
 if __name__ == "__main__":
     print(Property.make_random_property())
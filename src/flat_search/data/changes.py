@@ -1,15 +1,22 @@
 from collections import defaultdict
 import json
 import logging
-from typing import Any, Dict, List, Set, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 import os
 
 from flat_search.data import Property
+from flat_search.data.compact import CompactProperty, load_compact_properties
+from flat_search.data.dump import list_dumps
+from flat_search.data.snapshot import is_ndjson, load_dump, read_snapshot
 from dataclasses import fields
 
 from flat_search.settings import Settings
 
 
+EXCLUDED_ATTRIBUTES = set(["date_found", "listing_url", "postcode_district", "duplicate_of"])
+""" fields whose changes are not reported, they change without the listing itself changing """
+
+
 class FieldChange():
     def __init__(self, field_name: str, old: Any, new: Any) -> None:
         self.field_name = field_name
@@ -18,16 +25,38 @@ class FieldChange():
 
 
 class PropertyChanges():
-    def __init__(self, appended: List[str], removed: List[str], modified: Dict[str, List[FieldChange]]) -> None:
+    def __init__(self, appended: List[str], removed: List[str], modified: Dict[str, List[FieldChange]], relisted: Dict[str, List[str]] = None, returning: Dict[str, float] = None) -> None:
         self.appended = appended
         self.removed = removed
         self.modified = modified
+        # new listings duplicating earlier listings, mapped to the ids of those. These are not in `appended`
+        self.relisted = relisted or {}
+        # listings seen in an earlier snapshot than the last mapped to when they were first seen. These are not in `appended` either
+        self.returning = returning or {}
+
+    def empty(self) -> bool:
+        return not (self.appended or self.removed or self.modified or self.relisted or self.returning)
 
     class Encoder(json.JSONEncoder):
         def default(self, o):
             return o.__dict__
 
 
+def field_changes(old_property: Dict[str, Any], new_property: Dict[str, Any], excluded_attributes: Set[str] = None) -> List[FieldChange]:
+    """ the compared fields whose dumped values differ between the two dumped values of a listing """
+    changes = []
+    for field in fields(Property):
+        if field.name in (excluded_attributes or ()):
+            continue
+
+        # dumps written before a field was added don't have it
+        old_value = old_property.get(field.name)
+        new_value = new_property.get(field.name)
+        if field.compare and old_value != new_value:
+            changes.append(FieldChange(field.name, old_value, new_value))
+    return changes
+
+
 def generate_changes(old: Any, new: Any, excluded_attributes: Set[str] = None) -> PropertyChanges:
 
     old_ids: Set[str] = {id for id in old["ids"].keys()}
@@ -42,49 +71,108 @@ def generate_changes(old: Any, new: Any, excluded_attributes: Set[str] = None) -
         old_index = old["ids"][id]
         new_index = new["ids"][id]
 
-        old_property = old["properties"][old_index]
-        new_property = new["properties"][new_index]
-
-        for field in fields(Property):
-            if field.name in excluded_attributes:
-                continue
-
-            old_value = old_property[field.name]
-            new_value = new_property[field.name]
-            if field.compare and old_value != new_value:
-                updated_ids[id].append(FieldChange(
-                    field.name, old_value, new_value))
+        changes = field_changes(
+            old["properties"][old_index], new["properties"][new_index], excluded_attributes)
+        if changes:
+            updated_ids[id] = changes
 
     return PropertyChanges(list(appended_ids), list(removed_ids), updated_ids)
 
 
-def dump_changes_between(settings: Settings, dump_old_path: str, dump_new_path: str) -> Tuple[PropertyChanges, List[Property], List[Property]]:
-    """ finds deltas between two json dumps of properties. Returns changes and new property values"""
-
-    with open(dump_old_path, 'r') as o:
-        with open(dump_new_path, 'r') as n:
-            old_dump = json.load(o)
-            new_dump = json.load(n)
-            diff = generate_changes(
-                old_dump, new_dump, excluded_attributes=set(["date_found", "listing_url"]))
-
-            if not settings.send_removed_properties:
-                diff.removed = []
-
-            if diff.appended or diff.removed or diff.modified:
-                with open(dump_new_path.removesuffix(".json") + "_diff.json", 'w') as d:
-                    json.dump(diff, d, indent=4,
-                              cls=PropertyChanges.Encoder)
-                    return (diff, Property.schema().load(old_dump["properties"], many=True), Property.schema().load(new_dump["properties"], many=True))
-            else:
-                return None
-
-
-async def dump_latest_changes(settings: Settings) -> Union[Tuple[PropertyChanges, List[Property], List[Property]], None]:
-    """ finds newest and second newest dumps then compares them and dumps the change log then returns the changes if there are any and the two property lists """
-    dump_dir = "data"
-    files = sorted([x for x in os.listdir(dump_dir)
-                   if not "diff" in x and x.endswith(".json")])
+def merge_changes(old: Iterable[Dict[str, Any]], new: Iterable[Dict[str, Any]], excluded_attributes: Set[str] = None,
+                  keep_values: bool = True) -> Tuple[PropertyChanges, Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """ `generate_changes` over two streams of dumped properties sorted by id, holding one property of each in memory at a time.
+
+        returns the changes along with the dumped values of the changed listings before (removed and modified)
+        and after (appended and modified) unless `keep_values` is off, so memory only grows with the number of changes.
+    """
+    appended: List[str] = []
+    removed: List[str] = []
+    modified: Dict[str, List[FieldChange]] = {}
+    old_values: Dict[str, Dict[str, Any]] = {}
+    new_values: Dict[str, Dict[str, Any]] = {}
+
+    def advance(records, previous: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        record = next(records, None)
+        if record is not None and previous is not None and record["id"] <= previous["id"]:
+            raise ValueError(
+                f"snapshot is not sorted by id: {record['id']} after {previous['id']}")
+        return record
+
+    old_records, new_records = iter(old), iter(new)
+    o = advance(old_records, None)
+    n = advance(new_records, None)
+    while o is not None or n is not None:
+        if n is None or (o is not None and o["id"] < n["id"]):
+            removed.append(o["id"])
+            if keep_values:
+                old_values[o["id"]] = o
+            o = advance(old_records, o)
+        elif o is None or n["id"] < o["id"]:
+            appended.append(n["id"])
+            if keep_values:
+                new_values[n["id"]] = n
+            n = advance(new_records, n)
+        else:
+            changes = field_changes(o, n, excluded_attributes)
+            if changes:
+                modified[n["id"]] = changes
+                if keep_values:
+                    old_values[o["id"]] = o
+                    new_values[n["id"]] = n
+            o = advance(old_records, o)
+            n = advance(new_records, n)
+
+    return (PropertyChanges(appended, removed, modified), old_values, new_values)
+
+
+def dump_changes_between(settings: Settings, dump_old_path: str, dump_new_path: str, relisted: Dict[str, List[str]] = None, returning: Dict[str, float] = None) -> Tuple[PropertyChanges, List[CompactProperty], List[CompactProperty]]:
+    """ finds deltas between two dumps of properties. Returns changes and the old and new property values as `CompactProperty`.
+        new listings in `relisted` are reported as duplicates of the listings they map to and those in `returning` as back on the market instead of as new.
+
+        two ndjson snapshots are diffed by streaming through both and only the changed listings are returned,
+        otherwise both dumps are read in full and every listing is returned.
+        removed listings are always included, `send_removed_properties` is left to whoever emails the changes
+    """
+
+    if is_ndjson(dump_old_path) and is_ndjson(dump_new_path):
+        diff, old_values, new_values = merge_changes(read_snapshot(
+            dump_old_path), read_snapshot(dump_new_path), EXCLUDED_ATTRIBUTES)
+        old_properties = list(old_values.values())
+        new_properties = list(new_values.values())
+    else:
+        old_dump = load_dump(dump_old_path)
+        new_dump = load_dump(dump_new_path)
+        diff = generate_changes(
+            old_dump, new_dump, excluded_attributes=EXCLUDED_ATTRIBUTES)
+        old_properties = old_dump["properties"]
+        new_properties = new_dump["properties"]
+
+    if relisted:
+        diff.relisted = {
+            x: relisted[x] for x in diff.appended if x in relisted}
+        diff.appended = [
+            x for x in diff.appended if x not in diff.relisted]
+
+    if returning:
+        diff.returning = {
+            x: returning[x] for x in diff.appended if x in returning}
+        diff.appended = [
+            x for x in diff.appended if x not in diff.returning]
+
+    if not diff.empty():
+        with open(os.path.splitext(dump_new_path)[0] + "_diff.json", 'w') as d:
+            json.dump(diff, d, indent=4,
+                      cls=PropertyChanges.Encoder)
+        # every listing of both dumps is returned unless they were streamed, keep them compact
+        return (diff, load_compact_properties(old_properties), load_compact_properties(new_properties))
+    else:
+        return None
+
+
+async def dump_latest_changes(settings: Settings, dump_dir: str = "data", relisted: Dict[str, List[str]] = None, returning: Dict[str, float] = None) -> Union[Tuple[PropertyChanges, List[CompactProperty], List[CompactProperty]], None]:
+    """ finds newest and second newest dumps in the given directory then compares them and dumps the change log then returns the changes if there are any and the two property lists """
+    files = list_dumps(dump_dir)
 
     if len(files) >= 2:
         new_file_path = os.path.join(dump_dir, files[-1])
@@ -92,6 +180,6 @@ async def dump_latest_changes(settings: Settings) -> Union[Tuple[PropertyChanges
         logging.info(
             f"Comparing old dump: {old_file_path} to new dump {new_file_path}")
         return dump_changes_between(settings,
-                                    old_file_path, new_file_path)
+                                    old_file_path, new_file_path, relisted, returning)
 
     return None
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+from os.path import join
+from time import time
+from typing import Dict, List
+
+from flat_search.data import Property
+
+PAGE_FILENAME_PATTERN = re.compile(r"page_(\d+)\.json")
+
+
+class ScrapeCheckpoint():
+    """ per-page record of the listings parsed during a scrape run, written to disk as each page is parsed.
+
+        if a run fails part way through, a retry within `resume_window_seconds` of the first attempt resumes
+        from the first page missing from the checkpoint and the listings of both attempts are merged.
+    """
+
+    def __init__(self, key: str, resume_window_seconds: float, checkpoint_dir: str = "checkpoints") -> None:
+        """
+            key -- identifies the search, a checkpoint is only resumed by a run with the same key
+            resume_window_seconds -- how long after the checkpoint was started a retry may resume it, 0 disables resuming
+            checkpoint_dir -- the directory under which checkpoints are kept
+        """
+        self.path = join(checkpoint_dir, hashlib.sha1(
+            key.encode()).hexdigest())
+        self.pages: Dict[int, List[Property]] = {}
+
+        started = self._read_started()
+        if started is not None and time() - started <= resume_window_seconds:
+            self._load_pages()
+            logging.info(
+                f"Resuming checkpoint at: {self.path} with pages: {sorted(self.pages.keys())}")
+        else:
+            self.clear()
+
+        os.makedirs(self.path, exist_ok=True)
+        if not self.pages:
+            with open(join(self.path, "started"), "w") as f:
+                f.write(str(time()))
+
+    def _read_started(self) -> float:
+        try:
+            with open(join(self.path, "started"), "r") as f:
+                return float(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _load_pages(self):
+        for filename in os.listdir(self.path):
+            match = PAGE_FILENAME_PATTERN.fullmatch(filename)
+            if not match:
+                # i.e. a page a crash left half written
+                if filename != "started":
+                    logging.info(f"Removing unexpected checkpoint file: {filename}")
+                    os.remove(join(self.path, filename))
+                continue
+            index = int(match.group(1))
+            with open(join(self.path, filename), "r") as f:
+                self.pages[index] = Property.schema().load(
+                    json.load(f), many=True)
+
+    def first_unfinished_page(self) -> int:
+        """ the 0 indexed page at which scraping should resume """
+        index = 0
+        while index in self.pages:
+            index += 1
+        return index
+
+    def save_page(self, index: int, properties: List[Property]):
+        """ records the listings parsed from the 0 indexed page """
+        self.pages[index] = properties
+        path = join(self.path, f"page_{index}.json")
+        # write then rename so a crash never leaves a partial page behind
+        with open(path + ".tmp", "w") as f:
+            json.dump(Property.schema().dump(properties, many=True), f)
+        os.replace(path + ".tmp", path)
+
+    def properties(self) -> List[Property]:
+        """ all the checkpointed listings in page order """
+        return [p for index in sorted(self.pages.keys()) for p in self.pages[index]]
+
+    def clear(self):
+        """ removes the checkpoint, called once a run completes """
+        self.pages = {}
+        shutil.rmtree(self.path, ignore_errors=True)
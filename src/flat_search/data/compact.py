@@ -0,0 +1,218 @@
+"""
+Memory-compact, immutable representation of properties for keeping long histories in memory
+"""
+
+import sys
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+from flat_search.data import Property, PropertyType
+
+_PREFIXES: List[str] = [""]
+""" url prefixes shared between properties, the index of a prefix is stored in place of the prefix itself. Index 0 is the empty prefix """
+
+_PREFIX_INDICES: Dict[str, int] = {"": 0}
+
+_MAX_PREFIXES = 256
+""" prefix indices of image urls are stored as single bytes """
+
+_DATES: Dict[datetime, datetime] = {}
+""" dates shared between properties, i.e. the same availability date parsed for many listings """
+
+_MAX_DATES = 4096
+""" dates past this many are stored as they are rather than shared, so the table doesn't grow with every date ever seen """
+
+
+def _prefix_index(prefix: str) -> int:
+    index = _PREFIX_INDICES.get(prefix)
+    if index is None:
+        if len(_PREFIXES) >= _MAX_PREFIXES:
+            return 0
+        index = len(_PREFIXES)
+        _PREFIXES.append(sys.intern(prefix))
+        _PREFIX_INDICES[prefix] = index
+    return index
+
+
+def _split_url(url: str, at_last_slash: bool) -> Tuple[int, str]:
+    """ splits the url into the index of its shared prefix and the interned remainder.
+
+        the prefix is the base url, or everything up to the last `/` of the path if `at_last_slash` is set i.e. for image CDN urls
+    """
+    if at_last_slash:
+        prefix = url[:url.rfind("/") + 1]
+    else:
+        parsed = urlparse(url)
+        prefix = f"{parsed.scheme}://{parsed.netloc}" if parsed.netloc else ""
+
+    index = _prefix_index(prefix)
+    return (index, sys.intern(url[len(_PREFIXES[index]):]))
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+def _intern_date(value: Optional[datetime]) -> Optional[datetime]:
+    if value is None:
+        return None
+    shared = _DATES.get(value)
+    if shared is not None:
+        return shared
+    if len(_DATES) < _MAX_DATES:
+        _DATES[value] = value
+    return value
+
+
+class CompactProperty(NamedTuple):
+    """ immutable, tuple backed equivalent of `Property` without a per-instance `__dict__`.
+
+        strings are interned so repeated text across snapshots is stored once, the base url of the listing and
+        the CDN prefixes of the images are stored as indices into a shared prefix table and image urls are tuples.
+    """
+
+    id: str
+    listing_prefix: int
+    listing_path: str
+    date_found: datetime
+    property_type: PropertyType
+    price_per_month: Optional[int]
+    deposit: Optional[int]
+    bedrooms: Optional[int]
+    image_prefixes: Optional[bytes]
+    image_paths: Optional[Tuple[str, ...]]
+    address: Optional[str]
+    available_from: Optional[datetime]
+    date_listed: Optional[datetime]
+    description: str
+    postcode_district: Optional[str] = None
+    duplicate_of: Optional[str] = None
+
+    @property
+    def listing_url(self) -> str:
+        return _PREFIXES[self.listing_prefix] + self.listing_path
+
+    @property
+    def image_urls(self) -> Optional[Tuple[str, ...]]:
+        if self.image_paths is None:
+            return None
+        return tuple(_PREFIXES[prefix] + path for prefix, path in zip(self.image_prefixes, self.image_paths))
+
+    def from_property(p: Property) -> "CompactProperty":
+        listing_prefix, listing_path = _split_url(p.listing_url, False)
+
+        image_prefixes = None
+        image_paths = None
+        if p.image_urls is not None:
+            images = [_split_url(x, True) for x in p.image_urls]
+            image_prefixes = bytes(x[0] for x in images)
+            image_paths = tuple(x[1] for x in images)
+
+        return CompactProperty(
+            id=sys.intern(p.id),
+            listing_prefix=listing_prefix,
+            listing_path=listing_path,
+            date_found=p.date_found,
+            property_type=p.property_type,
+            price_per_month=p.price_per_month,
+            deposit=p.deposit,
+            bedrooms=p.bedrooms,
+            image_prefixes=image_prefixes,
+            image_paths=image_paths,
+            address=_intern(p.address),
+            available_from=_intern_date(p.available_from),
+            date_listed=_intern_date(p.date_listed),
+            description=_intern(p.description),
+            postcode_district=_intern(p.postcode_district),
+            duplicate_of=p.duplicate_of)
+
+    def to_property(self) -> Property:
+        image_urls = self.image_urls
+        return Property(
+            id=self.id,
+            listing_url=self.listing_url,
+            date_found=self.date_found,
+            property_type=self.property_type,
+            price_per_month=self.price_per_month,
+            deposit=self.deposit,
+            bedrooms=self.bedrooms,
+            image_urls=list(image_urls) if image_urls is not None else None,
+            address=self.address,
+            available_from=self.available_from,
+            date_listed=self.date_listed,
+            description=self.description,
+            postcode_district=self.postcode_district,
+            duplicate_of=self.duplicate_of)
+
+    def short_summary(self) -> str:
+        """ returns short summary with hyperlinks for command line usage"""
+        return f"{self.property_type.name} : {self.address} : {self.listing_url}"
+
+
+def compact_properties(properties: List[Property]) -> List[CompactProperty]:
+    return [CompactProperty.from_property(x) for x in properties]
+
+
+def load_compact_properties(values: Iterable[Dict[str, Any]]) -> List[CompactProperty]:
+    """ the dumped properties loaded one at a time straight into their compact form """
+    schema = Property.schema()
+    return [CompactProperty.from_property(schema.load(x)) for x in values]
+
+
+def as_property(p: Union[Property, CompactProperty]) -> Property:
+    """ the property itself or the full `Property` of a compact one, i.e. to dump it """
+    return p.to_property() if isinstance(p, CompactProperty) else p
+
+
+if __name__ == "__main__":
+    # memory benchmark: the same 100k listings (as if loaded from several snapshots) in both representations
+    import random
+    import tracemalloc
+    from datetime import timedelta
+
+    def make_properties(n: int) -> List[Property]:
+        rng = random.Random(0)
+        now = datetime.now()
+        dates = [now + timedelta(days=x) for x in range(60)]
+        # a history holds the same listing many times over, one copy per snapshot
+        unique = n // 10
+        properties = []
+        for i in range(n):
+            listing = i % unique
+            properties.append(Property(
+                id=str(60000000 + listing),
+                listing_url=f"https://www.zoopla.co.uk/to-rent/details/{60000000 + listing}/?search_identifier=69e30057ba2b75d95fbac60db87cceec",
+                date_found=now,
+                property_type=rng.choice(list(PropertyType)),
+                price_per_month=rng.randint(500, 5000),
+                deposit=rng.randint(1000, 10000),
+                bedrooms=rng.randint(1, 5),
+                image_urls=[f"https://lid.zoocdn.com/u/1200/900/{listing:040x}{x}.jpg:p" for x in range(4)],
+                address=f"{listing} Some Road, London SW{listing % 20}",
+                available_from=rng.choice(dates),
+                date_listed=rng.choice(dates),
+                description=f"{rng.randint(1, 5)} bed flat to rent, listing number {listing} " * 4))
+        # strings loaded from separate json snapshots are separate objects, simulate that
+        def copy(x): return (x + " ")[:-1]
+        for p in properties:
+            p.address = copy(p.address)
+            p.description = copy(p.description)
+            p.listing_url = copy(p.listing_url)
+            p.image_urls = [copy(x) for x in p.image_urls]
+        return properties
+
+    N = 100_000
+
+    tracemalloc.start()
+    properties = make_properties(N)
+    regular_size, _ = tracemalloc.get_traced_memory()
+
+    compact = compact_properties(properties)
+    del properties
+    compact_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(compact) == N
+    print(f"{N} listings as Property:        {regular_size / 2**20:.1f} MiB")
+    print(f"{N} listings as CompactProperty: {compact_size / 2**20:.1f} MiB")
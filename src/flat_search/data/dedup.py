@@ -0,0 +1,258 @@
+"""
+Exact and near-duplicate detection of listings within a run and against the listings of previous runs
+"""
+
+import hashlib
+import logging
+import re
+import sqlite3
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from flat_search.data import Property
+
+NUM_PERMUTATIONS = 64
+
+BANDS = 16
+""" a pair of listings becomes a candidate if all the rows of any band of their signatures agree, with 16 bands of 4 rows
+    that is likely above a similarity of about 0.5 """
+
+ROWS = NUM_PERMUTATIONS // BANDS
+
+SHINGLE_SIZE = 5
+
+SIMILARITY_THRESHOLD = 0.7
+""" estimated jaccard similarity of the shingles of two candidates above which they are duplicates """
+
+PRICE_TOLERANCE = 0.1
+""" relative difference of the monthly prices of two duplicates, a relisted flat often comes back slightly cheaper """
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+ABBREVIATIONS = {
+    "rd": "road",
+    "st": "street",
+    "ave": "avenue",
+    "ln": "lane",
+    "sq": "square",
+    "pl": "place",
+    "ct": "court",
+    "gdns": "gardens",
+    "bed": "bedroom",
+    "beds": "bedroom",
+    "bedrooms": "bedroom",
+    "flat": "apartment",
+}
+""" spellings agents use interchangeably, mapped to one form """
+
+_PRIME = (1 << 31) - 1
+_random = np.random.RandomState(0x5eed)
+# fixed seed so signatures stored by previous runs stay comparable
+_A = _random.randint(1, _PRIME, NUM_PERMUTATIONS).astype(np.uint64)
+_B = _random.randint(0, _PRIME, NUM_PERMUTATIONS).astype(np.uint64)
+
+
+def normalize(p: Property) -> str:
+    """ lower case words of the address and description with punctuation dropped and abbreviations expanded """
+    words = TOKEN_PATTERN.findall(
+        f"{p.address or ''} {p.description or ''}".lower())
+    return " ".join(ABBREVIATIONS.get(x, x) for x in words)
+
+
+def minhash(text: str) -> np.ndarray:
+    """ minhash signature of the character shingles of the text """
+    shingles = {text[i:i + SHINGLE_SIZE]
+                for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))}
+    hashes = np.fromiter((zlib.crc32(x.encode()) for x in shingles),
+                         dtype=np.uint64, count=len(shingles)) % _PRIME
+    # hashes and coefficients are below 2^31 so the products fit in 64 bits
+    return ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+def band_buckets(signature: np.ndarray, bedrooms: Optional[int]) -> List[int]:
+    """ the lsh bucket of each band of the signature, listings with different numbers of bedrooms never share a bucket """
+    bedrooms = -1 if bedrooms is None else bedrooms
+    return [int.from_bytes(hashlib.blake2b(struct.pack("<ii", band, bedrooms) + signature[band * ROWS:(band + 1) * ROWS].tobytes(),
+                                           digest_size=8).digest(), "little", signed=True)
+            for band in range(BANDS)]
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return np.count_nonzero(a == b) / NUM_PERMUTATIONS
+
+
+def prices_match(a: Optional[int], b: Optional[int]) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    return abs(a - b) <= PRICE_TOLERANCE * max(a, b)
+
+
+def _signature(p: Property) -> Optional[np.ndarray]:
+    text = normalize(p)
+    # listings without any text would all look alike
+    return minhash(text) if text else None
+
+
+def shares_image(a: Property, b: Property) -> bool:
+    """ whether the two listings show any of the same images """
+    return not set(a.image_urls or ()).isdisjoint(b.image_urls or ())
+
+
+def deduplicate(properties: List[Property]) -> Tuple[List[Property], List[List[str]]]:
+    """ drops listings repeated within a run under the same id and flags near-duplicates under different ids.
+
+        the text of a search result is only its address and title, which neighbouring flats often share, so a near-duplicate
+        is only dropped if it also shares an image with the first listing of its cluster. the others are kept with
+        `duplicate_of` set to the id of that listing.
+
+        returns the remaining properties in their original order and the id clusters of the near-duplicates,
+        the id of the first listing first in each cluster.
+    """
+    unique: Dict[str, Property] = {}
+    for p in properties:
+        unique.setdefault(p.id, p)
+    candidates = list(unique.values())
+    if len(candidates) < len(properties):
+        logging.info(
+            f"Dropped {len(properties) - len(candidates)} listings repeated under the same id")
+
+    parents = list(range(len(candidates)))
+
+    def root(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    signatures = [_signature(p) for p in candidates]
+    buckets: Dict[int, List[int]] = {}
+    for i, signature in enumerate(signatures):
+        if signature is None:
+            continue
+        p = candidates[i]
+        for bucket in band_buckets(signature, p.bedrooms):
+            members = buckets.setdefault(bucket, [])
+            for j in members:
+                a, b = root(i), root(j)
+                if a != b and prices_match(p.price_per_month, candidates[j].price_per_month) \
+                        and similarity(signature, signatures[j]) >= SIMILARITY_THRESHOLD:
+                    # the earliest listing is the root of the cluster
+                    parents[max(a, b)] = min(a, b)
+            members.append(i)
+
+    clusters: Dict[int, List[str]] = {}
+    kept = []
+    dropped = []
+    for i, p in enumerate(candidates):
+        first = candidates[root(i)]
+        clusters.setdefault(root(i), []).append(p.id)
+        if first is p:
+            kept.append(p)
+        elif shares_image(p, first):
+            dropped.append(p.id)
+        else:
+            p.duplicate_of = first.id
+            kept.append(p)
+    clusters = [x for x in clusters.values() if len(x) > 1]
+    if clusters:
+        logging.info(
+            f"Near-duplicate listings in clusters: {clusters}, dropped {dropped} sharing images with the first of their cluster")
+
+    return kept, clusters
+
+
+class DuplicateIndex():
+    """ minhash signatures of every listing seen in previous runs and their lsh buckets, stored in sqlite.
+
+        matching a run costs one indexed lookup per band of each listing not seen before, independent of the size of the history.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS minhash_signatures (
+                listing_id TEXT PRIMARY KEY,
+                price_per_month INTEGER,
+                signature BLOB NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS minhash_buckets (
+                bucket INTEGER NOT NULL,
+                listing_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS minhash_buckets_bucket ON minhash_buckets (bucket);
+            CREATE INDEX IF NOT EXISTS minhash_buckets_listing ON minhash_buckets (listing_id);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def _known(self, listing_id: str) -> bool:
+        return self.connection.execute(
+            "SELECT 1 FROM minhash_signatures WHERE listing_id = ?", (listing_id,)).fetchone() is not None
+
+    def last_snapshot(self) -> Optional[float]:
+        return self.connection.execute("SELECT MAX(last_seen) FROM minhash_signatures").fetchone()[0]
+
+    def match(self, properties: List[Property]) -> Dict[str, List[str]]:
+        """ maps the ids of the listings not seen before to the ids of the earlier listings they duplicate.
+
+            only listings taken down before the last snapshot are candidates, a new listing resembling one still on
+            the market is most likely a similar flat nearby rather than the same flat listed again
+        """
+        last_snapshot = self.last_snapshot()
+        live = {p.id for p in properties}
+        matches = {}
+        for p in properties:
+            if self._known(p.id):
+                continue
+            signature = _signature(p)
+            if signature is None:
+                continue
+
+            candidates = set()
+            for bucket in band_buckets(signature, p.bedrooms):
+                candidates.update(x for (x,) in self.connection.execute("""
+                    SELECT minhash_buckets.listing_id FROM minhash_buckets JOIN minhash_signatures USING (listing_id)
+                    WHERE minhash_buckets.bucket = ? AND minhash_signatures.last_seen < ?
+                """, (bucket, last_snapshot)))
+            candidates.difference_update(live)
+
+            duplicates = []
+            for listing_id in sorted(candidates):
+                price, other = self.connection.execute(
+                    "SELECT price_per_month, signature FROM minhash_signatures WHERE listing_id = ?", (listing_id,)).fetchone()
+                if prices_match(p.price_per_month, price) and \
+                        similarity(signature, np.frombuffer(other, dtype=np.uint32)) >= SIMILARITY_THRESHOLD:
+                    duplicates.append(listing_id)
+            if duplicates:
+                matches[p.id] = duplicates
+        return matches
+
+    def add_snapshot(self, properties: List[Property], timestamp: float):
+        """ stores the signatures of the listings of a snapshot, replacing those of listings whose text or price changed """
+        with self.connection:
+            for p in properties:
+                signature = _signature(p)
+                if signature is None:
+                    continue
+                blob = signature.tobytes()
+                row = self.connection.execute(
+                    "SELECT price_per_month, signature FROM minhash_signatures WHERE listing_id = ?", (p.id,)).fetchone()
+                if row == (p.price_per_month, blob):
+                    self.connection.execute(
+                        "UPDATE minhash_signatures SET last_seen = MAX(last_seen, ?) WHERE listing_id = ?", (timestamp, p.id))
+                    continue
+
+                self.connection.execute(
+                    "DELETE FROM minhash_buckets WHERE listing_id = ?", (p.id,))
+                self.connection.execute("""
+                    INSERT INTO minhash_signatures (listing_id, price_per_month, signature, last_seen) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (listing_id) DO UPDATE SET price_per_month = excluded.price_per_month,
+                        signature = excluded.signature, last_seen = MAX(last_seen, excluded.last_seen)
+                """, (p.id, p.price_per_month, blob, timestamp))
+                self.connection.executemany("INSERT INTO minhash_buckets (bucket, listing_id) VALUES (?, ?)",
+                                            [(x, p.id) for x in band_buckets(signature, p.bedrooms)])
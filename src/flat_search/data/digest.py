@@ -0,0 +1,112 @@
+"""
+Durable queue of property changes coalesced across runs into one digest
+"""
+
+import json
+import sqlite3
+from time import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from flat_search.data import Property
+from flat_search.data.compact import CompactProperty, as_property
+from flat_search.data.changes import EXCLUDED_ATTRIBUTES, PropertyChanges, generate_changes
+
+DIGEST_FILENAME = "digest.sqlite"
+
+
+class ChangeDigest():
+    """ the changes of every run since the last digest was sent, stored in sqlite.
+
+        each listing is stored once with its value when it first changed (none if it was new) and its latest value (none if it was removed),
+        so however many runs changed a listing the digest shows a single change from the first old value to the latest new one
+        and a listing added then removed again within one digest doesn't show at all.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS digest_listings (
+                listing_id TEXT PRIMARY KEY,
+                base TEXT,
+                latest TEXT,
+                relisted_from TEXT,
+                first_seen REAL,
+                first_queued REAL NOT NULL
+            );
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, changes: PropertyChanges, old_properties: List[Property], properties: List[Property]):
+        """ queues the changes of a run, `old_properties` and `properties` being the listings before and after it """
+        old = {x.id: x for x in old_properties}
+        new = {x.id: x for x in properties}
+        now = time()
+
+        def dump(p: Optional[Union[Property, CompactProperty]]) -> Optional[str]:
+            return json.dumps(Property.schema().dump(as_property(p))) if p is not None else None
+
+        with self.connection:
+            ids = [*changes.appended, *changes.relisted, *changes.returning,
+                   *changes.removed, *changes.modified]
+            for id in ids:
+                base = old.get(id)
+                relisted_from = changes.relisted.get(id)
+                # the base of a listing already queued is kept, only its latest value moves on
+                self.connection.execute("""
+                    INSERT INTO digest_listings (listing_id, base, latest, relisted_from, first_seen, first_queued) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (listing_id) DO UPDATE SET latest = excluded.latest,
+                        relisted_from = COALESCE(relisted_from, excluded.relisted_from), first_seen = COALESCE(first_seen, excluded.first_seen)
+                """, (id, dump(base), dump(new.get(id)), json.dumps(relisted_from) if relisted_from else None,
+                      changes.returning.get(id), now))
+
+    def pending(self) -> int:
+        """ the number of listings with queued changes """
+        return self.connection.execute("SELECT COUNT(*) FROM digest_listings").fetchone()[0]
+
+    def oldest(self) -> Optional[float]:
+        """ when the oldest queued change was queued """
+        return self.connection.execute("SELECT MIN(first_queued) FROM digest_listings").fetchone()[0]
+
+    def due(self, window_seconds: float, max_changes: int) -> bool:
+        """ if the oldest change was queued more than `window_seconds` ago, or at least `max_changes` listings changed (0 for no limit) """
+        oldest = self.oldest()
+        if oldest is None:
+            return False
+        return time() - oldest >= window_seconds or (max_changes > 0 and self.pending() >= max_changes)
+
+    def collect(self) -> Optional[Tuple[PropertyChanges, List[Property], List[Property]]]:
+        """ the net changes of everything queued along with the listings before and after them, None if they cancel out """
+        old_dump: Dict[str, Any] = {"ids": {}, "properties": []}
+        new_dump: Dict[str, Any] = {"ids": {}, "properties": []}
+        relisted: Dict[str, List[str]] = {}
+        returning: Dict[str, float] = {}
+
+        for listing_id, base, latest, relisted_from, first_seen in self.connection.execute(
+                "SELECT listing_id, base, latest, relisted_from, first_seen FROM digest_listings ORDER BY first_queued"):
+            for value, dump in ((base, old_dump), (latest, new_dump)):
+                if value is not None:
+                    dump["ids"][listing_id] = len(dump["properties"])
+                    dump["properties"].append(json.loads(value))
+            if relisted_from:
+                relisted[listing_id] = json.loads(relisted_from)
+            if first_seen is not None:
+                returning[listing_id] = first_seen
+
+        diff = generate_changes(
+            old_dump, new_dump, excluded_attributes=EXCLUDED_ATTRIBUTES)
+        diff.relisted = {x: relisted[x] for x in diff.appended if x in relisted}
+        diff.returning = {x: returning[x] for x in diff.appended
+                          if x in returning and x not in diff.relisted}
+        diff.appended = [x for x in diff.appended
+                         if x not in diff.relisted and x not in diff.returning]
+
+        if not (diff.appended or diff.removed or diff.modified or diff.relisted or diff.returning):
+            return None
+        return (diff, Property.schema().load(old_dump["properties"], many=True),
+                Property.schema().load(new_dump["properties"], many=True))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM digest_listings")
@@ -1,32 +1,92 @@
 import os
-from typing import List
+from typing import Callable, List
 from flat_search.data import Property
+from flat_search.log import Summary, log_event
 import logging
 import json
 from os.path import join
 from datetime import datetime
+from flat_search.data.dedup import DuplicateIndex
+from flat_search.data.postcode import PostcodeIndex
+from flat_search.data.price_history import PRICE_HISTORY_DIRNAME, PriceHistory
+from flat_search.data.search_index import INDEX_FILENAME, SearchIndex
+from flat_search.data.seen import SeenIndex
+from flat_search.data.snapshot import JSON_SUFFIX, NDJSON_SUFFIX, write_snapshot
 
 
-def dump_properties(properties: List[Property]) -> str:
-    """ dump properties to file and return path to the file written """
+_dump_listeners: List[Callable[[str], None]] = []
+
+
+def add_dump_listener(listener: Callable[[str], None]):
+    """ calls the listener with the path of every dump this process writes, once its indexes are updated """
+    _dump_listeners.append(listener)
+
+
+def list_dumps(dump_dir: str = "data") -> List[str]:
+    """ the file names of the property dumps of either format in the directory, oldest first """
+    if not os.path.isdir(dump_dir):
+        return []
+    return sorted([x for x in os.listdir(dump_dir)
+                   if not "diff" in x and (x.endswith(JSON_SUFFIX) or x.endswith(NDJSON_SUFFIX))])
+
+
+def dump_properties(properties: List[Property], dump_dir: str = "data", ndjson: bool = False) -> str:
+    """ dump properties to file in the given directory and return path to the file written.
+        with `ndjson` the properties are streamed to a snapshot sorted by id rather than dumped as one json document
+    """
 
     now = datetime.now()
-    filename = now.strftime('%Y-%m-%d_%H-%M-%S.json')
-    path = join("data", filename)
-    logging.info(
-        f'dumping properties to json file at {path}: {[x.short_summary() for x in properties]}')
-    logging.info(f"Total: {len(properties)} properties being dumped.")
+    filename = now.strftime('%Y-%m-%d_%H-%M-%S') + \
+        (NDJSON_SUFFIX if ndjson else JSON_SUFFIX)
+    path = join(dump_dir, filename)
+    logging.info("dumping properties to json file at %s: %s", path,
+                 Summary(properties, Property.short_summary))
+    logging.debug("dumped properties: %s", Summary(
+        properties, Property.short_summary, limit=None))
+    log_event("properties_dumped", path=path, count=len(properties))
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
     try:
-        dump = Property.schema().dump(properties, many=True)
-        ids = {x.id: i for i, x in enumerate(properties)}
-
-        with open(path, 'w') as f:
-            json.dump({
-                "properties": dump,
-                "ids": ids
-            }, f, indent=4)
+        if ndjson:
+            write_snapshot(path, properties)
+        else:
+            dump = Property.schema().dump(properties, many=True)
+            ids = {x.id: i for i, x in enumerate(properties)}
+
+            with open(path, 'w') as f:
+                json.dump({
+                    "properties": dump,
+                    "ids": ids
+                }, f, indent=4)
     except:
         logging.exception("Exception in writing to file")
+
+    timestamp = now.replace(microsecond=0).timestamp()
+    try:
+        index = SearchIndex(join(dump_dir, INDEX_FILENAME))
+        index.add_snapshot(properties, timestamp)
+        index.close()
+
+        postcodes = PostcodeIndex(join(dump_dir, INDEX_FILENAME))
+        postcodes.add_snapshot(properties, timestamp)
+        postcodes.close()
+
+        duplicates = DuplicateIndex(join(dump_dir, INDEX_FILENAME))
+        duplicates.add_snapshot(properties, timestamp)
+        duplicates.close()
+
+        seen = SeenIndex(join(dump_dir, INDEX_FILENAME))
+        seen.add_snapshot(properties, timestamp)
+        seen.close()
+
+        PriceHistory(join(dump_dir, PRICE_HISTORY_DIRNAME)
+                     ).add_snapshot(properties, timestamp)
+    except:
+        logging.exception("Exception in updating the search index")
+
+    for listener in _dump_listeners:
+        try:
+            listener(path)
+        except:
+            logging.exception("Exception in dump listener")
     return path
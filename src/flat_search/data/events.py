@@ -0,0 +1,195 @@
+"""
+Append-only, rotated log of change events for consumers following the changes of a search without reading its dumps
+"""
+
+import fcntl
+import logging
+import os
+from dataclasses import dataclass, field
+from time import sleep
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from dataclasses_json import dataclass_json
+
+from flat_search.data import Property
+from flat_search.data.compact import CompactProperty, as_property
+from flat_search.data.changes import PropertyChanges
+
+EVENTS_DIRNAME = "events"
+
+SEGMENT_PREFIX = "events-"
+
+
+@dataclass_json
+@dataclass
+class ChangeEvent():
+    """ one listing appended, removed, modified, relisted or returning in one run """
+
+    offset: int
+    """ the position of the event in the log, strictly increasing and never reused """
+
+    timestamp: float
+    """ the time of the snapshot the change was found in """
+
+    listing_id: str
+
+    kind: str
+    """ one of `appended`, `removed`, `modified`, `relisted` and `returning` """
+
+    changes: List[Dict[str, Any]] = field(default_factory=list)
+    """ the `field_name`, `old` and `new` value of every changed field of a modified listing """
+
+    value: Optional[Dict[str, Any]] = None
+    """ the listing as dumped, its last known value for a removed listing """
+
+    relisted_from: Optional[List[str]] = None
+    """ the ids of the earlier listings a relisted listing duplicates """
+
+
+class ChangeEventLog():
+    """ change events appended as json lines to segment files named after the offset of their first event.
+
+        a new segment is started once the current one grows beyond `max_segment_bytes` and only the newest `max_segments` are kept.
+        appends are serialized across processes with a lock file.
+    """
+
+    def __init__(self, directory: str, max_segment_bytes: int = 8 * 2**20, max_segments: int = 16) -> None:
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self) -> List[str]:
+        """ the segment file names, oldest first """
+        return sorted(x for x in os.listdir(self.directory)
+                      if x.startswith(SEGMENT_PREFIX) and x.endswith(".jsonl"))
+
+    def _segment_name(self, first_offset: int) -> str:
+        # zero padded so names sort by offset
+        return f"{SEGMENT_PREFIX}{first_offset:020d}.jsonl"
+
+    def _first_offset(self, segment: str) -> int:
+        return int(segment[len(SEGMENT_PREFIX):-len(".jsonl")])
+
+    def _next_offset(self, segment: Optional[str]) -> int:
+        if segment is None:
+            return 0
+        last = None
+        for event in self._read_segment(segment):
+            last = event.offset
+        return last + 1 if last is not None else self._first_offset(segment)
+
+    def append(self, events: List[ChangeEvent]) -> List[ChangeEvent]:
+        """ assigns the events their offsets and appends them, returns the events with their offsets """
+        if not events:
+            return events
+
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                segments = self.segments()
+                current = segments[-1] if segments else None
+                offset = self._next_offset(current)
+                path = os.path.join(self.directory, current) if current else None
+
+                if path is None or os.path.getsize(path) >= self.max_segment_bytes:
+                    current = self._segment_name(offset)
+                    path = os.path.join(self.directory, current)
+                    segments.append(current)
+
+                with open(path, "a+b") as f:
+                    # a write cut short by a crash leaves a partial line, start on a fresh one
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            f.write(b"\n")
+                    for event in events:
+                        event.offset = offset
+                        offset += 1
+                        f.write(event.to_json().encode() + b"\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                for segment in segments[:-self.max_segments]:
+                    os.remove(os.path.join(self.directory, segment))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return events
+
+    def _read_segment(self, segment: str) -> Iterator[ChangeEvent]:
+        try:
+            f = open(os.path.join(self.directory, segment), "r")
+        except FileNotFoundError:
+            # removed by rotation while being read
+            return
+        with f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # still being written
+                    return
+                try:
+                    yield ChangeEvent.from_json(line)
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(
+                        f"Skipping corrupt change event in {segment}")
+
+    def read(self, from_offset: int = 0) -> Iterator[ChangeEvent]:
+        """ the events at or after the offset, starting at the oldest event kept if it was rotated away """
+        segments = self.segments()
+        # the last segment starting at or before the offset holds it
+        start = 0
+        for i, segment in enumerate(segments):
+            if self._first_offset(segment) <= from_offset:
+                start = i
+        for segment in segments[start:]:
+            for event in self._read_segment(segment):
+                if event.offset >= from_offset:
+                    yield event
+
+    def follow(self, from_offset: int = 0, poll_interval: float = 5) -> Iterator[ChangeEvent]:
+        """ the events at or after the offset, waiting for new events forever """
+        while True:
+            for event in self.read(from_offset):
+                from_offset = event.offset + 1
+                yield event
+            sleep(poll_interval)
+
+
+def change_events(changes: PropertyChanges, old_properties: List[Property], properties: List[Property], timestamp: float) -> List[ChangeEvent]:
+    """ one event per listing in the changes, offsets are assigned when they are appended to a log """
+    old = {x.id: x for x in old_properties}
+    new = {x.id: x for x in properties}
+
+    def dump(p: Optional[Union[Property, CompactProperty]]) -> Optional[Dict[str, Any]]:
+        return Property.schema().dump(as_property(p)) if p is not None else None
+
+    events = [ChangeEvent(-1, timestamp, id, "appended", value=dump(new.get(id)))
+              for id in changes.appended]
+    events += [ChangeEvent(-1, timestamp, id, "removed", value=dump(old.get(id)))
+               for id in changes.removed]
+    events += [ChangeEvent(-1, timestamp, id, "modified", [x.__dict__ for x in field_changes], dump(new.get(id)))
+               for id, field_changes in changes.modified.items()]
+    events += [ChangeEvent(-1, timestamp, id, "relisted", value=dump(new.get(id)), relisted_from=ids)
+               for id, ids in changes.relisted.items()]
+    events += [ChangeEvent(-1, timestamp, id, "returning", value=dump(new.get(id)))
+               for id in changes.returning]
+    return events
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="prints the change events of a search as json lines")
+    parser.add_argument("--dump-dir", default="data")
+    parser.add_argument("--from", dest="from_offset", type=int, default=0,
+                        help="the offset of the first event to print")
+    parser.add_argument("--follow", action="store_true",
+                        help="keep waiting for new events")
+    args = parser.parse_args()
+
+    log = ChangeEventLog(os.path.join(args.dump_dir, EVENTS_DIRNAME))
+    events = log.follow(args.from_offset) if args.follow else log.read(
+        args.from_offset)
+    for event in events:
+        print(event.to_json(), flush=True)
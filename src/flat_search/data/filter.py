@@ -0,0 +1,133 @@
+"""
+Batch filtering of properties over numpy columns driven by declarative filter rules
+"""
+
+from datetime import datetime
+from functools import cached_property
+import logging
+from typing import List, Optional
+
+import numpy as np
+
+from flat_search.data import Property, PropertyType
+from flat_search.data.postcode import postcode_area
+from flat_search.settings import FilterRule, Settings
+
+NUMERIC_FIELDS = ["price_per_month", "deposit",
+                  "bedrooms", "available_from", "date_listed", "price_per_bedroom"]
+TEXT_FIELDS = ["address", "description"]
+
+
+class PropertyColumns():
+    """ a list of properties viewed as one numpy array per field, each column is only built once it's used """
+
+    def __init__(self, properties: List[Property]) -> None:
+        self.properties = properties
+        self.size = len(properties)
+
+    def _numeric(self, values: List[Optional[float]]) -> np.ndarray:
+        return np.array([np.nan if x is None else x for x in values], dtype=np.float64)
+
+    def _timestamps(self, values: List[Optional[datetime]]) -> np.ndarray:
+        return self._numeric([x.timestamp() if x is not None else None for x in values])
+
+    def _text(self, values: List[Optional[str]]) -> np.ndarray:
+        return np.array([x or "" for x in values], dtype=str)
+
+    @cached_property
+    def price_per_month(self) -> np.ndarray:
+        return self._numeric([p.price_per_month for p in self.properties])
+
+    @cached_property
+    def deposit(self) -> np.ndarray:
+        return self._numeric([p.deposit for p in self.properties])
+
+    @cached_property
+    def bedrooms(self) -> np.ndarray:
+        return self._numeric([p.bedrooms for p in self.properties])
+
+    @cached_property
+    def price_per_bedroom(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.bedrooms > 0, self.price_per_month / self.bedrooms, np.nan)
+
+    @cached_property
+    def available_from(self) -> np.ndarray:
+        return self._timestamps([p.available_from for p in self.properties])
+
+    @cached_property
+    def date_listed(self) -> np.ndarray:
+        return self._timestamps([p.date_listed for p in self.properties])
+
+    @cached_property
+    def property_type(self) -> np.ndarray:
+        return self._text([p.property_type.value if p.property_type is not None else None for p in self.properties])
+
+    @cached_property
+    def postcode_district(self) -> np.ndarray:
+        return self._text([p.postcode_district for p in self.properties])
+
+    @cached_property
+    def postcode_area(self) -> np.ndarray:
+        return self._text([postcode_area(p.postcode_district) if p.postcode_district else None for p in self.properties])
+
+    @cached_property
+    def address(self) -> np.ndarray:
+        return self._text([p.address for p in self.properties])
+
+    @cached_property
+    def description(self) -> np.ndarray:
+        return self._text([p.description for p in self.properties])
+
+
+def evaluate_rule(rule: FilterRule, columns: PropertyColumns) -> np.ndarray:
+    """ returns the boolean mask of the properties passing the rule """
+    if rule.field in NUMERIC_FIELDS:
+        column = getattr(columns, rule.field)
+        # comparisons with nan are false so missing values fail any bound
+        present = ~np.isnan(column)
+        mask = present.copy()
+        if rule.min is not None:
+            mask &= column > rule.min if rule.min_exclusive else column >= rule.min
+        if rule.max is not None:
+            mask &= column <= rule.max
+        if rule.exclude:
+            # missing values fail an excluded range too
+            return ~mask & present
+    elif rule.field == "property_type":
+        mask = np.isin(columns.property_type, [
+                       PropertyType(x).value for x in rule.allow or []])
+    elif rule.field == "postcode_district":
+        allow = [x.upper() for x in rule.allow or []]
+        mask = np.isin(columns.postcode_district, allow) | np.isin(
+            columns.postcode_area, allow)
+    elif rule.field in TEXT_FIELDS:
+        text = np.char.lower(getattr(columns, rule.field))
+        mask = np.zeros(columns.size, dtype=bool)
+        for keyword in rule.keywords or []:
+            mask |= np.char.find(text, keyword.lower()) >= 0
+    else:
+        raise ValueError(f"Cannot filter on unknown field: {rule.field}")
+
+    return ~mask if rule.exclude else mask
+
+
+def filter_settings(properties: List[Property], settings: Settings) -> List[Property]:
+    """ the properties within the price, bedroom and availability ranges of the settings and passing its extra `filters` """
+    return filter_properties(properties, settings.filter_rules())
+
+
+def filter_properties(properties: List[Property], rules: List[FilterRule]) -> List[Property]:
+    """ returns the properties passing all of the rules, in their original order """
+    if not properties:
+        return []
+
+    columns = PropertyColumns(properties)
+    mask = np.ones(columns.size, dtype=bool)
+    for rule in rules:
+        rule_mask = evaluate_rule(rule, columns)
+        logging.debug(
+            "rule on %s passed %d of %d properties", rule.field, np.count_nonzero(rule_mask), columns.size)
+        mask &= rule_mask
+
+    return [properties[i] for i in np.flatnonzero(mask)]
@@ -0,0 +1,141 @@
+"""
+Postcode district parsing, the district index across snapshots and per-district statistics
+"""
+
+import re
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from flat_search.data import Property
+
+POSTCODE_AREAS = set("""
+AB AL B BA BB BD BH BL BN BR BS BT CA CB CF CH CM CO CR CT CV CW DA DD DE DG DH DL DN DT DY E EC EH EN EX FK FY G GL GU GY
+HA HD HG HP HR HS HU HX IG IM IP IV JE KA KT KW KY L LA LD LE LL LN LS LU M ME MK ML N NE NG NN NP NR NW OL OX PA PE PH PL
+PO PR RG RH RM S SA SE SG SK SL SM SN SO SP SR SS ST SW SY TA TD TF TN TQ TR TS TW UB W WA WC WD WF WN WR WS WV YO ZE
+""".split())
+""" the letter prefixes of all UK postcode areas, used to tell postcodes from i.e. road numbers """
+
+OUTWARD_CODE_PATTERN = re.compile(
+    r"\b([A-Z]{1,2})([0-9][0-9A-Z]?)(?:\s*[0-9][A-Z]{2})?\b")
+
+AREA_PATTERN = re.compile(r"[A-Z]*")
+
+DISTRICT_SUFFIX_PATTERN = re.compile(r"(?:[0-9][0-9A-Z]?)?")
+""" what follows the area in a district, nothing for a whole area """
+
+
+def parse_postcode_district(address: Optional[str]) -> Optional[str]:
+    """ returns the outward code (district) of the last postcode mentioned in the address i.e. `SW10` or `N4`, None if there is none """
+    if not address:
+        return None
+    district = None
+    for match in OUTWARD_CODE_PATTERN.finditer(address):
+        if match.group(1) in POSTCODE_AREAS:
+            district = match.group(1) + match.group(2)
+    return district
+
+
+def postcode_area(district: str) -> str:
+    """ the letter prefix of a district i.e. `SW` for `SW10` """
+    return AREA_PATTERN.match(district).group()
+
+
+def is_district_or_area(value: str) -> bool:
+    """ whether the value is a postcode area i.e. `SW` or one of its districts i.e. `SW10`, case insensitive """
+    value = value.upper()
+    area = postcode_area(value)
+    return area in POSTCODE_AREAS and DISTRICT_SUFFIX_PATTERN.fullmatch(value[len(area):]) is not None
+
+
+class PostcodeIndex():
+    """ maps postcode districts to the ids of the listings seen in them across all snapshots, stored in sqlite """
+
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS postcode_districts (
+                district TEXT NOT NULL,
+                listing_id TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                PRIMARY KEY (district, listing_id)
+            );
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def add_snapshot(self, properties: List[Property], timestamp: float):
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO postcode_districts (district, listing_id, first_seen, last_seen) VALUES (?, ?, ?, ?)
+                ON CONFLICT (district, listing_id) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)
+            """, [(p.postcode_district, p.id, timestamp, timestamp) for p in properties if p.postcode_district])
+
+    def listings(self, prefix: str, since: float = None) -> List[Tuple[str, str]]:
+        """ returns (district, listing id) of the listings in districts starting with the prefix.
+
+            a prefix of letters is a whole area, i.e. `N` gives N1 to N22 but not NW or NE districts and `E` leaves out EC.
+            a prefix with digits matches every district starting with it, i.e. `SW1` gives SW1, SW1A and SW10 to SW19
+        """
+        prefix = prefix.upper()
+        since = since if since is not None else float("-inf")
+        if prefix and AREA_PATTERN.fullmatch(prefix):
+            return self.connection.execute(
+                "SELECT district, listing_id FROM postcode_districts WHERE district GLOB ? AND last_seen >= ? ORDER BY district",
+                (prefix + "[0-9]*", since)).fetchall()
+        return self.connection.execute(
+            "SELECT district, listing_id FROM postcode_districts WHERE district >= ? AND district < ? AND last_seen >= ? ORDER BY district",
+            (prefix, prefix + "\uffff", since)).fetchall()
+
+
+def district_stats(districts: np.ndarray, prices: np.ndarray) -> Dict[str, Tuple[int, float]]:
+    """ returns the number of listings and the median price per district, listings without a district or price are left out """
+    known = (districts != "") & ~np.isnan(prices)
+    districts = districts[known]
+    prices = prices[known]
+    if districts.size == 0:
+        return {}
+
+    names, groups = np.unique(districts, return_inverse=True)
+    # sort by district then price so each district's prices are a contiguous sorted run
+    order = np.lexsort((prices, groups))
+    sorted_prices = prices[order]
+    counts = np.bincount(groups, minlength=names.size)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = (sorted_prices[starts + (counts - 1) // 2] +
+               sorted_prices[starts + counts // 2]) / 2
+
+    return {str(name): (int(count), float(median)) for name, count, median in zip(names, counts, medians)}
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    from flat_search.data.dump import list_dumps
+    from flat_search.data.snapshot import load_dump
+    from flat_search.data.filter import PropertyColumns
+    from flat_search.data.search_index import INDEX_FILENAME
+
+    parser = argparse.ArgumentParser(
+        description="per postcode district statistics of the latest dump, or the listings seen in districts starting with a prefix")
+    parser.add_argument("prefix", nargs="?",
+                        help="list the listings seen in districts starting with this prefix across all snapshots")
+    parser.add_argument("--dump-dir", default="data")
+    args = parser.parse_args()
+
+    if args.prefix:
+        index = PostcodeIndex(os.path.join(args.dump_dir, INDEX_FILENAME))
+        for district, listing_id in index.listings(args.prefix):
+            print(f"{district}\t{listing_id}")
+    else:
+        dumps = list_dumps(args.dump_dir)
+        if not dumps:
+            raise SystemExit(f"no dumps in {args.dump_dir}")
+        properties = Property.schema().load(
+            load_dump(os.path.join(args.dump_dir, dumps[-1]))["properties"], many=True)
+        columns = PropertyColumns(properties)
+        for district, (count, median) in sorted(district_stats(columns.postcode_district, columns.price_per_month).items()):
+            print(f"{district}\tcount: {count}\tmedian pcm: {median:.0f}")
@@ -0,0 +1,266 @@
+"""
+Time series of the monthly price of every listing across snapshots, kept as numpy arrays appended to as snapshots are dumped
+"""
+
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from flat_search.data import Property
+from flat_search.data.postcode import district_stats, postcode_area
+
+PRICE_HISTORY_DIRNAME = "price_history"
+
+OBSERVATION = np.dtype([
+    ("timestamp", "<f8"),
+    ("listing", "<i4"),
+    ("price", "<f4"),
+    ("bedrooms", "<i2"),
+    ("area", "<i4"),
+])
+""" one listing in one snapshot. Listings and postcode areas are indices into their key files, missing values are nan or -1 """
+
+DAY = 24 * 60 * 60
+
+
+class PriceDrop(NamedTuple):
+    peak: float
+    """ the highest monthly price the listing was ever seen at """
+    price: float
+    """ the monthly price in the latest snapshot """
+    dropped_at: float
+    """ the timestamp of the first snapshot the listing was seen at its current price """
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """ mean over the trailing `window` values ending at each value, nan values are left out """
+    known = ~np.isnan(values)
+    sums = np.cumsum(np.where(known, values, 0))
+    counts = np.cumsum(known)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts[window:] = counts[window:] - counts[:-window]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def group_medians(groups: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    """ median of the values in each group, groups being integers below `size`. Empty groups are nan """
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=size)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(size, np.nan)
+    present = counts > 0
+    starts, counts = starts[present], counts[present]
+    medians[present] = (sorted_values[starts + (counts - 1) // 2] +
+                        sorted_values[starts + counts // 2]) / 2
+    return medians
+
+
+class PriceHistory():
+    """ the price of every listing in every snapshot stored as fixed size records appended to a binary file, read back as one numpy array.
+
+        the ids of listings and names of postcode areas are stored once each in append-only key files and referred to by index.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.observations_path = os.path.join(directory, "observations.bin")
+        self.listing_ids = self._read_keys("listings.txt")
+        self.areas = self._read_keys("areas.txt")
+        self.listing_indices = {x: i for i, x in enumerate(self.listing_ids)}
+        self.area_indices = {x: i for i, x in enumerate(self.areas)}
+        self._observations: Optional[np.ndarray] = None
+
+    def _read_keys(self, filename: str) -> List[str]:
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path):
+            return []
+        with open(path, "r") as f:
+            return f.read().splitlines()
+
+    def _append_keys(self, filename: str, keys: List[str]):
+        if keys:
+            with open(os.path.join(self.directory, filename), "a") as f:
+                f.write("".join(x + "\n" for x in keys))
+
+    def _index(self, key: str, keys: List[str], indices: Dict[str, int], added: List[str]) -> int:
+        index = indices.get(key)
+        if index is None:
+            index = len(keys)
+            keys.append(key)
+            indices[key] = index
+            added.append(key)
+        return index
+
+    @property
+    def observations(self) -> np.ndarray:
+        if self._observations is None:
+            if not os.path.exists(self.observations_path):
+                self._observations = np.empty(0, dtype=OBSERVATION)
+            else:
+                data = np.fromfile(self.observations_path, dtype=np.uint8)
+                # a write interrupted part way leaves a partial record at the end
+                data = data[:data.size - data.size % OBSERVATION.itemsize]
+                self._observations = data.view(OBSERVATION)
+        return self._observations
+
+    def add_snapshot(self, properties: List[Property], timestamp: float):
+        new_listings, new_areas = [], []
+        records = np.empty(len(properties), dtype=OBSERVATION)
+        for i, p in enumerate(properties):
+            records[i] = (
+                timestamp,
+                self._index(p.id, self.listing_ids,
+                            self.listing_indices, new_listings),
+                np.nan if p.price_per_month is None else p.price_per_month,
+                -1 if p.bedrooms is None else p.bedrooms,
+                self._index(postcode_area(p.postcode_district), self.areas, self.area_indices, new_areas)
+                if p.postcode_district else -1)
+
+        # keys first so every record written refers to a stored key
+        self._append_keys("listings.txt", new_listings)
+        self._append_keys("areas.txt", new_areas)
+        with open(self.observations_path, "ab") as f:
+            records.tofile(f)
+        self._observations = None
+
+    def snapshots(self) -> np.ndarray:
+        return np.unique(self.observations["timestamp"])
+
+    def listing_prices(self, listing_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """ the timestamps of the snapshots the listing was seen in and its price in each """
+        index = self.listing_indices.get(listing_id)
+        observations = self.observations[self.observations["listing"] == index] \
+            if index is not None else self.observations[:0]
+        observations = observations[np.argsort(observations["timestamp"])]
+        return (observations["timestamp"], observations["price"].astype(np.float64))
+
+    def _select(self, bedrooms: Optional[int], area: Optional[str]) -> np.ndarray:
+        observations = self.observations
+        mask = ~np.isnan(observations["price"])
+        if bedrooms is not None:
+            mask &= observations["bedrooms"] == bedrooms
+        if area is not None:
+            mask &= observations["area"] == self.area_indices.get(
+                area.upper(), -2)
+        return observations[mask]
+
+    def median_trend(self, bedrooms: Optional[int] = None, area: Optional[str] = None, window_days: float = 7) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ the snapshot timestamps, the median price of the matching listings in each snapshot
+            and the mean of those medians over the trailing `window_days`
+        """
+        observations = self._select(bedrooms, area)
+        timestamps, snapshot = np.unique(
+            observations["timestamp"], return_inverse=True)
+        medians = group_medians(
+            snapshot, observations["price"].astype(np.float64), timestamps.size)
+
+        if timestamps.size == 0:
+            return (timestamps, medians, medians)
+        # snapshots aren't evenly spaced, the window is however many snapshots were taken per window on average
+        span = timestamps[-1] - timestamps[0]
+        window = max(1, int(round(window_days * DAY * (timestamps.size - 1) / span))) if span > 0 else 1
+        return (timestamps, medians, rolling_mean(medians, window))
+
+    def area_medians(self, bedrooms: Optional[int] = None, timestamp: Optional[float] = None) -> Dict[str, Tuple[int, float]]:
+        """ number of listings and median price per postcode area in the snapshot at `timestamp`, the latest one by default """
+        observations = self._select(bedrooms, None)
+        if observations.size == 0:
+            return {}
+        if timestamp is None:
+            timestamp = observations["timestamp"].max()
+        observations = observations[observations["timestamp"] == timestamp]
+        areas = np.array([self.areas[x] if x >= 0 else "" for x in observations["area"]], dtype=str)
+        return district_stats(areas, observations["price"].astype(np.float64))
+
+    def price_drops(self, listing_ids: Optional[List[str]] = None) -> Dict[str, PriceDrop]:
+        """ the listings seen in the latest snapshot at a lower price than the highest they were ever seen at """
+        observations = self.observations[~np.isnan(self.observations["price"])]
+        if observations.size == 0:
+            return {}
+        latest = observations["timestamp"].max()
+        current = np.unique(
+            observations["listing"][observations["timestamp"] == latest])
+        if listing_ids is not None:
+            wanted = [self.listing_indices[x]
+                      for x in listing_ids if x in self.listing_indices]
+            current = np.intersect1d(current, wanted)
+        observations = observations[np.isin(observations["listing"], current)]
+        if observations.size == 0:
+            return {}
+
+        # each listing becomes a contiguous run ordered by time
+        observations = observations[np.lexsort(
+            (observations["timestamp"], observations["listing"]))]
+        listings = observations["listing"]
+        prices = observations["price"].astype(np.float64)
+        starts = np.flatnonzero(np.r_[True, listings[1:] != listings[:-1]])
+        ends = np.r_[starts[1:], listings.size] - 1
+
+        peaks = np.maximum.reduceat(prices, starts)
+        last_prices = prices[ends]
+        # the latest change of price within each run, the first record of a run counts as one
+        changed = np.r_[True, (prices[1:] != prices[:-1]) |
+                        (listings[1:] != listings[:-1])]
+        change_positions = np.maximum.accumulate(
+            np.where(changed, np.arange(prices.size), 0))
+        dropped_at = observations["timestamp"][change_positions[ends]]
+
+        dropped = np.flatnonzero(last_prices < peaks)
+        return {self.listing_ids[listings[ends[i]]]: PriceDrop(float(peaks[i]), float(last_prices[i]), float(dropped_at[i]))
+                for i in dropped}
+
+
+def rebuild_price_history(dump_dir: str) -> PriceHistory:
+    """ builds the price history of every dump in the directory from scratch """
+    import shutil
+    from flat_search.data.dump import list_dumps
+    from flat_search.data.snapshot import load_dump
+    from flat_search.data.search_index import snapshot_timestamp
+
+    directory = os.path.join(dump_dir, PRICE_HISTORY_DIRNAME)
+    shutil.rmtree(directory, ignore_errors=True)
+    history = PriceHistory(directory)
+    for filename in list_dumps(dump_dir):
+        properties = Property.schema().load(
+            load_dump(os.path.join(dump_dir, filename))["properties"], many=True)
+        history.add_snapshot(properties, snapshot_timestamp(filename))
+    return history
+
+
+if __name__ == "__main__":
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(
+        description="price history of a listing, or the median price trend and per postcode area medians of all listings")
+    parser.add_argument("listing_id", nargs="?")
+    parser.add_argument("--dump-dir", default="data")
+    parser.add_argument("--bedrooms", type=int)
+    parser.add_argument("--area", help="postcode area i.e. `SW`")
+    parser.add_argument("--window-days", type=float, default=7)
+    parser.add_argument("--rebuild", action="store_true",
+                        help="build the history from every existing dump first")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        history = rebuild_price_history(args.dump_dir)
+    else:
+        history = PriceHistory(os.path.join(
+            args.dump_dir, PRICE_HISTORY_DIRNAME))
+
+    if args.listing_id:
+        for timestamp, price in zip(*history.listing_prices(args.listing_id)):
+            print(f"{datetime.fromtimestamp(timestamp)}\t{price:.0f} pcm")
+    else:
+        for timestamp, median, rolling in zip(*history.median_trend(args.bedrooms, args.area, args.window_days)):
+            print(
+                f"{datetime.fromtimestamp(timestamp)}\tmedian pcm: {median:.0f}\t{args.window_days:g} day mean: {rolling:.0f}")
+        for area, (count, median) in sorted(history.area_medians(args.bedrooms).items()):
+            print(f"{area}\tcount: {count}\tmedian pcm: {median:.0f}")
+        for listing_id, drop in history.price_drops().items():
+            print(
+                f"{listing_id}\tdown from {drop.peak:.0f} to {drop.price:.0f} pcm since {datetime.fromtimestamp(drop.dropped_at)}")
@@ -0,0 +1,200 @@
+"""
+Time series of the measurements of every run, with alerts when a run drifts away from the ones before it
+"""
+
+import json
+import os
+import resource
+import sqlite3
+import tracemalloc
+from contextlib import contextmanager
+from statistics import median
+from time import perf_counter, time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from flat_search.data import ScrapeReport
+
+RUN_METRICS_FILENAME = "run_metrics.sqlite"
+
+TOP_ALLOCATIONS = 10
+""" the number of allocation sites kept from the tracemalloc snapshot of a run """
+
+MIN_ALERT_HISTORY = 3
+""" the number of earlier runs a metric needs before a run can drift from them """
+
+
+class RunMetrics():
+    """ the measurements of one run: the durations of its phases in `<phase>_seconds`, counts like `pages_walked` and memory.
+
+        peak RSS and the traced allocations are those of the whole process, runs of other searches scheduled at the same time included.
+    """
+
+    def __init__(self, trace_allocations: bool = False) -> None:
+        """
+            trace_allocations -- traces python allocations with tracemalloc for the run, slowing it down noticeably
+        """
+        self.started = time()
+        self.values: Dict[str, float] = {}
+        self.top_allocations: List[str] = []
+        self._start = perf_counter()
+        # another run may already be tracing, only the run which started it stops it
+        self._tracing = trace_allocations and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+
+    def add(self, name: str, value: float):
+        """ adds the value to the metric, metrics measured more than once a run (i.e. once per subscriber) are summed """
+        self.values[name] = self.values.get(name, 0) + value
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """ adds the time spent in the block to `<name>_seconds` """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{name}_seconds", perf_counter() - start)
+
+    def add_report(self, report: ScrapeReport):
+        """ adds the page and listing counts and phase durations of a scrape """
+        self.add("pages_walked", report.pages_walked)
+        self.add("listings_parsed", report.listings_parsed)
+        for phase, seconds in report.phase_seconds.items():
+            self.add(f"{phase}_seconds", seconds)
+
+    def finish(self):
+        """ measures the total duration and memory of the run """
+        self.values["duration_seconds"] = perf_counter() - self._start
+        # kilobytes on linux
+        self.values["peak_rss_mb"] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024
+        if self._tracing:
+            snapshot = tracemalloc.take_snapshot()
+            self.top_allocations = [str(x) for x in snapshot.statistics(
+                "lineno")[:TOP_ALLOCATIONS]]
+            self.values["traced_peak_mb"] = tracemalloc.get_traced_memory()[
+                1] / 2**20
+            tracemalloc.stop()
+            self._tracing = False
+
+
+class RunMetricsStore():
+    """ the metrics of every run stored in sqlite, one row per run and metric """
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY,
+                started REAL NOT NULL,
+                status TEXT NOT NULL,
+                top_allocations TEXT
+            );
+            CREATE TABLE IF NOT EXISTS run_values (
+                run_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (run_id, name)
+            );
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, metrics: RunMetrics, status: str = "ok") -> int:
+        """ stores the metrics of a finished run, returns its id """
+        with self.connection:
+            run_id = self.connection.execute("INSERT INTO runs (started, status, top_allocations) VALUES (?, ?, ?)",
+                                             (metrics.started, status, json.dumps(metrics.top_allocations) if metrics.top_allocations else None)).lastrowid
+            self.connection.executemany("INSERT INTO run_values (run_id, name, value) VALUES (?, ?, ?)",
+                                        [(run_id, name, value) for name, value in metrics.values.items()])
+        return run_id
+
+    def names(self) -> List[str]:
+        return [x for x, in self.connection.execute("SELECT DISTINCT name FROM run_values ORDER BY name")]
+
+    def runs(self, limit: int = None) -> List[Tuple[int, float, str]]:
+        """ the id, start and status of the latest runs, oldest first """
+        rows = self.connection.execute(
+            "SELECT run_id, started, status FROM runs ORDER BY run_id DESC LIMIT ?", (limit or -1,)).fetchall()
+        return rows[::-1]
+
+    def history(self, name: str, limit: int = None, before_run: int = None) -> List[Tuple[float, float]]:
+        """ the start and value of the metric in the latest successful runs before `before_run` (or in all runs), oldest first """
+        rows = self.connection.execute("""
+            SELECT runs.started, run_values.value FROM run_values JOIN runs ON runs.run_id = run_values.run_id
+            WHERE run_values.name = ? AND runs.status = 'ok' AND runs.run_id < ?
+            ORDER BY runs.run_id DESC LIMIT ?
+        """, (name, before_run if before_run is not None else 2**62, limit or -1)).fetchall()
+        return rows[::-1]
+
+    def top_allocations(self, run_id: int) -> List[str]:
+        row = self.connection.execute(
+            "SELECT top_allocations FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else []
+
+    def drifts(self, run_id: int, metrics: RunMetrics, names: List[str], band: float, window: int) -> Dict[str, Tuple[float, float]]:
+        """ the metrics of the run more than `band` (a fraction) away from their median over the `window` successful runs before it,
+            mapped to their value and that median. metrics with fewer than `MIN_ALERT_HISTORY` earlier runs are left out
+        """
+        drifted = {}
+        for name in names:
+            value = metrics.values.get(name)
+            if value is None:
+                continue
+            history = [x for _, x in self.history(name, window, run_id)]
+            if len(history) < MIN_ALERT_HISTORY:
+                continue
+            expected = median(history)
+            if abs(value - expected) > band * abs(expected):
+                drifted[name] = (value, expected)
+        return drifted
+
+
+class MetricsDriftError(Exception):
+    """ a run whose metrics drifted away from the runs before it """
+
+    def __init__(self, drifted: Dict[str, Tuple[float, float]]) -> None:
+        self.drifted = drifted
+        super().__init__("metrics outside their usual range: " + ", ".join(
+            f"{name}={value:.4g} (median {expected:.4g})" for name, (value, expected) in drifted.items()))
+
+
+SPARK_BLOCKS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values: List[float]) -> str:
+    """ the values as a line of block characters scaled between their minimum and maximum """
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    if high == low:
+        return SPARK_BLOCKS[0] * len(values)
+    return "".join(SPARK_BLOCKS[round((x - low) / (high - low) * (len(SPARK_BLOCKS) - 1))] for x in values)
+
+
+def metrics_report(store: RunMetricsStore, runs: int = 20, names: Optional[List[str]] = None) -> str:
+    """ the trend, latest value and median of every metric over the latest successful runs, and the top allocations of the last traced run """
+    recent = store.runs(runs)
+    if not recent:
+        return "no runs recorded"
+    failed = sum(1 for _, _, status in recent if status != "ok")
+    lines = [f"{len(recent)} runs, {failed} failed"]
+
+    names = names or store.names()
+    width = max(len(x) for x in names) if names else 0
+    for name in names:
+        values = [x for _, x in store.history(name, runs)]
+        if not values:
+            continue
+        lines.append(
+            f"{name:<{width}}  {sparkline(values):<{runs}}  latest: {values[-1]:.4g}  median: {median(values):.4g}  min: {min(values):.4g}  max: {max(values):.4g}")
+
+    for run_id, started, _ in reversed(recent):
+        allocations = store.top_allocations(run_id)
+        if allocations:
+            lines.append(f"top allocations of run {run_id}:")
+            lines.extend(f"  {x}" for x in allocations)
+            break
+    return "\n".join(lines)
@@ -0,0 +1,246 @@
+"""
+Incrementally maintained full-text index over the address and description of every listing ever dumped
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from flat_search.data import Property
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+INDEX_FILENAME = "index.sqlite"
+""" the database shared by the search, postcode, duplicate and seen listing indexes of a dump directory """
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def encode_postings(doc_ids: Iterable[int], previous: int = 0) -> bytes:
+    """ encodes increasing doc ids as varint deltas from the previous doc id """
+    output = bytearray()
+    for doc_id in doc_ids:
+        delta = doc_id - previous
+        previous = doc_id
+        while delta >= 0x80:
+            output.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        output.append(delta)
+    return bytes(output)
+
+
+def decode_postings(data: bytes) -> List[int]:
+    doc_ids = []
+    current = 0
+    delta = 0
+    shift = 0
+    for byte in data:
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            current += delta
+            doc_ids.append(current)
+            delta = 0
+            shift = 0
+    return doc_ids
+
+
+class SearchIndex():
+    """ inverted index over the address and description of listings, stored in sqlite.
+
+        a document is one version of a listing (its id and the content of its text fields) along with the first and last
+        time a snapshot contained it, so a listing appearing unchanged in many snapshots is only indexed once.
+        postings are stored per term as varint encoded doc id deltas and only ever appended to.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self._create_tables()
+
+    def _create_tables(self):
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_id INTEGER PRIMARY KEY,
+                listing_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                UNIQUE (listing_id, content_hash)
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT PRIMARY KEY,
+                last_doc_id INTEGER NOT NULL,
+                doc_ids BLOB NOT NULL
+            );
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def clear(self):
+        """ drops every indexed document, the tables of the other indexes sharing the database are left alone """
+        self.connection.executescript("""
+            DROP TABLE IF EXISTS documents;
+            DROP TABLE IF EXISTS postings;
+        """)
+        self._create_tables()
+
+    def add_snapshot(self, properties: List[Property], timestamp: float):
+        """ indexes the listings of a snapshot taken at the given timestamp """
+        new_postings: Dict[str, List[int]] = {}
+
+        with self.connection:
+            for p in properties:
+                text = f"{p.address or ''}\n{p.description or ''}"
+                content_hash = hashlib.sha1(text.encode()).hexdigest()
+                row = self.connection.execute(
+                    "SELECT doc_id FROM documents WHERE listing_id = ? AND content_hash = ?", (p.id, content_hash)).fetchone()
+                if row:
+                    self.connection.execute(
+                        "UPDATE documents SET last_seen = MAX(last_seen, ?) WHERE doc_id = ?", (timestamp, row[0]))
+                    continue
+
+                doc_id = self.connection.execute(
+                    "INSERT INTO documents (listing_id, content_hash, first_seen, last_seen) VALUES (?, ?, ?, ?)",
+                    (p.id, content_hash, timestamp, timestamp)).lastrowid
+                for term in set(tokenize(text)):
+                    new_postings.setdefault(term, []).append(doc_id)
+
+            for term, doc_ids in new_postings.items():
+                row = self.connection.execute(
+                    "SELECT last_doc_id FROM postings WHERE term = ?", (term,)).fetchone()
+                if row:
+                    self.connection.execute("UPDATE postings SET last_doc_id = ?, doc_ids = doc_ids || ? WHERE term = ?",
+                                            (doc_ids[-1], encode_postings(doc_ids, row[0]), term))
+                else:
+                    self.connection.execute("INSERT INTO postings (term, last_doc_id, doc_ids) VALUES (?, ?, ?)",
+                                            (term, doc_ids[-1], encode_postings(doc_ids)))
+
+        logging.info(
+            f"indexed {len(properties)} listings, {len(new_postings)} terms updated")
+
+    def _term_docs(self, term: str) -> Set[int]:
+        """ doc ids of the term, a trailing `*` matches every term with the prefix """
+        if term.endswith("*"):
+            prefix = term[:-1]
+            rows = self.connection.execute(
+                "SELECT doc_ids FROM postings WHERE term >= ? AND term < ?", (prefix, prefix + "\uffff")).fetchall()
+        else:
+            rows = self.connection.execute(
+                "SELECT doc_ids FROM postings WHERE term = ?", (term,)).fetchall()
+
+        docs = set()
+        for (data,) in rows:
+            docs.update(decode_postings(data))
+        return docs
+
+    def _all_docs(self) -> Set[int]:
+        return {x for (x,) in self.connection.execute("SELECT doc_id FROM documents")}
+
+    def query(self, query: str, since: float = None) -> List[Tuple[str, float, float]]:
+        """ returns (listing id, first seen, last seen) of the listings matching the query, most recently seen first.
+
+            words are and-ed together, `OR` separates alternatives, a leading `-` excludes a word,
+            a trailing `*` matches any word with that prefix and quoted phrases match all their words.
+            if `since` is given only listings seen at or after that timestamp are returned.
+        """
+        matches: Set[int] = set()
+        for alternative in re.split(r"\s+OR\s+", query.strip()):
+            docs: Optional[Set[int]] = None
+            excluded: Set[int] = set()
+            for word in re.findall(r'-?"[^"]*"|\S+', alternative):
+                negate = word.startswith("-")
+                terms = tokenize(word)
+                if terms and word.endswith("*"):
+                    terms[-1] += "*"
+                if not terms:
+                    continue
+                word_docs = self._term_docs(terms[0])
+                for term in terms[1:]:
+                    word_docs &= self._term_docs(term)
+                if negate:
+                    excluded |= word_docs
+                else:
+                    docs = word_docs if docs is None else docs & word_docs
+            if docs is None:
+                docs = self._all_docs() if excluded else set()
+            matches |= docs - excluded
+
+        if not matches:
+            return []
+
+        listings: Dict[str, Tuple[float, float]] = {}
+        ids = list(matches)
+        # stay below the sqlite limit on bound parameters
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for listing_id, first_seen, last_seen in self.connection.execute(
+                    f"SELECT listing_id, first_seen, last_seen FROM documents WHERE doc_id IN ({','.join('?' * len(chunk))})", chunk):
+                if since is not None and last_seen < since:
+                    continue
+                seen = listings.get(listing_id)
+                if seen:
+                    first_seen, last_seen = min(
+                        first_seen, seen[0]), max(last_seen, seen[1])
+                listings[listing_id] = (first_seen, last_seen)
+
+        return sorted(((k, *v) for k, v in listings.items()), key=lambda x: x[2], reverse=True)
+
+
+def snapshot_timestamp(filename: str) -> float:
+    """ the time a dump was taken, read from its file name """
+    return datetime.strptime(os.path.splitext(filename)[0], '%Y-%m-%d_%H-%M-%S').timestamp()
+
+
+def rebuild_index(dump_dir: str) -> SearchIndex:
+    """ indexes every dump in the directory from scratch """
+    index = SearchIndex(os.path.join(dump_dir, INDEX_FILENAME))
+    index.clear()
+
+    from flat_search.data.dump import list_dumps
+    from flat_search.data.snapshot import load_dump
+    for filename in list_dumps(dump_dir):
+        properties = Property.schema().load(
+            load_dump(os.path.join(dump_dir, filename))["properties"], many=True)
+        index.add_snapshot(properties, snapshot_timestamp(filename))
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="query the full-text index over the address and description of all dumped listings")
+    parser.add_argument("query", nargs="?",
+                        help='i.e. `balcony OR "bills included"`, `-studio garden*`')
+    parser.add_argument("--dump-dir", default="data")
+    parser.add_argument("--days", type=float,
+                        help="only listings seen within this many days")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="index every existing dump from scratch first")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        index = rebuild_index(args.dump_dir)
+    else:
+        index = SearchIndex(os.path.join(args.dump_dir, INDEX_FILENAME))
+
+    if args.query:
+        since = (datetime.now() - timedelta(days=args.days)
+                 ).timestamp() if args.days else None
+        start = perf_counter()
+        results = index.query(args.query, since)
+        elapsed = perf_counter() - start
+        for listing_id, first_seen, last_seen in results:
+            print(
+                f"{listing_id}\tfirst seen: {datetime.fromtimestamp(first_seen)}\tlast seen: {datetime.fromtimestamp(last_seen)}")
+        print(f"{len(results)} listings in {elapsed * 1000:.1f}ms")
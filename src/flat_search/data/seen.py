@@ -0,0 +1,206 @@
+"""
+Persistent index of every listing id and content fingerprint ever seen, used to tell new listings from returning and reposted ones
+"""
+
+import hashlib
+import sqlite3
+from enum import Enum
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+from flat_search.data import Property
+from flat_search.data.dedup import normalize
+
+BLOOM_HASHES = 7
+
+
+class ListingStatus(Enum):
+    NEW = "new"
+    """ neither the id nor the content was seen before """
+    SEEN = "seen"
+    """ the id was in the previous snapshot """
+    RETURNING = "returning"
+    """ the id was seen before but not in the previous snapshot, i.e. a listing taken down and put back up """
+    REPOSTED = "reposted"
+    """ the id is new but the exact same content was seen under another id, which is no longer in the previous snapshot """
+
+
+class Sighting(NamedTuple):
+    status: ListingStatus
+    first_seen: Optional[float] = None
+    """ when the id, or for reposted listings the content, was first seen """
+    previous_id: Optional[str] = None
+    """ the id the content of a reposted listing was first seen under """
+
+
+def fingerprint(p: Property) -> Optional[int]:
+    """ 64 bit hash of the normalized text, bedroom count, price and first image of the listing, None if it has no text.
+
+        the text of a search result is only its address and title, the price and image tell apart flats in the same street
+    """
+    text = normalize(p)
+    if not text:
+        return None
+    image = p.image_urls[0] if p.image_urls else ""
+    digest = hashlib.blake2b(
+        f"{p.bedrooms}\n{p.price_per_month}\n{image}\n{text}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def _id_key(listing_id: str) -> bytes:
+    return b"id:" + listing_id.encode()
+
+
+def _fingerprint_key(fingerprint: int) -> bytes:
+    return b"fp:" + fingerprint.to_bytes(8, "little", signed=True)
+
+
+class BloomFilter():
+    """ set membership with false positives but no false negatives in `size` bits """
+
+    def __init__(self, size: int, bits: Optional[bytes] = None) -> None:
+        self.size = size
+        self.bits = np.frombuffer(bits, dtype=np.uint8).copy() if bits is not None \
+            else np.zeros((size + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, key: bytes) -> np.ndarray:
+        # double hashing, the k positions are h1 + i * h2
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return np.array([(h1 + i * h2) % self.size for i in range(BLOOM_HASHES)], dtype=np.int64)
+
+    def add(self, key: bytes):
+        positions = self._positions(key)
+        self.bits[positions >> 3] |= (1 << (positions & 7)).astype(np.uint8)
+
+    def __contains__(self, key: bytes) -> bool:
+        positions = self._positions(key)
+        return bool(np.all(self.bits[positions >> 3] & (1 << (positions & 7)).astype(np.uint8)))
+
+
+class SeenIndex():
+    """ the first and last time every listing id and content fingerprint was seen, stored in sqlite.
+
+        classifying a listing takes one primary key lookup for its id and at most one for its fingerprint.
+        with `bloom_bits` set a bloom filter over all ids and fingerprints, kept in the same database,
+        answers most lookups for listings never seen before without touching the tables.
+    """
+
+    def __init__(self, path: str, bloom_bits: int = 0) -> None:
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS seen_listings (
+                listing_id TEXT PRIMARY KEY,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS seen_fingerprints (
+                fingerprint INTEGER PRIMARY KEY,
+                listing_id TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS seen_snapshots (
+                timestamp REAL PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS seen_bloom_filters (
+                size INTEGER PRIMARY KEY,
+                bits BLOB NOT NULL
+            );
+        """)
+        self.bloom = self._load_bloom(bloom_bits) if bloom_bits else None
+
+    def close(self):
+        self.connection.close()
+
+    def _keys(self) -> Iterable[bytes]:
+        for (listing_id,) in self.connection.execute("SELECT listing_id FROM seen_listings"):
+            yield _id_key(listing_id)
+        for (x,) in self.connection.execute("SELECT fingerprint FROM seen_fingerprints"):
+            yield _fingerprint_key(x)
+
+    def _load_bloom(self, size: int) -> BloomFilter:
+        row = self.connection.execute(
+            "SELECT bits FROM seen_bloom_filters WHERE size = ?", (size,)).fetchone()
+        if row:
+            return BloomFilter(size, row[0])
+
+        bloom = BloomFilter(size)
+        for key in self._keys():
+            bloom.add(key)
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO seen_bloom_filters (size, bits) VALUES (?, ?)", (size, bloom.bits.tobytes()))
+        return bloom
+
+    def _maybe_seen(self, key: bytes) -> bool:
+        return self.bloom is None or key in self.bloom
+
+    def last_snapshot(self) -> Optional[float]:
+        return self.connection.execute("SELECT MAX(timestamp) FROM seen_snapshots").fetchone()[0]
+
+    def _taken_down(self, listing_id: str, last_snapshot: float) -> bool:
+        """ whether the listing is missing from the last snapshot, a listing still on the market is not reposted """
+        row = self.connection.execute(
+            "SELECT last_seen FROM seen_listings WHERE listing_id = ?", (listing_id,)).fetchone()
+        return row is None or row[0] < last_snapshot
+
+    def classify(self, properties: List[Property]) -> Dict[str, Sighting]:
+        """ classifies the listings of a snapshot against all the snapshots added before it """
+        last_snapshot = self.last_snapshot()
+        live = {p.id for p in properties}
+        sightings = {}
+        for p in properties:
+            row = None
+            if self._maybe_seen(_id_key(p.id)):
+                row = self.connection.execute(
+                    "SELECT first_seen, last_seen FROM seen_listings WHERE listing_id = ?", (p.id,)).fetchone()
+            if row:
+                first_seen, last_seen = row
+                status = ListingStatus.RETURNING if last_seen < last_snapshot else ListingStatus.SEEN
+                sightings[p.id] = Sighting(status, first_seen)
+                continue
+
+            content = fingerprint(p)
+            if content is not None and self._maybe_seen(_fingerprint_key(content)):
+                row = self.connection.execute(
+                    "SELECT listing_id, first_seen FROM seen_fingerprints WHERE fingerprint = ?", (content,)).fetchone()
+            if row and row[0] not in live and self._taken_down(row[0], last_snapshot):
+                sightings[p.id] = Sighting(
+                    ListingStatus.REPOSTED, row[1], row[0])
+            else:
+                sightings[p.id] = Sighting(ListingStatus.NEW)
+        return sightings
+
+    def add_snapshot(self, properties: List[Property], timestamp: float):
+        keys = []
+        with self.connection:
+            for p in properties:
+                self.connection.execute("""
+                    INSERT INTO seen_listings (listing_id, first_seen, last_seen) VALUES (?, ?, ?)
+                    ON CONFLICT (listing_id) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)
+                """, (p.id, timestamp, timestamp))
+                keys.append(_id_key(p.id))
+
+                content = fingerprint(p)
+                if content is None:
+                    continue
+                self.connection.execute("""
+                    INSERT INTO seen_fingerprints (fingerprint, listing_id, first_seen, last_seen) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (fingerprint) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)
+                """, (content, p.id, timestamp, timestamp))
+                keys.append(_fingerprint_key(content))
+
+            self.connection.execute(
+                "INSERT OR IGNORE INTO seen_snapshots (timestamp) VALUES (?)", (timestamp,))
+
+            # every stored filter is kept in sync, not only the one this index was opened with, or it would miss listings
+            for size, bits in self.connection.execute("SELECT size, bits FROM seen_bloom_filters").fetchall():
+                bloom = self.bloom if self.bloom is not None and self.bloom.size == size else BloomFilter(
+                    size, bits)
+                for key in keys:
+                    bloom.add(key)
+                self.connection.execute(
+                    "UPDATE seen_bloom_filters SET bits = ? WHERE size = ?", (bloom.bits.tobytes(), size))
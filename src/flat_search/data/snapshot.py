@@ -0,0 +1,153 @@
+"""
+Streaming dumps: one json line per property sorted by id, written and read without holding the whole dump in memory
+"""
+
+import heapq
+import json
+import logging
+import os
+import tempfile
+from typing import IO, Any, Dict, Iterable, Iterator, List, Tuple
+
+from flat_search.data import Property
+
+NDJSON_SUFFIX = ".ndjson"
+
+JSON_SUFFIX = ".json"
+
+SORT_CHUNK_SIZE = 10_000
+""" the number of properties sorted in memory at once when writing a snapshot, larger inputs are sorted in chunks spilled to disk """
+
+
+def is_ndjson(path: str) -> bool:
+    return path.endswith(NDJSON_SUFFIX)
+
+
+def _spill(lines: List[Tuple[str, str]], directory: str) -> IO[str]:
+    """ writes the sorted chunk to a temporary file of `<id>\\t<line>` rows, rewound for reading """
+    f = tempfile.TemporaryFile("w+", dir=directory)
+    for id, line in sorted(lines, key=lambda x: x[0]):
+        f.write(f"{json.dumps(id)}\t{line}\n")
+    f.seek(0)
+    return f
+
+
+def _read_spilled(f: IO[str]) -> Iterator[Tuple[str, str]]:
+    for row in f:
+        id, line = row.rstrip("\n").split("\t", 1)
+        yield (json.loads(id), line)
+
+
+def write_snapshot(path: str, properties: Iterable[Property], chunk_size: int = SORT_CHUNK_SIZE) -> int:
+    """ writes the properties as json lines sorted by id, returns the number written.
+
+        the properties can be a generator, at most `chunk_size` of them are held in memory: bigger inputs are sorted in
+        chunks spilled to temporary files and merged. the file is written next to the path and moved into place once complete,
+        so readers never see a partial snapshot. a repeated id keeps its first property.
+    """
+    schema = Property.schema()
+    directory = os.path.dirname(path) or "."
+    chunk: List[Tuple[str, str]] = []
+    spilled: List[IO[str]] = []
+    try:
+        for p in properties:
+            # the id of a property is a string so the json line can carry it through the sort
+            chunk.append((p.id, json.dumps(schema.dump(p))))
+            if len(chunk) >= chunk_size:
+                spilled.append(_spill(chunk, directory))
+                chunk = []
+
+        if spilled:
+            if chunk:
+                spilled.append(_spill(chunk, directory))
+            # stable on ties, chunks are merged in the order they were spilled
+            merged = heapq.merge(*[_read_spilled(f) for f in spilled], key=lambda x: x[0])
+        else:
+            merged = iter(sorted(chunk, key=lambda x: x[0]))
+
+        count = 0
+        previous = None
+        with open(path + ".tmp", "w") as f:
+            for id, line in merged:
+                if id == previous:
+                    logging.warning(f"Skipping repeated listing {id} in snapshot {path}")
+                    continue
+                f.write(line + "\n")
+                previous = id
+                count += 1
+        os.replace(path + ".tmp", path)
+        return count
+    finally:
+        for f in spilled:
+            f.close()
+
+
+def read_snapshot(path: str) -> Iterator[Dict[str, Any]]:
+    """ the properties of a snapshot as dumped, in the order of their ids """
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_snapshot_properties(path: str) -> Iterator[Property]:
+    schema = Property.schema()
+    for record in read_snapshot(path):
+        yield schema.load(record)
+
+
+def loads_dump(data: str, ndjson: bool) -> Dict[str, Any]:
+    """ the contents of a dump of either format as `{"properties": [...], "ids": {id: index}}` """
+    if not ndjson:
+        return json.loads(data)
+    properties = [json.loads(x) for x in data.splitlines() if x.strip()]
+    return {"properties": properties, "ids": {x["id"]: i for i, x in enumerate(properties)}}
+
+
+def load_dump(path: str) -> Dict[str, Any]:
+    """ the whole dump at the path in either format as `{"properties": [...], "ids": {id: index}}`, for random access """
+    with open(path, "r") as f:
+        return loads_dump(f.read(), is_ndjson(path))
+
+
+if __name__ == "__main__":
+    # peak memory of diffing two json dumps against diffing two sorted snapshots of the same listings
+    import tracemalloc
+    from datetime import datetime
+    from time import perf_counter
+
+    from flat_search.data import PropertyType
+    from flat_search.data.changes import EXCLUDED_ATTRIBUTES, generate_changes, merge_changes
+
+    N = 20_000
+    directory = tempfile.mkdtemp()
+
+    def properties(offset: int) -> Iterator[Property]:
+        for i in range(offset, N + offset):
+            yield Property(str(i), f"https://example.com/{i}", datetime.now(), PropertyType.FLAT, 1000 + i % 7 + (offset if i % 100 == 0 else 0),
+                           bedrooms=i % 4, address=f"{i} Road, London SW{i % 20}", description="a flat " * 20)
+
+    for name, offset in [("old", 0), ("new", N // 100)]:
+        write_snapshot(os.path.join(directory, name + NDJSON_SUFFIX), properties(offset), chunk_size=N // 4)
+        dump = list(properties(offset))
+        with open(os.path.join(directory, name + JSON_SUFFIX), "w") as f:
+            json.dump({"properties": Property.schema().dump(dump, many=True), "ids": {x.id: i for i, x in enumerate(dump)}}, f, indent=4)
+        del dump
+
+    def measure(diff) -> None:
+        tracemalloc.start()
+        start = perf_counter()
+        changes = diff()
+        seconds = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        print(f"  {seconds:.2f}s, peak {peak:.1f}MiB, appended: {len(changes.appended)}, removed: {len(changes.removed)}, modified: {len(changes.modified)}")
+
+    size = os.path.getsize(os.path.join(directory, "new" + JSON_SUFFIX)) / 2**20
+    print(f"{N} listings, {size:.1f}MiB per json dump")
+    print("json dumps, generate_changes:")
+    measure(lambda: generate_changes(load_dump(os.path.join(directory, "old" + JSON_SUFFIX)),
+                                     load_dump(os.path.join(directory, "new" + JSON_SUFFIX)), EXCLUDED_ATTRIBUTES))
+    print("ndjson snapshots, merge_changes:")
+    measure(lambda: merge_changes(read_snapshot(os.path.join(directory, "old" + NDJSON_SUFFIX)),
+                                  read_snapshot(os.path.join(directory, "new" + NDJSON_SUFFIX)), EXCLUDED_ATTRIBUTES, keep_values=False)[0])
@@ -1,27 +1,22 @@
 import datetime
 import logging
 import os
-from typing import List
+from typing import Dict, List, Optional
 from flat_search.data import Property
 from flat_search.data.changes import PropertyChanges
+from flat_search.data.price_history import PriceDrop
 
 from flat_search.settings import Settings
 
+from flat_search.email.service import email_service, get_template
+
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import smtplib
-import ssl
-import jinja2
-import os
 
 
-def generate_email(settings: Settings, changes: PropertyChanges, old_properties: List[Property], properties: List[Property]):
+def generate_email(settings: Settings, changes: PropertyChanges, old_properties: List[Property], properties: List[Property], price_drops: Dict[str, PriceDrop] = None):
 
-    template_loader = jinja2.FileSystemLoader(
-        searchpath=os.path.dirname(settings.email_template))
-    template_env = jinja2.Environment(loader=template_loader)
-    template_file = os.path.basename(settings.email_template)
-    template = template_env.get_template(template_file)
+    template = get_template(settings.email_template)
 
     properties_dict = {x.id: x for x in properties}
     old_properties_dict = {x.id: x for x in old_properties}
@@ -34,84 +29,59 @@ def generate_email(settings: Settings, changes: PropertyChanges, old_properties:
 
     updated = [{"value": properties_dict[id], "updates": changes, "added": False, "removed": False}
                for id, changes in changes.modified.items()]
+
+    relisted = [{"value": properties_dict[id], "updates": [], "added": False, "removed": False, "relisted_from": ids}
+                for id, ids in changes.relisted.items()]
+
+    returning = [{"value": properties_dict[id], "updates": [], "added": False, "removed": False, "first_seen": datetime.datetime.fromtimestamp(first_seen)}
+                 for id, first_seen in changes.returning.items()]
+    entries = [*added, *removed, *updated, *relisted, *returning]
+    for entry in entries:
+        drop = (price_drops or {}).get(entry["value"].id)
+        if drop:
+            entry["price_drop"] = {"peak": drop.peak, "price": drop.price,
+                                   "dropped_at": datetime.datetime.fromtimestamp(drop.dropped_at)}
+
     template = template.render(
-        properties=[*added, *removed, *updated], date=datetime.datetime.now())
-    logging.info(f"template generated: {template}")
+        properties=entries, date=datetime.datetime.now())
+    logging.info("template generated: %d characters for %d properties",
+                 len(template), len(entries))
+    logging.debug("template generated: %s", template)
     return template
 
 
-def send_property_updates_email(settings: Settings, changes: PropertyChanges, old_properties: List[Property],  properties: List[Property]):
-    """ sends the diff from the last scrape to the defined userbase """
+def send_property_updates_email(settings: Settings, changes: PropertyChanges, old_properties: List[Property],  properties: List[Property], price_drops: Dict[str, PriceDrop] = None):
+    """ queues the diff from the last scrape to be sent to the defined userbase, mentioning how far the price of any listing in `price_drops` has dropped """
 
     logging.info("Sending change emails")
 
-    smtp_server = "smtp.gmail.com"  # for Gmail
-    port = 587  # For starttls
-
-    login = os.getenv("SMTP_LOGIN")
-    password = os.getenv("SMTP_PASSWORD")
     msg = MIMEMultipart()
     msg["Subject"] = f"New property updates for {datetime.datetime.now().strftime('%H:%M - %A, %B')}"
-    msg["From"] = login
     msg['To'] = ", ".join(settings.email_recipients)
 
     body_html = MIMEText(generate_email(
-        settings, changes, old_properties, properties), 'html')
+        settings, changes, old_properties, properties, price_drops), 'html')
     msg.attach(body_html)  # attaching to msg
 
-    context = ssl.create_default_context()
-    # Try to log in to server and send email
-    try:
-        server = smtplib.SMTP(smtp_server, port)
-        server.ehlo()  # check connection
-        server.starttls(context=context)  # Secure the connection
-        server.ehlo()  # check connection
-        server.login(login, password)
-
-        # Send email here
-        server.sendmail(login, settings.email_recipients, msg.as_string())
+    email_service().send(msg, settings.email_recipients)
 
-    except Exception as e:
-        # Print any error messages
-        logging.exception("Exception in sending email")
-    finally:
-        server.quit()
 
-
-def send_error_email(settings: Settings, proxy: "flat_search.backends.Proxy", exception: Exception):
-    """ sends the diff from the last scrape to the defined userbase """
+def send_error_email(settings: Settings, proxy: Optional["flat_search.backends.Proxy"], exception: Exception):
+    """ queues an email about a failed scrape, or a run gone wrong without a proxy to blame, to be sent to the defined userbase """
 
     logging.info("Sending error email")
 
-    smtp_server = "smtp.gmail.com"  # for Gmail
-    port = 587  # For starttls
-
-    login = os.getenv("SMTP_LOGIN")
-    password = os.getenv("SMTP_PASSWORD")
     msg = MIMEMultipart()
     msg["Subject"] = f"Property Errors! for {datetime.datetime.now().strftime('%H:%M - %A, %B')}"
-    msg["From"] = login
     msg['To'] = ", ".join(settings.email_recipients)
 
-    body_html = MIMEText(
-        f"error in property updates, proxy {proxy.url.geturl() if proxy else ''} set to failure, exception: {exception}")
+    if proxy:
+        body_html = MIMEText(
+            f"error in property updates, proxy {proxy.url.geturl()} set to failure, exception: {exception}")
+    else:
+        body_html = MIMEText(
+            f"error in property updates, exception: {exception}")
 
     msg.attach(body_html)  # attaching to msg
 
-    context = ssl.create_default_context()
-    # Try to log in to server and send email
-    try:
-        server = smtplib.SMTP(smtp_server, port)
-        server.ehlo()  # check connection
-        server.starttls(context=context)  # Secure the connection
-        server.ehlo()  # check connection
-        server.login(login, password)
-
-        # Send email here
-        server.sendmail(login, settings.email_recipients, msg.as_string())
-
-    except Exception as e:
-        # Print any error messages
-        logging.exception("Exception in sending email")
-    finally:
-        server.quit()
+    email_service().send(msg, settings.email_recipients)
@@ -0,0 +1,199 @@
+"""
+Template compilation cache and a background email sender reusing one authenticated SMTP connection
+"""
+
+import atexit
+import logging
+import os
+import queue
+import smtplib
+import ssl
+import threading
+from email.mime.multipart import MIMEMultipart
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from flat_search.exporter import EMAIL_QUEUE
+
+SMTP_TIMEOUT = 30
+""" the seconds a blocking SMTP operation may take before it fails """
+
+EXIT_FLUSH_TIMEOUT = 60
+""" the seconds the process waits for queued emails when it exits, emails still queued after that are dropped """
+
+if TYPE_CHECKING:
+    import jinja2
+
+_environments: Dict[str, "jinja2.Environment"] = {}
+_environments_lock = threading.Lock()
+
+
+def get_template(path: str) -> "jinja2.Template":
+    """ the compiled template at the path.
+
+        one environment is kept per template directory so each template is only compiled once per process,
+        compiled bytecode is also cached on disk across processes and a template is recompiled when its file changes.
+    """
+    import jinja2
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with _environments_lock:
+        environment = _environments.get(directory)
+        if environment is None:
+            environment = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(searchpath=directory),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(),
+                # checks the mtime of the file every time the template is fetched
+                auto_reload=True)
+            _environments[directory] = environment
+    return environment.get_template(os.path.basename(path))
+
+
+class EmailService():
+    """ sends emails from a background thread over a single SMTP connection.
+
+        the connection is opened and logged into when the first message of a run is sent, reused for every message queued
+        while it is open and closed once no message was queued for `idle_timeout` seconds.
+        the host, port and whether to use starttls default to gmail and can be overridden i.e. to point at a local SMTP server in development.
+        every SMTP operation fails after `timeout` seconds so a hung server can't stall the sender.
+    """
+
+    def __init__(self, host: str = "smtp.gmail.com", port: int = 587, login: Optional[str] = None, password: Optional[str] = None,
+                 starttls: bool = True, idle_timeout: float = 60, timeout: float = SMTP_TIMEOUT) -> None:
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.starttls = starttls
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.queue: "queue.Queue[Optional[Tuple[MIMEMultipart, List[str]]]]" = queue.Queue()
+        self.server: Optional[smtplib.SMTP] = None
+        self.sent = 0
+        self.connections = 0
+        self.thread = threading.Thread(
+            target=self._run, name="email-sender", daemon=True)
+        self.thread.start()
+
+    def from_env() -> "EmailService":
+        """ configured from the `SMTP_*` environment variables """
+        return EmailService(host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
+                            port=int(os.getenv("SMTP_PORT", "587")),
+                            login=os.getenv("SMTP_LOGIN"),
+                            password=os.getenv("SMTP_PASSWORD"),
+                            starttls=os.getenv("SMTP_STARTTLS", "true").lower() != "false",
+                            timeout=float(os.getenv("SMTP_TIMEOUT", SMTP_TIMEOUT)))
+
+    def send(self, msg: MIMEMultipart, recipients: List[str]):
+        """ queues the message, it is sent in the background """
+        if msg["From"] is None:
+            msg["From"] = self.login
+        self.queue.put((msg, recipients))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """ blocks until every message queued so far was sent or failed, or for at most `timeout` seconds.
+            returns whether the queue was emptied, otherwise the messages still queued are dropped and logged
+        """
+        waiter = threading.Thread(
+            target=self.queue.join, name="email-flush", daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        if not waiter.is_alive():
+            return True
+
+        dropped = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                dropped.append(item[0]["Subject"])
+            self.queue.task_done()
+        logging.error(
+            f"Gave up waiting {timeout}s for emails to be sent, dropped {len(dropped)} queued emails: {dropped}")
+        return False
+
+    def close(self):
+        """ sends the queued messages then stops the sender and closes the connection """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            if self.starttls:
+                server.starttls(context=ssl.create_default_context())
+                server.ehlo()
+            # local stand-in servers usually don't support auth
+            if self.login and self.password:
+                server.login(self.login, self.password)
+        except:
+            server.close()
+            raise
+        self.connections += 1
+        logging.debug(f"Opened SMTP connection to {self.host}:{self.port}")
+        return server
+
+    def _disconnect(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+        logging.debug(f"Closed SMTP connection to {self.host}:{self.port}")
+
+    def _deliver(self, msg: MIMEMultipart, recipients: List[str]):
+        for attempt in range(2):
+            if self.server is None:
+                self.server = self._connect()
+            try:
+                self.server.sendmail(msg["From"], recipients, msg.as_string())
+                self.sent += 1
+                return
+            except smtplib.SMTPServerDisconnected:
+                # the server dropped the connection while it was idle, reconnect once
+                self.server = None
+                if attempt:
+                    raise
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(
+                    timeout=self.idle_timeout if self.server is not None else None)
+            except queue.Empty:
+                self._disconnect()
+                continue
+
+            try:
+                if item is None:
+                    self._disconnect()
+                    return
+                msg, recipients = item
+                logging.info(
+                    f"Sending email: {msg['Subject']} to {recipients}")
+                self._deliver(msg, recipients)
+            except Exception:
+                logging.exception("Exception in sending email")
+                self._disconnect()
+            finally:
+                self.queue.task_done()
+
+
+_service: Optional[EmailService] = None
+_service_lock = threading.Lock()
+
+
+def email_service() -> EmailService:
+    """ the email service shared by the whole process, created from the environment on first use """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = EmailService.from_env()
+            EMAIL_QUEUE.set_function(_service.queue.qsize)
+            # don't lose queued emails when the process exits, without a hung server keeping it from exiting
+            atexit.register(_service.flush, EXIT_FLUSH_TIMEOUT)
+        return _service
@@ -0,0 +1,242 @@
+"""
+Counters, gauges and histograms of the long running scheduler in the prometheus text format, served over http from a background thread
+"""
+
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import monotonic, perf_counter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from flat_search.settings import settings_cache_stats
+
+MIN_RENDER_INTERVAL = 1
+""" the seconds a rendering of the metrics is served for, scrapes more frequent than this cost nothing """
+
+Sample = Tuple[str, Dict[str, str], float]
+""" the suffix of the metric name, the labels and the value of one line of the exposition """
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_sample(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        name = name + "{" + ",".join(f'{k}="{escape_label(str(v))}"' for k, v in labels.items()) + "}"
+    if value == float("inf"):
+        return f"{name} +Inf"
+    return f"{name} {float(value)!r}"
+
+
+class Metric():
+    """ a named metric with a value per combination of its label values """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        assert set(labels) == set(self.labels), \
+            f"{self.name} takes the labels {self.labels}, got {tuple(labels)}"
+        return tuple(str(labels[x]) for x in self.labels)
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        lines.extend(format_sample(self.name + suffix, labels, value)
+                     for suffix, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    """ a value which only goes up """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), function: Callable[[], float] = None) -> None:
+        """
+            function -- reads the value when the metrics are rendered instead of it being counted here, only without labels
+        """
+        super().__init__(name, help, labels)
+        self.function = function
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[Sample]:
+        if self.function:
+            return [("", {}, self.function())]
+        with self.lock:
+            return [("", dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """ a value which goes up and down, set directly or read from a function when the metrics are rendered """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.function: Optional[Callable[[], Optional[float]]] = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function: Optional[Callable[[], Optional[float]]]):
+        """ reads the value from the function, which returns None while there is no value, only without labels """
+        self.function = function
+
+    def samples(self) -> List[Sample]:
+        if self.function:
+            value = self.function()
+            return [] if value is None else [("", {}, value)]
+        with self.lock:
+            return [("", dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    """ counts of observed values in cumulative buckets along with their sum and count """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = sorted(buckets)
+        # per label values: the count of each bucket (not cumulative, the last one being +Inf), the sum and the count
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def time(self, function: Callable[..., Any], **labels) -> Callable[..., Any]:
+        """ wraps the function so the seconds every call takes are observed """
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(perf_counter() - start, **labels)
+        return wrapper
+
+    def samples(self) -> List[Sample]:
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bound, count in zip([*self.buckets, float("inf")], counts):
+                    cumulative += count
+                    samples.append(("_bucket", {**labels, "le": "+Inf" if bound == float("inf") else repr(float(bound))},
+                                    cumulative))
+                samples.append(("_sum", labels, total[0]))
+                samples.append(("_count", labels, cumulative))
+        return samples
+
+
+class MetricsRegistry():
+    """ the metrics of the process, rendered at most once every `min_render_interval` seconds however often they are scraped """
+
+    def __init__(self, min_render_interval: float = MIN_RENDER_INTERVAL) -> None:
+        self.metrics: List[Metric] = []
+        self.min_render_interval = min_render_interval
+        self.lock = threading.Lock()
+        self._rendered: Optional[Tuple[float, bytes]] = None
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> bytes:
+        with self.lock:
+            if self._rendered and monotonic() - self._rendered[0] < self.min_render_interval:
+                return self._rendered[1]
+            lines = []
+            for metric in self.metrics:
+                try:
+                    lines.extend(metric.render())
+                except Exception:
+                    logging.exception(f"Exception in rendering {metric.name}")
+            rendered = ("\n".join(lines) + "\n").encode()
+            self._rendered = (monotonic(), rendered)
+            return rendered
+
+
+REGISTRY = MetricsRegistry()
+
+RUNS = REGISTRY.register(Counter(
+    "flat_search_runs_total", "runs triggered by the scheduler by outcome: ok, failed or skipped", ["profile", "status"]))
+RUN_SECONDS = REGISTRY.register(Histogram(
+    "flat_search_run_duration_seconds", "the duration of runs which were not skipped",
+    [30, 60, 120, 300, 600, 1200, 1800, 3600], ["profile"]))
+PAGES_PER_RUN = REGISTRY.register(Histogram(
+    "flat_search_pages_per_run", "listing pages walked by a run", [0, 1, 2, 5, 10, 20, 50, 100]))
+LISTINGS_PER_RUN = REGISTRY.register(Histogram(
+    "flat_search_listings_per_run", "listings parsed by a run", [0, 10, 25, 50, 100, 250, 500, 1000, 2500]))
+PARSE_SECONDS = REGISTRY.register(Histogram(
+    "flat_search_page_parse_seconds", "the time taken to parse one listing page", [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5]))
+SCHEDULED_SEARCHES = REGISTRY.register(Gauge(
+    "flat_search_scheduled_searches", "searches waiting for their next trigger"))
+RUNNING_SEARCHES = REGISTRY.register(Gauge(
+    "flat_search_running_searches", "runs in progress"))
+NEXT_TRIGGER_SECONDS = REGISTRY.register(Gauge(
+    "flat_search_next_trigger_seconds", "seconds until the earliest scheduled trigger"))
+EMAIL_QUEUE = REGISTRY.register(Gauge(
+    "flat_search_email_queue_depth", "emails queued and not yet sent"))
+API_CACHE = REGISTRY.register(Counter(
+    "flat_search_api_cache_requests_total", "api requests answered from the response cache (hit) or rendered (miss)", ["result"]))
+SETTINGS_READS = REGISTRY.register(Counter(
+    "flat_search_settings_reads_total", "settings read through the settings cache", function=lambda: settings_cache_stats()[0]))
+SETTINGS_PARSES = REGISTRY.register(Counter(
+    "flat_search_settings_parses_total", "settings reads which missed the cache and parsed the file", function=lambda: settings_cache_stats()[1]))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logging.debug("metrics endpoint: " + format, *args)
+
+
+def start_metrics_server(host: str, port: int, registry: MetricsRegistry = REGISTRY) -> HTTPServer:
+    """ serves the metrics at `http://<host>:<port>/metrics` from a daemon thread.
+
+        requests are handled one at a time so a burst of scrapes queues up rather than competing with the runs.
+    """
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    server = HTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever,
+                     name="metrics-server", daemon=True).start()
+    logging.info(
+        f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,158 @@
+"""
+Lazily formatted log payloads, structured log events and a background log writer
+"""
+
+import atexit
+import copy
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Iterable, List, Optional
+
+SUMMARY_LIMIT = 5
+""" the number of items of a collection shown by a `Summary` by default """
+
+
+class Lazy():
+    """ log argument computed only if the record is emitted, i.e. `logging.debug("ids: %s", Lazy(lambda: [x.id for x in xs]))` """
+
+    def __init__(self, compute: Callable[[], Any]) -> None:
+        self.compute = compute
+
+    def __str__(self) -> str:
+        return str(self.compute())
+
+
+class Summary():
+    """ log argument showing the size of a collection and its first few items, only described if the record is emitted """
+
+    def __init__(self, items: Iterable[Any], describe: Callable[[Any], str] = str, limit: Optional[int] = SUMMARY_LIMIT) -> None:
+        self.items = items
+        self.describe = describe
+        self.limit = limit
+
+    def __str__(self) -> str:
+        items = list(self.items)
+        shown = items if self.limit is None else items[:self.limit]
+        described = ", ".join(self.describe(x) for x in shown)
+        if len(shown) == len(items):
+            return f"{len(items)} items: [{described}]"
+        return f"{len(items)} items: [{described}, ... {len(items) - len(shown)} more]"
+
+
+def log_event(event: str, level: int = logging.INFO, logger: logging.Logger = None, **fields):
+    """ logs a named event with structured fields, nothing is formatted unless the level is enabled.
+
+        text handlers show `event key=value ...`, the `StructuredFormatter` writes the event and fields as json.
+    """
+    logger = logger or logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, "%s %s", event, Lazy(lambda: " ".join(f"{k}={v}" for k, v in fields.items())),
+               extra={"event": event, "fields": fields})
+
+
+class StructuredFormatter(logging.Formatter):
+    """ formats records as json lines, with the event name and fields of records logged through `log_event` """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+        }
+        event = getattr(record, "event", None)
+        if event:
+            data["event"] = event
+            data.update(getattr(record, "fields", {}))
+        else:
+            data["message"] = record.getMessage()
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """ queue handler leaving the formatting of records to the listener's handlers.
+
+        the message is merged with its arguments on the logging thread, as arguments like `Lazy` may only be safe to evaluate there,
+        while timestamps, json encoding, tracebacks and the writes themselves happen on the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_listener: Optional[QueueListener] = None
+
+
+def start_background_logging(root: logging.Logger = None) -> QueueListener:
+    """ moves the handlers of the root logger behind a queue written out by a background thread, does nothing if already started """
+    global _listener
+    root = root or logging.getLogger()
+    if _listener is not None:
+        return _listener
+
+    handlers: List[logging.Handler] = list(root.handlers)
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue()
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+    _listener.start()
+    # write out what's still queued at exit
+    atexit.register(stop_background_logging)
+    return _listener
+
+
+def stop_background_logging():
+    """ writes out the queued records and stops the background thread, the handlers stay behind the queue """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+if __name__ == "__main__":
+    # overhead benchmark: the same records written straight to a file, then through the queue, and disabled records
+    import os
+    import tempfile
+    from time import perf_counter
+
+    N = 20_000
+    items = [f"listing_{x}" for x in range(500)]
+
+    def run(logger: logging.Logger) -> float:
+        start = perf_counter()
+        for i in range(N):
+            logger.info("dumping properties to %s: %s",
+                        "data/x.json", Summary(items))
+        return (perf_counter() - start) / N * 1e6
+
+    directory = tempfile.mkdtemp()
+    direct = logging.getLogger("direct")
+    direct.propagate = False
+    direct.addHandler(logging.FileHandler(os.path.join(directory, "direct")))
+    direct.setLevel(logging.INFO)
+    print(f"direct file handler:   {run(direct):.1f}us per record")
+
+    queued = logging.getLogger("queued")
+    queued.propagate = False
+    queued.addHandler(logging.FileHandler(os.path.join(directory, "queued")))
+    queued.setLevel(logging.INFO)
+    start_background_logging(queued)
+    print(f"background writer:     {run(queued):.1f}us per record on the logging thread")
+    stop_background_logging()
+
+    queued.setLevel(logging.WARNING)
+    print(f"disabled, lazy args:   {run(queued):.2f}us per record")
+    start = perf_counter()
+    for i in range(N):
+        queued.info(f"dumping properties to data/x.json: {items}")
+    print(
+        f"disabled, f-string:    {(perf_counter() - start) / N * 1e6:.2f}us per record")
@@ -0,0 +1,125 @@
+import asyncio
+import datetime
+import heapq
+import logging
+from itertools import count
+from time import perf_counter
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from croniter import croniter
+
+from flat_search.exporter import NEXT_TRIGGER_SECONDS, RUN_SECONDS, RUNNING_SEARCHES, RUNS, SCHEDULED_SEARCHES
+from flat_search.settings import SearchProfile, Settings
+from flat_search.util import binomial_trial, random_in_range
+
+
+class SearchScheduler():
+    """ runs many saved searches from a single event loop.
+
+        keeps a priority queue of the next (randomized) cron trigger of every search and sleeps until the earliest one,
+        so an idle search costs a single heap entry. Triggered runs execute concurrently but never more than
+        `max_concurrent_sessions` at a time, each run holding one of the shared browser session slots for its duration.
+    """
+
+    def __init__(self, profiles: List[SearchProfile], run: Callable[[SearchProfile, Settings], Awaitable[None]], max_concurrent_sessions: int = 1) -> None:
+        """
+            profiles -- the searches to schedule
+            run -- the coroutine executing one run of a search with its freshly loaded settings
+            max_concurrent_sessions -- the maximum number of runs (and therefore browser sessions) active at once
+        """
+        assert (max_concurrent_sessions >= 1)
+        self.run = run
+        self.max_concurrent_sessions = max_concurrent_sessions
+        # created by `run_forever`, before python 3.10 a semaphore binds to the event loop current when it's created
+        self.sessions: Optional[asyncio.Semaphore] = None
+        self.queue: List[Tuple[datetime.datetime, int, SearchProfile]] = []
+        self.running: set = set()
+        self.active_profiles: set = set()
+        # tie breaker so profiles themselves are never compared
+        self._sequence = count()
+
+        for profile in profiles:
+            self.schedule(profile, datetime.datetime.now())
+
+        # read when the metrics are scraped, costs nothing in between
+        SCHEDULED_SEARCHES.set_function(lambda: len(self.queue))
+        RUNNING_SEARCHES.set_function(lambda: len(self.running))
+        NEXT_TRIGGER_SECONDS.set_function(self.next_trigger_seconds)
+
+    def next_trigger_seconds(self) -> Optional[float]:
+        """ the seconds until the earliest trigger, None if nothing is scheduled """
+        if not self.queue:
+            return None
+        return max(0, (self.queue[0][0] - datetime.datetime.now()).total_seconds())
+
+    def next_trigger(self, settings: Settings, after: datetime.datetime) -> datetime.datetime:
+        """ the next cron trigger after the given date with the random variation of the search added """
+        next_date: datetime.datetime = croniter(settings.cron_expression, after).get_next(
+            ret_type=datetime.datetime)
+        random_minutes = random_in_range(
+            0, settings.cron_expression_variation)
+        return next_date + datetime.timedelta(minutes=random_minutes)
+
+    def schedule(self, profile: SearchProfile, after: datetime.datetime):
+        """ loads the settings of the profile and pushes its next trigger onto the queue """
+        settings = profile.load()
+        trigger = self.next_trigger(settings, after)
+        logging.info(f"[{profile.name}] Next trigger: {trigger}")
+        heapq.heappush(self.queue, (trigger, next(self._sequence), profile))
+
+    async def _execute(self, profile: SearchProfile):
+        try:
+            # load settings each time in case they change, this lets us change things in between runs
+            settings = profile.load()
+
+            if binomial_trial(settings.cron_expression_skip_chance):
+                logging.info(f"[{profile.name}] Skipping...")
+                RUNS.inc(profile=profile.name, status="skipped")
+                return
+
+            async with self.sessions:
+                logging.info(f"[{profile.name}] Executing run")
+                start = perf_counter()
+                try:
+                    await self.run(profile, settings)
+                finally:
+                    RUN_SECONDS.observe(
+                        perf_counter() - start, profile=profile.name)
+            RUNS.inc(profile=profile.name, status="ok")
+        except Exception as E:
+            logging.error(
+                f"[{profile.name}] Exception in scraping run.")
+            logging.exception(E)
+            RUNS.inc(profile=profile.name, status="failed")
+        finally:
+            self.active_profiles.discard(profile.name)
+
+    async def run_forever(self):
+        """ sleeps until the earliest trigger, starts its run in the background and reschedules the search """
+        self.sessions = asyncio.Semaphore(self.max_concurrent_sessions)
+        while self.queue:
+            trigger, _, profile = self.queue[0]
+            sleep_time = (trigger - datetime.datetime.now()).total_seconds()
+            if sleep_time > 0:
+                logging.info(
+                    f"Sleeping for {datetime.timedelta(seconds=sleep_time)} until [{profile.name}]")
+                await asyncio.sleep(sleep_time)
+                continue
+
+            heapq.heappop(self.queue)
+            if profile.name in self.active_profiles:
+                # dumps and diffs of a search must not be written by two runs at once
+                logging.info(
+                    f"[{profile.name}] Previous run still in progress, skipping trigger")
+            else:
+                self.active_profiles.add(profile.name)
+                task = asyncio.create_task(self._execute(profile))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+            try:
+                self.schedule(profile, trigger)
+            except Exception as E:
+                logging.error(
+                    f"[{profile.name}] Could not load settings, search will no longer be scheduled.")
+                logging.exception(E)
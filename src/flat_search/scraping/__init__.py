@@ -4,7 +4,7 @@ from typing import List, Tuple
 
 from selenium.webdriver.remote.webdriver import WebDriver
 
-from flat_search.util import binomial_trial, sleep_random_range
+from flat_search.util import async_sleep_random_range, binomial_trial, run_blocking, sleep_random_range
 
 
 class FailureBehaviour(Enum):
@@ -121,3 +121,62 @@ class ScrapeStrategy():
             return "[" + ",".join([x.__str__() for x in self.steps]) + "]"
         else:
             return self.name
+
+
+class AsyncScrapeStrategy(ScrapeStrategy):
+    """ asynchronous counterpart of `ScrapeStrategy`.
+
+        delays are awaited rather than slept and WebDriver calls are offloaded to the default executor,
+        so several independent sessions can interleave on a single event loop.
+        `FailureBehaviour` and `SkipBehaviour` are interpreted exactly as in `ScrapeStrategy.execute_strategy`.
+    """
+
+    async def execute_strategy(self, driver: WebDriver, level=0) -> bool:
+        """ execute the strategy. return the status of execution, see `ScrapeStrategy.execute_strategy` """
+        assert driver
+
+        if self.steps:
+            level += 1
+
+            strategy_idx = 0
+
+            while strategy_idx + 1 <= len(self.steps):
+                title = await run_blocking(lambda: driver.title)
+                logging.info(
+                    f"{self.log_prefix(level,step=(strategy_idx,len(self.steps)))}Executing step: {strategy_idx + 1} of strategy: {self.name} from page: `{title}`")
+                strategy = self.steps[strategy_idx]
+
+                await async_sleep_random_range(*self.delay)
+
+                if binomial_trial(strategy.probability):
+                    logging.info(
+                        f"{self.log_prefix(level)}Executing: {strategy.name}")
+                    success = await strategy.execute_strategy(driver, level=level)
+
+                    if success or strategy.on_fail == FailureBehaviour.SKIP:
+                        strategy_idx += 1
+                    elif strategy.on_fail == FailureBehaviour.BREAK:
+                        return False
+                else:
+                    logging.info(
+                        f"{self.log_prefix(level)}Skipping strategy {strategy.name} with probability {strategy.probability}")
+                    if strategy.on_skip == SkipBehaviour.BREAK:
+                        logging.info(
+                            f"{self.log_prefix(level)}Skipping rest of the steps as well due to skip behaviour")
+                        break
+                    else:
+                        strategy_idx += 1
+
+            return True
+        else:
+            try:
+                await self._strategy(driver, level + 1)
+                return True
+            except Exception as E:
+                logging.exception(
+                    f"Error in strategy : {self}.")
+                return False
+
+    async def _strategy(self, driver: WebDriver, level: int = 0):
+        """ the awaitable strategy to be implemented by each individual implementation """
+        raise NotImplementedError()
@@ -0,0 +1,117 @@
+import logging
+from typing import *
+from flat_search.scraping import AsyncScrapeStrategy, ScrapeStrategy
+from flat_search.scraping.strategy import ArbitraryStrategy, EnterPropertyQuery, ListingPageRandomWalk, LoopWhile, NavigateTo, PagedPropertyListingStrategy
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.common.keys import Keys
+from flat_search.util import async_sleep_random_range, binomial_trial, random_in_range, run_blocking
+
+
+class AsyncArbitraryStrategy(AsyncScrapeStrategy, ArbitraryStrategy):
+    """ scraping strategy backed by a lambda, the lambda is run in the executor """
+
+    async def _strategy(self, driver: WebDriver, level: int):
+        await run_blocking(self.behaviour, driver)
+
+
+class AsyncLoopWhile(AsyncScrapeStrategy, LoopWhile):
+    """ asynchronous `LoopWhile`, condition and cleanup are run in the executor """
+
+    async def execute_strategy(self, driver: WebDriver, level=0) -> bool:
+        try:
+            while await run_blocking(self.condition, driver, self.index, level):
+                logging.info(
+                    f"{self.log_prefix(level)}Condition satisfied, looping for the {self.ordinal(self.index + 1)} time")
+                if not await super().execute_strategy(driver, level + 1):
+                    return False
+                await run_blocking(self.cleanup, driver, self.index, level)
+                if self.delay:
+                    await async_sleep_random_range(*self.delay)
+                self.index += 1
+            else:
+                logging.info(
+                    f"{self.log_prefix(level)}Condition failed, breaking loop")
+            return True
+        except Exception as E:
+            logging.exception(
+                f"Exception in LoopUntill cleanup or condition function")
+            return False
+
+
+class AsyncNavigateTo(AsyncScrapeStrategy, NavigateTo):
+    """ Navigate to arbitrary url without blocking the event loop """
+
+    async def _strategy(self, driver: WebDriver, level: int):
+        await run_blocking(driver.get, self.url)
+
+
+class AsyncEnterPropertyQuery(AsyncScrapeStrategy, EnterPropertyQuery):
+    """ asynchronous `EnterPropertyQuery`, the whole interaction is a chain of WebDriver calls so it runs in the executor """
+
+    async def _strategy(self, driver: WebDriver, level: int):
+        await run_blocking(EnterPropertyQuery._strategy, self, driver, level)
+
+
+class AsyncListingPageRandomWalk(AsyncScrapeStrategy, ListingPageRandomWalk):
+    """ asynchronous `ListingPageRandomWalk`, WebDriver calls run in the executor and the `looking` delays are awaited """
+
+    async def _strategy(self, driver: WebDriver, level: int):
+        index = 0
+        listings = []
+        while True:
+
+            if not listings:
+                logging.info(
+                    f"{self.log_prefix(level)}waiting for listing elements")
+                await run_blocking(WebDriverWait(driver, 10).until,
+                                   expected_conditions.presence_of_all_elements_located(self.listing_locator))
+
+                listings = await run_blocking(driver.find_elements, *self.listing_locator)
+                logging.info(
+                    f"{self.log_prefix(level)}Using locator: {self.listing_locator} found: {len(listings)} listings")
+
+            if index + 1 > len(listings):
+                break
+
+            listing = listings[index]
+            #  scroll to the listing
+            listing_id = await run_blocking(listing.get_property, 'id')
+            logging.info(
+                f"{self.log_prefix(level)}Scrolling to: {listing_id}")
+
+            await run_blocking(ActionChains(driver).scroll_to_element(
+                listing).pause(random_in_range(0.1, 0.5)).perform)
+            index += 1
+            if binomial_trial(self.listing_look_probability):
+                logging.info(
+                    f"{self.log_prefix(level)}Looking closer at: {listing_id}")
+                #  look at it a wee while
+                await async_sleep_random_range(*self.look_delay)
+
+                if binomial_trial(self.listing_click_probability):
+                    logging.info(
+                        f"{self.log_prefix(level)}Clicking: {listing_id}")
+                    #  the action equivalent doesn't work
+                    await run_blocking(listing.click)
+                    await async_sleep_random_range(4, 6)
+                    await run_blocking(ActionChains(driver).send_keys(Keys.ARROW_DOWN).perform)
+                    await async_sleep_random_range(0.1, 0.7)
+                    await run_blocking(ActionChains(driver).send_keys(Keys.ARROW_UP).perform)
+                    await async_sleep_random_range(0.1, 0.7)
+
+                    logging.info(
+                        f"{self.log_prefix(level)}Going back")
+                    await run_blocking(driver.back)
+                    await async_sleep_random_range(2, 5)
+                    listings = []
+
+
+class AsyncPagedPropertyListingStrategy(AsyncScrapeStrategy, PagedPropertyListingStrategy):
+    """ asynchronous `PagedPropertyListingStrategy`, builds the same tree out of the asynchronous strategies """
+
+    def node_types(self) -> Tuple[type, type, type, type, type]:
+        return (AsyncScrapeStrategy, AsyncEnterPropertyQuery, AsyncLoopWhile, AsyncArbitraryStrategy, AsyncListingPageRandomWalk)
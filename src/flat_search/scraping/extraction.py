@@ -0,0 +1,97 @@
+"""
+Declarative extraction of `Property` fields from parsed listing html
+"""
+
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from bs4 import Tag
+
+Step = Callable[[Any], Optional[Any]]
+
+
+def find(*args, **kwargs) -> Step:
+    """ selector step returning the first descendant matching the `BeautifulSoup.find` arguments or None """
+    return lambda tag: tag.find(*args, **kwargs)
+
+
+def find_all(*args, **kwargs) -> Step:
+    """ selector step returning all the descendants matching the `BeautifulSoup.find_all` arguments """
+    return lambda tag: tag.find_all(*args, **kwargs)
+
+
+def next_sibling(*args, **kwargs) -> Step:
+    """ selector step returning the next sibling matching the `BeautifulSoup.find_next_sibling` arguments or None """
+    return lambda tag: tag.find_next_sibling(*args, **kwargs)
+
+
+def to_int(text: str) -> Optional[int]:
+    """ parses a plain non-negative integer, returns None rather than raising if the text isn't one """
+    text = text.strip()
+    return int(text) if text.isdigit() else None
+
+
+@dataclass
+class FieldSpec():
+    """ describes how to extract one field of a listing """
+
+    selector: Sequence[Step]
+    """ the steps applied in order starting at the listing element, a step returning None means the field is missing """
+
+    transform: Optional[Callable[[Any], Optional[Any]]] = None
+    """ post-processing of the selected value, returning None means the field is missing """
+
+    default: Any = None
+    """ the value of the field when it is missing """
+
+    required: bool = False
+    """ if set a missing field raises a ValueError instead of taking the default """
+
+
+class MissingFieldError(ValueError):
+    pass
+
+
+class Extractor():
+    """ a compiled `ExtractionSpec`, extracts all the fields of a listing without raising on missing optional fields
+        while counting how often each field was missing.
+    """
+
+    def __init__(self, fields: List[Tuple[str, Tuple[Step, ...], Optional[Callable], Any, bool]]) -> None:
+        self.fields = fields
+        self.misses: Counter = Counter()
+
+    def extract(self, element: "Tag") -> Dict[str, Any]:
+        values = {}
+        misses = self.misses
+        for name, steps, transform, default, required in self.fields:
+            value = element
+            for step in steps:
+                value = step(value)
+                if value is None:
+                    break
+            if value is not None and transform is not None:
+                value = transform(value)
+
+            if value is None:
+                if required:
+                    raise MissingFieldError(
+                        f"required field `{name}` missing from listing")
+                misses[name] += 1
+                value = default
+            values[name] = value
+        return values
+
+
+@dataclass
+class ExtractionSpec():
+    """ maps field names to the specs used to extract them from a listing element """
+
+    fields: Dict[str, FieldSpec] = field(default_factory=dict)
+
+    def compile(self) -> Extractor:
+        """ flattens the spec into the tuples the extractor loops over """
+        return Extractor([(name, tuple(spec.selector), spec.transform, spec.default, spec.required)
+                          for name, spec in self.fields.items()])
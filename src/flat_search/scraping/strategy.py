@@ -10,6 +10,7 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.common.keys import Keys
+from flat_search.log import Lazy
 from flat_search.util import binomial_trial, random_in_range, sleep_random_range
 
 
@@ -117,6 +118,12 @@ class PagedPropertyListingStrategy(ScrapeStrategy):
                  walk_query_pages_max: int,
                  # parsing settings
                  parse_function: Callable[[str], List[Property]],
+                 # resume settings
+                 walk_start_page: int = 0,
+                 walk_page_url: Callable[[str, int], str] = None,
+                 on_page_parsed: Callable[[int, List[Property]], None] = None,
+                 # pagination settings
+                 walk_count_pages: Callable[[str], Optional[int]] = None,
                  *args, **kwargs) -> None:
         """
             query_url -- the url at which we find query textbox and submit button
@@ -134,11 +141,22 @@ class PagedPropertyListingStrategy(ScrapeStrategy):
             walk_next_page_btn_locator -- the locator for the next page button, if one cannot be found it is assumed this is the last page
             walk_query_pages_max -- the number of pages to walk through at most
             parse_function -- the method to use to parse listing data once on one of the query listing pages (the main working horse)
+            walk_start_page -- the 0 indexed page of the true query to start from, i.e. when resuming a failed run
+            walk_page_url -- given the url the query led to and a 0 indexed page number returns the url of that page (optionally with filters pushed down),
+                if given the true query navigates there after the query is entered, required if `walk_start_page` is set
+            on_page_parsed -- called with the 0 indexed page number and the listings parsed from it after each page of the true query is parsed
+            walk_count_pages -- given the source of the first listing page of the true query returns the total number of pages or None if unknown,
+                if known the pages are walked by count rather than by waiting for the next page button
             listing_url -- either a plain url for the listing page if it's just one page, or a callable which given a page number returns the url of that page
         """
+        assert (walk_start_page == 0 or walk_page_url)
         self.walk_query_pages_max = walk_query_pages_max
+        self.on_page_parsed = on_page_parsed
+        self.walk_start_page = walk_start_page
+        self.page_count: Optional[int] = None
         self.data = []
         steps = []
+        sequence_type, query_type, loop_type, arbitrary_type, walk_type = self.node_types()
         no_decoys = random.randint(0, query_decoy_max)
         logging.info(
             f"{self.log_prefix(0)}Number of decoys chosen: {no_decoys}")
@@ -153,6 +171,9 @@ class PagedPropertyListingStrategy(ScrapeStrategy):
                 probability_scrape = 0
                 prefix = "Decoy"
                 max_pages = 1
+                start_page = 0
+                page_url = None
+                count_pages = None
 
             else:
                 # real query always gets looked at fully, and gets a full walk cuz why not
@@ -160,37 +181,65 @@ class PagedPropertyListingStrategy(ScrapeStrategy):
                 probability_scrape = 1
                 prefix = "True"
                 max_pages = walk_query_pages_max
+                start_page = walk_start_page
+                page_url = walk_page_url
+                count_pages = walk_count_pages
+
+            loop = loop_type(name=f"Scraping page",
+                             condition=lambda d, i, l, max_pages=max_pages, count_pages=count_pages: self.has_clickable_next_page_btn(
+                                 d, i, walk_next_page_btn_locator, l, max_pages=max_pages, count_pages=count_pages),
+                             cleanup=lambda d, i, l, max_pages=max_pages, count_pages=count_pages: self.click_next_page_btn(
+                                 d, i, walk_next_page_btn_locator, l, max_pages=max_pages, count_pages=count_pages),
+                             delay=(1, 3))
+            loop.index = start_page
+            loop.steps = [
+                arbitrary_type(
+                    name="Parse Data", behaviour=lambda d, loop=loop: self.parse_page_data(d, loop.index, parse_function), probability=probability_scrape),
+                walk_type(walk_listing_locator, walk_listing_look_probability,
+                          walk_listing_click_probability, walk_listing_look_delay, delay=(1, 3))
+            ]
+
+            query_steps = [
+                query_type(query_url, query, query_textbox_locator,
+                           query_btn_locator, delay=(1, 3), probability=probability_enter_query,
+                           on_skip=SkipBehaviour.BREAK),  # skip other steps if we don't enter query
+            ]
+            if page_url:
+                # pages before the start page were already parsed, go straight to the first missing one with the filters applied
+                query_steps.append(arbitrary_type(
+                    name=f"Jump to page {start_page + 1}", behaviour=lambda d, start_page=start_page, page_url=page_url: d.get(page_url(d.current_url, start_page))))
+            query_steps.append(loop)
 
             steps.append(
-                ScrapeStrategy(name=f"{prefix} Query: `{query}`", delay=(6, 10), steps=[
-                    EnterPropertyQuery(query_url, query, query_textbox_locator,
-                                       query_btn_locator, delay=(1, 3), probability=probability_enter_query,
-                                       on_skip=SkipBehaviour.BREAK),  # skip other steps if we don't enter query
-                    LoopWhile(name=f"Scraping page",
-                              condition=lambda d, i, l: self.has_clickable_next_page_btn(
-                                  d, i, walk_next_page_btn_locator, l, max_pages=max_pages),
-                              cleanup=lambda d, i, l: self.click_next_page_btn(
-                                  d, i, walk_next_page_btn_locator, l),
-                              delay=(1, 3),
-                              steps=[
-                                  ArbitraryStrategy(
-                                      name="Parse Data", behaviour=lambda d: self.data.extend(parse_function(d.page_source)), probability=probability_scrape),
-                                  ListingPageRandomWalk(walk_listing_locator, walk_listing_look_probability,
-                                                        walk_listing_click_probability, walk_listing_look_delay, delay=(1, 3))
-                              ])
-                ])
-            )
+                sequence_type(name=f"{prefix} Query: `{query}`", delay=(6, 10), steps=query_steps))
         # order not important make it more random
         random.shuffle(steps)
 
         super().__init__(
             f"Scraping `{query_url}`", *args, steps=steps, **kwargs)
 
-    def has_clickable_next_page_btn(self, driver: WebDriver, i: int, btn_locator, level: int, max_pages: int):
+    def node_types(self) -> Tuple[type, type, type, type, type]:
+        """ the strategy classes used to build the tree: (sequence, query, loop, arbitrary, random walk) """
+        return (ScrapeStrategy, EnterPropertyQuery, LoopWhile, ArbitraryStrategy, ListingPageRandomWalk)
+
+    def has_clickable_next_page_btn(self, driver: WebDriver, i: int, btn_locator, level: int, max_pages: int, count_pages: Callable[[str], Optional[int]] = None):
         if i + 1 > max_pages:
             logging.info(
                 f"{self.log_prefix(level)}Condition: Scraped enough pages.")
             return False
+
+        if count_pages:
+            if self.page_count is None:
+                self.page_count = count_pages(driver.page_source)
+                logging.info(
+                    f"{self.log_prefix(level)}Condition: planned {self.pages_planned()} pages out of {self.page_count} total.")
+            if self.page_count is not None:
+                if i + 1 > self.page_count:
+                    logging.info(
+                        f"{self.log_prefix(level)}Condition: Scraped all {self.page_count} pages.")
+                    return False
+                return True
+
         try:
             WebDriverWait(driver, 5).until(
                 expected_conditions.element_to_be_clickable(btn_locator))
@@ -202,11 +251,27 @@ class PagedPropertyListingStrategy(ScrapeStrategy):
                 f"{self.log_prefix(level)}Condition: Could not find next page button with locator: {btn_locator} on page {i + 1}.")
             return False
 
-    def click_next_page_btn(self, driver: WebDriver, i, btn_locator, level: int):
+    def click_next_page_btn(self, driver: WebDriver, i, btn_locator, level: int, max_pages: int = None, count_pages: Callable[[str], Optional[int]] = None):
+        if count_pages and self.page_count is not None and i + 1 >= min(self.page_count, max_pages):
+            logging.info(
+                f"{self.log_prefix(level)}Last planned page, not clicking next page button.")
+            return
         elem = driver.find_element(*btn_locator)
         ActionChains(driver).scroll_to_element(elem).perform()
         elem.click()
 
+    def pages_planned(self) -> Optional[int]:
+        """ the number of pages of the true query this run will walk if the total number of pages is known """
+        if self.page_count is None:
+            return None
+        return max(0, min(self.page_count, self.walk_query_pages_max) - self.walk_start_page)
+
+    def parse_page_data(self, driver: WebDriver, index: int, parse_function: Callable[[str], List[Property]]):
+        properties = parse_function(driver.page_source)
+        self.data.extend(properties)
+        if self.on_page_parsed:
+            self.on_page_parsed(index, properties)
+
     def get_data(self) -> List[Property]:
         return self.data
 
@@ -288,8 +353,11 @@ class ListingPageRandomWalk(ScrapeStrategy):
                     expected_conditions.presence_of_all_elements_located(self.listing_locator))
 
                 listings = driver.find_elements(*self.listing_locator)
-                logging.info(
-                    f"{self.log_prefix(level)}Using locator: {self.listing_locator} found: {[(l.tag_name, l.get_property('id')) for l in listings]} ")
+                logging.info("%sUsing locator: %s found: %d listings",
+                             self.log_prefix(level), self.listing_locator, len(listings))
+                # every id is another WebDriver call, only made when debugging
+                logging.debug("%sfound listings: %s", self.log_prefix(level), Lazy(
+                    lambda: [(l.tag_name, l.get_property('id')) for l in listings]))
 
             if index + 1 > len(listings):
                 break
@@ -1,15 +1,79 @@
 
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+import hashlib
+import json
 import logging
 import os
-from typing import List
+import threading
+from typing import Dict, List, Optional, Tuple
 
 from logging.handlers import TimedRotatingFileHandler
 
+from croniter import croniter
 from dataclasses_json import dataclass_json
 
 from flat_search.data import PropertyType
+from flat_search.log import StructuredFormatter, start_background_logging
+
+
+@dataclass_json
+@dataclass
+class FilterRule():
+    """ a single predicate over one field of a property, a property passes a list of rules if it passes all of them.
+
+        numeric fields: `price_per_month`, `deposit`, `bedrooms`, `price_per_bedroom`, `available_from` and `date_listed` (timestamps),
+        missing values never pass a range, excluded or not.
+        `property_type` takes an `allow` list of property type values.
+        `postcode_district` takes an `allow` list of districts (`SW10`) or whole areas (`SW` for SW1 to SW20).
+        text fields: `address` and `description` take `keywords`, matched case insensitively.
+    """
+
+    field: str
+    """ the field of the property the rule applies to """
+
+    min: Optional[float] = None
+    """ the inclusive lower bound of a numeric field """
+
+    max: Optional[float] = None
+    """ the inclusive upper bound of a numeric field """
+
+    min_exclusive: bool = False
+    """ makes `min` an exclusive lower bound """
+
+    allow: Optional[List[str]] = None
+    """ the allowed values of a categorical field """
+
+    keywords: Optional[List[str]] = None
+    """ the property passes if any of these appear in the text field """
+
+    exclude: bool = False
+    """ inverts the rule, i.e. to drop properties mentioning a keyword """
+
+
+SEARCH_FIELDS = ["za_url", "query", "property_type_allowlist", "min_price", "max_price",
+                 "min_bedrooms", "max_bedrooms", "available_from", "filters"]
+""" the settings a search is made of, see `Settings.search_key` """
+
+
+@dataclass_json
+@dataclass
+class Subscriber():
+    """ a recipient of a shared scrape with their own filters, fields left as None are taken from the parent settings """
+
+    name: str
+    """ unique among the subscribers of a search, used as the name of the subscriber's dump directory """
+
+    email_recipients: List[str]
+    """ the emails to send this subscriber's property updates to """
+
+    property_type_allowlist: Optional[List[PropertyType]] = None
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    min_bedrooms: Optional[int] = None
+    max_bedrooms: Optional[int] = None
+    available_from: Optional[float] = None
+    filters: Optional[List[FilterRule]] = None
 
 
 @dataclass_json
@@ -77,26 +141,358 @@ class Settings():
     logging_level: str
     """  the log level, options: """
 
+    structured_logs: bool = False
+    """ writes the log file as json lines, with the fields of structured events as keys """
+
+    navigation_rate_per_minute: float = 20
+    """ the number of page navigations per minute allowed to each host, shared by all processes running from the same directory """
+
+    navigation_burst: int = 5
+    """ the number of page navigations allowed to a host in quick succession before `navigation_rate_per_minute` applies """
+
+    checkpoint_resume_window_minutes: float = 60
+    """ a failed scrape retried within this many minutes resumes from the first page it did not finish, 0 disables resuming """
+
+    scrape_retries: int = 2
+    """ the number of times a failed scrape is retried within the same run, resuming from its checkpoint """
+
+    scrape_retry_delay_seconds: float = 60
+    """ the seconds waited before retrying a failed scrape, keep it well within `checkpoint_resume_window_minutes` """
+
+    seen_bloom_filter_bits: int = 0
+    """ the size of the bloom filter in front of the index of every listing seen before, 0 disables it.
+        about 10 bits per listing and fingerprint ever seen keeps false positives near 1% """
+
+    digest_window_minutes: float = 0
+    """ if set, changes are queued and sent as one digest by the first run at least this many minutes after the oldest queued change.
+        0 sends the changes of every run straight away """
+
+    digest_max_changes: int = 0
+    """ in digest mode, the digest is also sent as soon as this many listings have queued changes, 0 for no limit """
+
+    trace_allocations: bool = False
+    """ traces python allocations during runs and stores the top allocation sites with the run metrics, slows runs down noticeably """
+
+    metrics_alert_band: float = 0
+    """ emails an alert when one of `metrics_alerts` of a run is more than this fraction (i.e. 0.5) away from its median over
+        the last `metrics_alert_window` runs, 0 disables alerts """
+
+    metrics_alert_window: int = 10
+    """ the number of earlier successful runs the metrics of a run are compared against """
+
+    metrics_alerts: List[str] = field(default_factory=lambda: [
+                                      "duration_seconds", "pages_walked", "listings_parsed", "listings_kept", "peak_rss_mb"])
+    """ the run metrics alerted on, see `python -m flat_search metrics` for every metric recorded """
+
+    metrics_port: int = 0
+    """ serves prometheus metrics of the scheduler at `http://<metrics_host>:<metrics_port>/metrics`, 0 disables the endpoint.
+        only read from the main settings file when the scheduler starts """
+
+    metrics_host: str = "127.0.0.1"
+    """ the address the metrics endpoint listens on """
+
+    dump_format: str = "json"
+    """ `json` dumps every run as one json document, `ndjson` streams it as one json line per listing sorted by id
+        so consecutive dumps are diffed in constant memory. dumps of both formats can sit in the same directory """
+
+    api_port: int = 0
+    """ serves the read-only listings api over the dumps of every search at `http://<api_host>:<api_port>/<search>/`, 0 disables it.
+        only read from the main settings file when the scheduler starts, `python -m flat_search serve` serves any dump directory """
+
+    api_host: str = "127.0.0.1"
+    """ the address the listings api listens on """
+
+    filters: List[FilterRule] = field(default_factory=list)
+    """ extra filter rules all properties have to pass on top of the price, bedroom and availability ranges above """
+
+    subscribers: List[Subscriber] = field(default_factory=list)
+    """ if given, the union of the subscribers' filters is scraped once and each subscriber gets their own filtered diff and email """
+
+    def for_subscriber(self, subscriber: Subscriber) -> "Settings":
+        """ returns a copy of these settings with the subscriber's filters and recipients applied """
+        overrides = {
+            "email_recipients": subscriber.email_recipients,
+            "subscribers": []
+        }
+        for name in ["property_type_allowlist", "min_price", "max_price", "min_bedrooms", "max_bedrooms", "available_from", "filters"]:
+            value = getattr(subscriber, name)
+            if value is not None:
+                overrides[name] = value
+        return replace(self, **overrides)
+
+    def superset(self) -> "Settings":
+        """ returns a copy of these settings whose filters admit every property admitted by any of the subscribers """
+        if not self.subscribers:
+            return self
+
+        subscribers = [self.for_subscriber(x) for x in self.subscribers]
+        property_types = []
+        for s in subscribers:
+            property_types.extend(
+                x for x in s.property_type_allowlist if x not in property_types)
+
+        return replace(self,
+                       property_type_allowlist=property_types,
+                       min_price=min(x.min_price for x in subscribers),
+                       max_price=max(x.max_price for x in subscribers),
+                       min_bedrooms=min(x.min_bedrooms for x in subscribers),
+                       max_bedrooms=max(x.max_bedrooms for x in subscribers),
+                       available_from=min(x.available_from for x in subscribers),
+                       # extra rules of one subscriber cannot be combined with another's, keep everything
+                       filters=[])
+
+    def search_key(self) -> str:
+        """ the fields deciding which listings a scrape walks through as a json string, unrelated settings like
+            the email template or recipients are left out so editing them doesn't orphan the checkpoint of a failed scrape
+        """
+        values = self.to_dict(encode_json=True)
+        return json.dumps({x: values[x] for x in SEARCH_FIELDS}, sort_keys=True)
+
+    def filter_rules(self) -> List[FilterRule]:
+        """ the rules applied to scraped properties, the price, bedroom and availability ranges followed by the extra `filters` """
+        return [
+            FilterRule("price_per_month", min=self.min_price,
+                       max=self.max_price),
+            FilterRule("bedrooms", min=self.min_bedrooms,
+                       max=self.max_bedrooms),
+            FilterRule("available_from", min=self.available_from,
+                       min_exclusive=True),
+            *self.filters
+        ]
+
+
+def parse_settings(path: str, data: Optional[str] = None) -> Settings:
+    """ parses the settings file at the given path, or its already read contents, into a Settings object without touching logging configuration """
+    if data is None:
+        with open(path, "r") as f:
+            data = f.read()
+    settings: Settings = Settings.schema().loads(data)
+
+    if settings.no_proxy:
+        logging.warn("NOT USING PROXY!")
+    return settings
+
+
+class InvalidSettingsError(ValueError):
+    pass
+
+
+def rule_problems(rule: FilterRule) -> List[str]:
+    """ the problems with a filter rule, an unknown field or an allowed value outside the vocabulary of its field
+        which would silently filter out every property """
+    from flat_search.data.filter import NUMERIC_FIELDS, TEXT_FIELDS
+    from flat_search.data.postcode import is_district_or_area
+
+    if rule.field == "property_type":
+        values = {x.value for x in PropertyType}
+        unknown = [x for x in rule.allow or [] if x not in values]
+    elif rule.field == "postcode_district":
+        unknown = [x for x in rule.allow or [] if not is_district_or_area(x)]
+    elif rule.field in NUMERIC_FIELDS or rule.field in TEXT_FIELDS:
+        unknown = []
+    else:
+        return [f"cannot filter on unknown field: {rule.field}"]
+
+    return [f"unknown {rule.field} values allowed: {unknown}"] if unknown else []
+
+
+def validate_settings(settings: Settings):
+    """ raises an InvalidSettingsError listing every problem with the settings """
+    problems = []
+    if settings.logging_level not in logging._nameToLevel:
+        problems.append(f"unknown logging_level: {settings.logging_level}")
+    if settings.min_price > settings.max_price:
+        problems.append("min_price is above max_price")
+    if settings.min_bedrooms > settings.max_bedrooms:
+        problems.append("min_bedrooms is above max_bedrooms")
+    if not settings.email_recipients and not settings.subscribers:
+        problems.append("no email_recipients or subscribers")
+    if not 0 <= settings.cron_expression_skip_chance <= 1:
+        problems.append("cron_expression_skip_chance is not between 0 and 1")
+    if settings.dump_format not in ["json", "ndjson"]:
+        problems.append(f"unknown dump_format: {settings.dump_format}")
+    if settings.metrics_alert_band < 0:
+        problems.append("metrics_alert_band is negative")
+    if settings.scrape_retries < 0:
+        problems.append("scrape_retries is negative")
+    if settings.metrics_alert_window < 1:
+        problems.append("metrics_alert_window is below 1")
+    if not croniter.is_valid(settings.cron_expression):
+        problems.append(f"invalid cron_expression: {settings.cron_expression}")
+
+    names = set()
+    for subscriber in settings.subscribers:
+        if subscriber.name in names:
+            problems.append(f"duplicate subscriber name: {subscriber.name}")
+        names.add(subscriber.name)
+
+    for rules in [settings.filters, *[x.filters or [] for x in settings.subscribers]]:
+        for rule in rules:
+            problems.extend(rule_problems(rule))
+
+    if problems:
+        raise InvalidSettingsError("; ".join(problems))
+
+
+class SettingsManager():
+    """ keeps the parsed settings of one file and only parses it again once its contents change.
+
+        a changed file is detected by its mtime and size, then confirmed by the hash of its contents so touching the file
+        doesn't cause a reparse. settings which fail to parse or validate are logged and the last good settings kept.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.settings: Optional[Settings] = None
+        self.stat: Optional[Tuple[int, int]] = None
+        self.digest: Optional[str] = None
+        self.reloads = 0
+        self.reads = 0
+        self.parses = 0
+        self.lock = threading.Lock()
+
+    def get(self) -> Settings:
+        """ the current settings, raises if the file never held valid settings """
+        with self.lock:
+            self.reads += 1
+            stat = os.stat(self.path)
+            key = (stat.st_mtime_ns, stat.st_size)
+            if self.settings is not None and key == self.stat:
+                return self.settings
+
+            with open(self.path, "rb") as f:
+                data = f.read()
+            digest = hashlib.sha1(data).hexdigest()
+            self.stat = key
+            if self.settings is not None and digest == self.digest:
+                return self.settings
+
+            self.parses += 1
+            try:
+                settings = parse_settings(self.path, data.decode())
+                validate_settings(settings)
+            except Exception:
+                if self.settings is None:
+                    raise
+                logging.exception(
+                    f"Keeping previous settings, the changed settings at {self.path} are invalid")
+                # the same broken contents aren't parsed again
+                self.digest = digest
+                return self.settings
+
+            self.settings = settings
+            self.digest = digest
+            self.reloads += 1
+            return settings
+
+
+_managers: Dict[str, SettingsManager] = {}
+_managers_lock = threading.Lock()
+
+
+def settings_manager(path: str) -> SettingsManager:
+    """ the manager of the settings file at the path shared by the whole process """
+    with _managers_lock:
+        manager = _managers.get(os.path.abspath(path))
+        if manager is None:
+            manager = SettingsManager(path)
+            _managers[os.path.abspath(path)] = manager
+        return manager
+
+
+def settings_cache_stats() -> Tuple[int, int]:
+    """ the number of times settings were read through a manager and the number of times a file had to be parsed for it """
+    with _managers_lock:
+        managers = list(_managers.values())
+    return (sum(x.reads for x in managers), sum(x.parses for x in managers))
+
+
+_file_handler: Optional[TimedRotatingFileHandler] = None
+_logging_lock = threading.Lock()
+
+
+def configure_logging(level: str, structured: bool = False):
+    """ sets up the console and daily rotated file logging written by a background thread the first time it is called,
+        later calls only change the level and the format of the log file
+    """
+    global _file_handler
+    root = logging.getLogger()
+    with _logging_lock:
+        if _file_handler is None:
+            os.makedirs('logs', exist_ok=True)
+            logging.basicConfig(force=True)
+            _file_handler = TimedRotatingFileHandler(
+                'logs/log', when='D', interval=1, backupCount=7)
+            root.addHandler(_file_handler)
+            start_background_logging(root)
+        _file_handler.setFormatter(
+            StructuredFormatter() if structured else logging.Formatter())
+        if root.level != logging._nameToLevel[level]:
+            print(f"log level: {level}")
+            root.setLevel(logging._nameToLevel[level])
+
 
 def load_settings() -> Settings:
-    """ looks for settings-<os.getenv('ENV')>.json file in the current directory and parses it into a Settings object"""
+    """ looks for settings-<os.getenv('ENV')>.json file in the current directory and parses it into a Settings object.
+
+        the file is only parsed again when it changed since the last call and logging is only set up once, so this is cheap to call before every run
+    """
     SETTINGS_LOCATION = f"settings-{str(os.getenv('ENV', 'dev'))}.json"
-    print(f"loading settings from: {SETTINGS_LOCATION}")
-
-    with open(SETTINGS_LOCATION, "r") as f:
-        data = f.read()
-        settings: Settings = Settings.schema().loads(data)
-
-        if settings.no_proxy:
-            logging.warn("NOT USING PROXY!")
-
-        print(f"log level: {settings.logging_level}")
-        os.makedirs('logs', exist_ok=True)
-        logging.basicConfig(
-            level=logging._nameToLevel[settings.logging_level], force=True)
-        logging.getLogger().addHandler(TimedRotatingFileHandler(
-            'logs/log', when='D', interval=1, backupCount=7))
-        # for n, l in logging.getLogger().manager.loggerDict.items():
-        #     if not n.startswith('root'):
-        #         l.disabled = True
-        return settings
+    manager = settings_manager(SETTINGS_LOCATION)
+    reloads = manager.reloads
+
+    settings = manager.get()
+    if manager.reloads != reloads:
+        print(f"loaded settings from: {SETTINGS_LOCATION}")
+    configure_logging(settings.logging_level, settings.structured_logs)
+    # for n, l in logging.getLogger().manager.loggerDict.items():
+    #     if not n.startswith('root'):
+    #         l.disabled = True
+    return settings
+
+
+@dataclass
+class SearchProfile():
+    """ a named saved search, each profile keeps its dumps and diffs in its own directory """
+
+    name: str
+    """ the name of the search (shown in logs) """
+
+    settings_path: str
+    """ path to the settings file of this search, re-read before every run """
+
+    dump_dir: str
+    """ directory holding the json dumps and diffs of this search """
+
+    def load(self) -> Settings:
+        return settings_manager(self.settings_path).get()
+
+
+def load_search_profiles() -> Tuple[List[SearchProfile], int]:
+    """ looks for searches-<os.getenv('ENV')>.json file in the current directory and returns the search profiles it lists
+        along with the maximum number of concurrent browser sessions.
+
+        the file has the format:
+        ```json
+        {
+            "max_concurrent_sessions": 1,
+            "searches": {
+                "<name>": "<path to settings file>"
+            }
+        }
+        ```
+
+        if no such file exists, the single settings-<os.getenv('ENV')>.json profile is used with the `data` directory.
+    """
+    env = str(os.getenv('ENV', 'dev'))
+    SEARCHES_LOCATION = f"searches-{env}.json"
+
+    if not os.path.exists(SEARCHES_LOCATION):
+        return ([SearchProfile("default", f"settings-{env}.json", "data")], 1)
+
+    with open(SEARCHES_LOCATION, "r") as f:
+        searches = json.load(f)
+
+    profiles = [SearchProfile(name, path, os.path.join("data", name))
+                for name, path in searches["searches"].items()]
+    return (profiles, int(searches.get("max_concurrent_sessions", 1)))
@@ -1,5 +1,8 @@
+import asyncio
+import functools
 import random
 from time import sleep
+from typing import Any, Callable
 
 
 def random_in_range(min: float, max: float):
@@ -13,6 +16,19 @@ def sleep_random_range(min: float, max: float):
         sleep(time)
 
 
+async def async_sleep_random_range(min: float, max: float):
+    """ awaitable version of `sleep_random_range`, yields to the event loop instead of blocking the thread """
+    time = random_in_range(min, max)
+    if time > 0.0001:
+        await asyncio.sleep(time)
+
+
+async def run_blocking(callable: Callable[..., Any], *args, **kwargs) -> Any:
+    """ runs a blocking callable (i.e. a WebDriver call) in the default executor and awaits its result """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(callable, *args, **kwargs))
+
+
 def binomial_trial(p: float) -> bool:
     """ if p is between 0 and 1, returns true if the binomial trial succeeded """
     if p == 0: